@@ -0,0 +1,183 @@
+"""
+End to end throughput of Consume, each formatter and StreamWriter replaying
+synthetic replication streams into a local Kinesis stub.
+
+    python -m benchmarks.bench_end_to_end --transactions 2000 --rows-per-xact 10 --columns 20
+
+For every output plugin and formatter it reports replicated messages/sec, bytes
+read from the stream and sent to Kinesis per second, p50/p99 latency of the
+format, put and send stages and the peak memory allocated while replaying.
+Stage latencies are per replication message for format, per formatted message,
+or transaction with --group-transactions, for put and per request for send. --format-workers formats in worker processes,
+whose format latency is not measured.
+"""
+from __future__ import division, print_function
+
+import argparse
+import logging
+import time
+import tracemalloc
+
+from pg2kinesis.__main__ import Consume, ParallelConsume
+from pg2kinesis.formatter import get_formatter, msgpack
+from pg2kinesis.grouping import TransactionGrouper
+from pg2kinesis.log import logger
+from pg2kinesis.parallel import FormatterPool
+from pg2kinesis.stream import KeyCoalescer, PipelinedStreamWriter, StreamWriter
+
+from .kinesis_stub import KinesisStub
+from .synthetic import PLUGINS, primary_key_map, replication_stream
+
+FORMATTERS = ['CSV', 'CSVPayload', 'MessagePack']
+STAGES = ['format', 'put', 'send']
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+def timed(func, samples):
+    def wrapper(*args, **kwargs):
+        start = timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            samples.append(timer() - start)
+    return wrapper
+
+
+class TimedFormatter(object):
+    """
+    Times calls of a formatter, Consume also reads attributes off it.
+    """
+    def __init__(self, formatter, samples):
+        self._formatter = formatter
+        self._call = timed(lambda payload: list(formatter(payload)), samples)
+
+    def __call__(self, payload):
+        return self._call(payload)
+
+    def __getattr__(self, name):
+        return getattr(self._formatter, name)
+
+
+def run(stream, plugin, formatter_name, args, stub):
+    output_plugin = 'wal2json' if plugin == 'wal2json2' else plugin
+    # pgoutput learns primary keys from its relation messages.
+    pk_map = {} if plugin == 'pgoutput' else primary_key_map(args.tables)
+    formatter = get_formatter(formatter_name, pk_map, output_plugin,
+                              args.full_change and output_plugin != 'test_decoding', None,
+                              wal2json_format_version=2 if plugin == 'wal2json2' else 1)
+    stream_writer = StreamWriter('bench', batch=args.put_records, endpoint_url=stub.endpoint_url,
+                                 coalescer=KeyCoalescer() if args.coalesce_keys else None)
+    writer = PipelinedStreamWriter(stream_writer).start() if args.pipeline else stream_writer
+
+    samples = dict((stage, []) for stage in STAGES)
+    operations = ['insert', 'update', 'delete']
+    grouper = TransactionGrouper(formatter) if args.group_transactions else None
+    if args.format_workers:
+        pool = FormatterPool(formatter, args.format_workers, args.format_batch_size)
+        consume = ParallelConsume(pool, writer, operations, grouper=grouper)
+    else:
+        consume = Consume(TimedFormatter(formatter, samples['format']), writer, operations, grouper=grouper)
+    writer.put_message = timed(writer.put_message, samples['put'])
+    stream_writer._send_agg_record = timed(stream_writer._send_agg_record, samples['send'])
+    stream_writer._send_batch = timed(stream_writer._send_batch, samples['send'])
+    # Only time puts of formatted messages, not send window checks.
+    consume.should_send_to_kinesis = lambda fmt_msg: True
+
+    sent_bytes = stub.bytes
+    start = timer()
+    for message in stream:
+        consume(message)
+    consume.close()
+
+    if args.pipeline:
+        while writer.queued_count:
+            time.sleep(.001)
+        writer.close()
+    stream_writer.flush()
+    elapsed = timer() - start
+
+    # Puts are of groups when grouping, every row of the stream is put.
+    messages = args.transactions * args.rows_per_xact if grouper else len(samples['put'])
+    return dict(elapsed=elapsed, messages=messages, sent_bytes=stub.bytes - sent_bytes,
+                acked=stream_writer.tracker.acked_lsn == stream[-1].data_start, samples=samples)
+
+
+def peak_memory(stream, plugin, formatter_name, args, stub):
+    """
+    :return: peak bytes allocated replaying stream, less what was allocated before.
+    """
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        run(stream, plugin, formatter_name, args, stub)
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--plugin', choices=PLUGINS, action='append',
+                        help='Output plugin stream to replay, repeatable. Default all.')
+    parser.add_argument('--formatter', choices=FORMATTERS, action='append',
+                        help='Formatter to run, repeatable. Default all installed.')
+    parser.add_argument('--transactions', type=int, default=2000)
+    parser.add_argument('--rows-per-xact', type=int, default=10)
+    parser.add_argument('--columns', type=int, default=20, help='Columns per row, the primary key included.')
+    parser.add_argument('--tables', type=int, default=10)
+    parser.add_argument('--full-change', action='store_true', help='Replicate whole rows from wal2json and pgoutput.')
+    parser.add_argument('--put-records', action='store_true')
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--format-workers', type=int, default=0, help='Format in this many processes.')
+    parser.add_argument('--format-batch-size', type=int, default=100)
+    parser.add_argument('--group-transactions', action='store_true', help='Put each transaction as one message.')
+    parser.add_argument('--coalesce-keys', action='store_true', help='Only send the last change of every row.')
+    parser.add_argument('--hot-rows', type=int, help='Change only this many distinct rows over and over.')
+    parser.add_argument('--latency', type=float, default=0.002, help='Seconds per Kinesis request.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of records throttled.')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the slower peak memory pass.')
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    formatters = args.formatter or [name for name in FORMATTERS if name != 'MessagePack' or msgpack is not None]
+    if args.full_change:
+        # Like pg2kinesis, CSV cannot format full changes.
+        assert 'CSV' not in (args.formatter or []), 'Full changes must be formatted as JSON or MessagePack.'
+        formatters = [name for name in formatters if name != 'CSV']
+    print('{} transactions of {} rows, {} columns, {} tables, full change: {}'.format(
+        args.transactions, args.rows_per_xact, args.columns, args.tables, args.full_change))
+    print('{:14} {:11} {:>10} {:>8} {:>8} {}{:>9}'.format(
+        'plugin', 'formatter', 'msgs/s', 'in MB/s', 'out MB/s',
+        ''.join('{:>17}'.format(stage + ' p50/p99 us') for stage in STAGES), 'peak MB'))
+
+    with KinesisStub(latency=args.latency, throttle_rate=args.throttle_rate) as stub:
+        for plugin in args.plugin or PLUGINS:
+            stream = replication_stream(plugin, args.transactions, args.rows_per_xact, args.columns, args.tables,
+                                        args.hot_rows)
+            in_bytes = sum(message.data_size for message in stream)
+
+            for formatter_name in formatters:
+                result = run(stream, plugin, formatter_name, args, stub)
+                assert result['acked'], 'Every message acknowledged'
+                peak = '-' if args.no_memory else '{:.1f}'.format(
+                    peak_memory(stream, plugin, formatter_name, args, stub) / 1048576)
+
+                latencies = ''.join('{:>8.0f}/{:<8.0f}'.format(percentile(result['samples'][stage], 50) * 1e6,
+                                                                percentile(result['samples'][stage], 99) * 1e6)
+                                    for stage in STAGES)
+                print('{:14} {:11} {:>10.0f} {:>8.2f} {:>8.2f} {}{:>9}'.format(
+                    plugin, formatter_name, result['messages'] / result['elapsed'],
+                    in_bytes / result['elapsed'] / 1048576, result['sent_bytes'] / result['elapsed'] / 1048576,
+                    latencies, peak))
+
+
+if __name__ == '__main__':
+    main()
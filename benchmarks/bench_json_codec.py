@@ -0,0 +1,81 @@
+"""
+Per message cost of each installed JSON codec formatting wal2json transactions,
+split into parsing the payload and encoding CSVPayload messages.
+
+    python -m benchmarks.bench_json_codec --rows 200 --columns 20 --full-change
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import timeit
+
+from pg2kinesis.formatter import CSVPayloadFormatter
+from pg2kinesis.json_codec import available_json_codecs, get_json_codec
+from pg2kinesis.slot import PrimaryKeyMapItem
+
+COLUMN_TYPES = ['int4', 'varchar', 'timestamp', 'numeric', 'jsonb', 'bool']
+
+
+def column_value(i, row):
+    col_type = COLUMN_TYPES[i % len(COLUMN_TYPES)]
+    if col_type == 'int4':
+        return row * 31 + i
+    elif col_type == 'varchar':
+        return 'value {} of row {}'.format(i, row)
+    elif col_type == 'timestamp':
+        return '2018-03-01 16:41:53.{:06}'.format(row)
+    elif col_type == 'numeric':
+        return row + i / 100
+    elif col_type == 'jsonb':
+        return json.dumps({'n': row, 'tags': ['a', 'b']})
+    return bool(row % 2)
+
+
+def make_transaction(rows, columns):
+    """
+    :return: a wal2json format-version 1 payload as wal2json sends it, in bytes.
+    """
+    names = ['id'] + ['c{}'.format(i) for i in range(columns - 1)]
+    types = ['int4'] + [COLUMN_TYPES[i % len(COLUMN_TYPES)] for i in range(columns - 1)]
+    change = [dict(kind='update', schema='public', table='bench', columnnames=names, columntypes=types,
+                   columnvalues=[row] + [column_value(i, row) for i in range(columns - 1)])
+              for row in range(rows)]
+    return json.dumps({'xid': 1234, 'change': change}).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200, help='Rows per transaction.')
+    parser.add_argument('--columns', type=int, default=20)
+    parser.add_argument('--full-change', action='store_true', help='Encode whole rows rather than keys.')
+    parser.add_argument('--number', type=int, default=50)
+    args = parser.parse_args()
+
+    payload = make_transaction(args.rows, args.columns)
+    pkey_map = {'public.bench': (PrimaryKeyMapItem('public.bench', 'id', 'integer', 1),)}
+
+    print('{} rows of {} columns, {} byte transaction, full change: {}'.format(
+        args.rows, args.columns, len(payload), args.full_change))
+    print('{:10} {:>12} {:>12} {:>12}'.format('codec', 'parse us/msg', 'encode us/msg', 'total us/msg'))
+
+    for name in available_json_codecs():
+        formatter = CSVPayloadFormatter(pkey_map, 'wal2json', args.full_change,
+                                        json_codec=get_json_codec(name))
+        changes = formatter._preprocess_wal2json_change(payload)
+
+        def parse():
+            formatter._preprocess_wal2json_change(payload)
+
+        def encode():
+            for change in changes:
+                formatter.produce_formatted_message(change)
+
+        per_msg = args.number * args.rows / 1e6
+        parse_us = min(timeit.repeat(parse, number=args.number, repeat=3)) / per_msg
+        encode_us = min(timeit.repeat(encode, number=args.number, repeat=3)) / per_msg
+        print('{:10} {:>12.2f} {:>13.2f} {:>12.2f}'.format(name, parse_us, encode_us, parse_us + encode_us))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Compares the put_record and PutRecords send paths of StreamWriter against a local
+Kinesis stub.
+
+    python -m benchmarks.bench_put_records --messages 20000 --latency 0.005
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import logging
+import time
+
+from pg2kinesis.formatter import Change, Message
+from pg2kinesis.log import logger
+from pg2kinesis.stream import StreamWriter
+
+from .kinesis_stub import KinesisStub
+
+
+def make_messages(count, payload_size):
+    padding = 'x' * payload_size
+    for i in range(count):
+        change = Change(xid=i // 10, table='public.bench', operation='update', pkey=str(i))
+        yield Message(change=change, fmt_msg='0,CDC,' + json.dumps(dict(change._asdict(), pad=padding)))
+
+
+def run(batch, messages, payload_size, latency, throttle_rate):
+    with KinesisStub(latency=latency, throttle_rate=throttle_rate) as stub:
+        writer = StreamWriter('bench', send_window=0, batch=batch, endpoint_url=stub.endpoint_url)
+        # Force small aggregates so that each path sends many records.
+        writer._record_agg = type(writer._record_agg)(max_size=64 * 1024)
+        stub.requests = 0
+
+        start = time.time()
+        for lsn, msg in enumerate(make_messages(messages, payload_size)):
+            writer.tracker.add(lsn)
+            writer.put_message(msg, lsn)
+        writer.flush()
+        elapsed = time.time() - start
+
+    return elapsed, stub.requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--payload-size', type=int, default=512)
+    parser.add_argument('--latency', type=float, default=0.005, help='Seconds per request.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    for name, batch in (('put_record', False), ('put_records', True)):
+        elapsed, requests = run(batch, args.messages, args.payload_size, args.latency, args.throttle_rate)
+        print('{:12} {:>10.0f} records/sec {:>6} requests {:>8.2f}s'.format(
+            name, args.messages / elapsed, requests, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Compares primary key extraction from test_decoding rows by the per-table regex
+pg2kinesis used to build, the compiled single pass tokenizer and
+TupleKeyReader, which searches first and only tokenizes when it must.
+
+    python -m benchmarks.bench_test_decoding --columns 200 --key-position 0
+"""
+from __future__ import division, print_function
+
+import argparse
+import re
+import timeit
+
+from pg2kinesis.formatter import compile_test_decoding_key_pattern, read_test_decoding_value, \
+    TupleKeyReader
+
+# The pattern Formatter used to build for every table's primary key.
+COL_TYPE_VALUE_TEMPLATE_PAT = r"{col_name}\[{col_type}\]:'?([\w\-]+)'?"
+
+COLUMN_TEMPLATES = [
+    "c{}[integer]:{}",
+    "c{}[character varying]:'value number {}'",
+    "c{}[timestamp without time zone]:'2018-03-01 16:41:53.{:06}'",
+    "c{}[text]:'it''s row {} of a wide table'",
+    "c{}[jsonb]:'{{\"n\": {}}}'",
+]
+
+
+def make_row(columns, key_position):
+    cols = [COLUMN_TEMPLATES[i % len(COLUMN_TEMPLATES)].format(i, i) for i in range(columns)]
+    cols.insert(key_position, "id[uuid]:'00079f3e-0479-4475-acff-4f225cc5188a'")
+    return ' '.join(cols)
+
+
+def regex_pkey(pattern, row):
+    return pattern.search(row).groups()[0]
+
+
+def tokenizer_pkey(pattern, row):
+    return read_test_decoding_value(pattern.match(row))
+
+
+def reader_pkey(reader, row):
+    return reader(row)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--columns', type=int, default=50)
+    parser.add_argument('--key-position', type=int, default=0)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    row = make_row(args.columns, args.key_position)
+    pattern = re.compile(COL_TYPE_VALUE_TEMPLATE_PAT.format(col_name='id', col_type='uuid'))
+    tokenizer = compile_test_decoding_key_pattern(['id'])
+    reader = TupleKeyReader(['id'], ['uuid'])
+    assert regex_pkey(pattern, row) == tokenizer_pkey(tokenizer, row) == reader_pkey(reader, row)
+
+    print('{} columns, key at {}, {} byte rows'.format(args.columns, args.key_position, len(row)))
+    for name, func, arg in (('regex', regex_pkey, pattern), ('tokenizer', tokenizer_pkey, tokenizer),
+                            ('reader', reader_pkey, reader)):
+        elapsed = min(timeit.repeat(lambda: func(arg, row), number=args.number, repeat=3))
+        print('{:10} {:>8.2f} us/row'.format(name, elapsed / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
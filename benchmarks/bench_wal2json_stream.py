@@ -0,0 +1,60 @@
+"""
+Peak memory formatting one large wal2json version 1 transaction, parsed whole
+and streamed one row at a time.
+
+    python -m benchmarks.bench_wal2json_stream --rows 100000 --columns 20
+"""
+from __future__ import division, print_function
+
+import argparse
+import timeit
+import tracemalloc
+
+from benchmarks.bench_json_codec import make_transaction
+from pg2kinesis.formatter import CSVPayloadFormatter, WAL2JSON_STREAM_WINDOW
+from pg2kinesis.slot import PrimaryKeyMapItem
+
+
+def peak_memory(formatter, payload):
+    """
+    :return: tuple of peak bytes allocated formatting payload, beyond the payload
+             itself, and seconds taken.
+    """
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        start = timeit.default_timer()
+        for fmt_msg in formatter(payload):
+            pass
+        elapsed = timeit.default_timer() - start
+        return tracemalloc.get_traced_memory()[1] - baseline, elapsed
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000, help='Rows of the transaction.')
+    parser.add_argument('--columns', type=int, default=20)
+    parser.add_argument('--full-change', action='store_true', help='Format whole rows rather than keys.')
+    args = parser.parse_args()
+
+    payload = make_transaction(args.rows, args.columns)
+    pkey_map = {'public.bench': (PrimaryKeyMapItem('public.bench', 'id', 'integer', 1),)}
+
+    print('{} rows of {} columns, {:.1f} MB transaction, full change: {}'.format(
+        args.rows, args.columns, len(payload) / 1048576, args.full_change))
+    print('{:8} {:>8} {:>8}'.format('parse', 'peak MB', 'seconds'))
+
+    peaks = {}
+    for name, threshold in (('whole', None), ('streamed', 1)):
+        formatter = CSVPayloadFormatter(pkey_map, 'wal2json', args.full_change, stream_threshold=threshold)
+        peaks[name], elapsed = peak_memory(formatter, payload)
+        print('{:8} {:>8.1f} {:>8.2f}'.format(name, peaks[name] / 1048576, elapsed))
+
+    # A few copies of the window, whatever the size of the payload.
+    assert peaks['streamed'] < 8 * WAL2JSON_STREAM_WINDOW, 'Streaming keeps peak memory bounded'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+A minimal in-process Kinesis endpoint for benchmarks.
+
+It speaks just enough of the Kinesis JSON protocol for StreamWriter: CreateStream,
+DescribeStream, PutRecord and PutRecords. Every request can be delayed by a fixed
+latency and a fraction of records can be rejected as throttled.
+"""
+from __future__ import division
+
+import base64
+import json
+import os
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+THROTTLED = 'ProvisionedThroughputExceededException'
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class KinesisStub(object):
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0):
+        """
+        :param latency: seconds added to every request.
+        :param throttle_rate: fraction of records (0..1) rejected as throttled.
+        """
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.requests = 0
+        self.records = 0
+        self.bytes = 0
+        self.throttled = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def endpoint_url(self):
+        return 'http://127.0.0.1:%s' % self._server.server_address[1]
+
+    def __enter__(self):
+        # boto3 insists on credentials and a region even though the stub ignores them.
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _accept(self, data):
+        with self._lock:
+            if self._random.random() < self.throttle_rate:
+                self.throttled += 1
+                return False
+            self.records += 1
+            self.bytes += len(base64.b64decode(data))
+            return True
+
+    def handle(self, action, body):
+        """
+        :return: tuple of http status and response body.
+        """
+        with self._lock:
+            self.requests += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if action == 'CreateStream':
+            return 200, {}
+        elif action == 'DescribeStream':
+            return 200, {'StreamDescription': {
+                'StreamName': body['StreamName'], 'StreamStatus': 'ACTIVE', 'Shards': [],
+                'HasMoreShards': False, 'StreamARN': 'arn:stub', 'RetentionPeriodHours': 24,
+                'StreamCreationTimestamp': 0, 'EnhancedMonitoring': []}}
+        elif action == 'PutRecord':
+            if not self._accept(body['Data']):
+                return 400, {'__type': THROTTLED, 'message': 'Rate exceeded'}
+            return 200, {'ShardId': 'shardId-000000000000', 'SequenceNumber': str(self.records)}
+        elif action == 'PutRecords':
+            results = []
+            for record in body['Records']:
+                if self._accept(record['Data']):
+                    results.append({'ShardId': 'shardId-000000000000', 'SequenceNumber': str(self.records)})
+                else:
+                    results.append({'ErrorCode': THROTTLED, 'ErrorMessage': 'Rate exceeded'})
+            failed = sum(1 for res in results if 'ErrorCode' in res)
+            return 200, {'FailedRecordCount': failed, 'Records': results}
+
+        return 400, {'__type': 'UnknownOperationException', 'message': action}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                action = self.headers['X-Amz-Target'].split('.')[-1]
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                status, response = stub.handle(action, body)
+                payload = json.dumps(response).encode('utf-8')
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/x-amz-json-1.1')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
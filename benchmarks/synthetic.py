@@ -0,0 +1,202 @@
+"""
+Synthetic replication streams, as the output plugins would send them.
+
+Rows cycle through a handful of column types, every table has an integer id
+primary key as its first column and changes are spread round robin over tables.
+"""
+from __future__ import division
+
+import json
+import struct
+from collections import namedtuple
+
+from pg2kinesis.slot import PrimaryKeyMapItem
+
+# Mirrors the attributes of psycopg2's ReplicationMessage that Consume uses.
+ReplicationMessage = namedtuple('ReplicationMessage', 'payload, data_size, data_start, cursor')
+
+# (wal2json type, test_decoding type)
+COLUMN_TYPES = [
+    ('int4', 'integer'),
+    ('varchar', 'character varying'),
+    ('timestamp', 'timestamp without time zone'),
+    ('numeric', 'numeric'),
+    ('text', 'text'),
+    ('bool', 'boolean'),
+]
+
+# wal2json type -> pg_type OID
+TYPE_OIDS = {'int4': 23, 'varchar': 1043, 'timestamp': 1114, 'numeric': 1700, 'text': 25, 'bool': 16}
+
+OPERATIONS = ['insert', 'update', 'update', 'delete']
+
+PLUGINS = ['test_decoding', 'wal2json', 'wal2json2', 'pgoutput']
+
+
+class NullCursor(object):
+    def send_feedback(self, **kwargs):
+        pass
+
+
+def table_name(i):
+    return 'public.bench_{}'.format(i)
+
+
+def primary_key_map(tables):
+    return dict((table_name(i), (PrimaryKeyMapItem(table_name(i), 'id', 'integer', 1),))
+                for i in range(tables))
+
+
+def make_row(row_id, columns):
+    """
+    :return: list of (name, wal2json type, test_decoding type, value), id first.
+    """
+    row = [('id', 'int4', 'integer', row_id)]
+    for i in range(columns - 1):
+        wal2json_type, test_decoding_type = COLUMN_TYPES[i % len(COLUMN_TYPES)]
+        if wal2json_type == 'int4':
+            value = row_id * 31 + i
+        elif wal2json_type == 'varchar':
+            value = 'value {} of row {}'.format(i, row_id)
+        elif wal2json_type == 'timestamp':
+            value = '2018-03-01 16:41:53.{:06}'.format(row_id % 1000000)
+        elif wal2json_type == 'numeric':
+            value = row_id + i / 100
+        elif wal2json_type == 'text':
+            value = "it's row {} of a wide table".format(row_id)
+        else:
+            value = bool(row_id % 2)
+        row.append(('c{}'.format(i), wal2json_type, test_decoding_type, value))
+    return row
+
+
+def test_decoding_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, (int, float)):
+        return str(value)
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def changes(transactions, rows_per_xact, columns, tables, hot_rows=None):
+    """
+    :param hot_rows: only change this many distinct rows, over and over, if given.
+    :return: generator of (xid, [(table, operation, row)]) per transaction.
+    """
+    row_id = 0
+    for xid in range(1000, 1000 + transactions):
+        xact = []
+        for _ in range(rows_per_xact):
+            xact.append((table_name(row_id % tables), OPERATIONS[row_id % len(OPERATIONS)],
+                         make_row(row_id % hot_rows if hot_rows else row_id, columns)))
+            row_id += 1
+        yield xid, xact
+
+
+def test_decoding_payloads(xid, xact):
+    yield 'BEGIN {}'.format(xid)
+    for table, operation, row in xact:
+        if operation == 'delete':
+            row = row[:1]
+        tuple_data = ' '.join('{}[{}]:{}'.format(name, td_type, test_decoding_value(value))
+                              for name, _, td_type, value in row)
+        yield 'table {}: {}: {}'.format(table, operation.upper(), tuple_data)
+    yield 'COMMIT {}'.format(xid)
+
+
+def wal2json_row(table, operation, row):
+    schema, name = table.split('.')
+    change = dict(kind=operation, schema=schema, table=name)
+    if operation == 'delete':
+        change['oldkeys'] = dict(keynames=['id'], keytypes=['int4'], keyvalues=[row[0][3]])
+    else:
+        change.update(columnnames=[col[0] for col in row], columntypes=[col[1] for col in row],
+                      columnvalues=[col[3] for col in row])
+    return change
+
+
+def wal2json_payloads(xid, xact):
+    yield json.dumps({'xid': xid, 'change': [wal2json_row(*change) for change in xact]})
+
+
+def wal2json2_payloads(xid, xact):
+    action = {'insert': 'I', 'update': 'U', 'delete': 'D'}
+    yield json.dumps({'action': 'B', 'xid': xid})
+    for table, operation, row in xact:
+        schema, name = table.split('.')
+        # As wal2json writes rows with include-xids, which pg2kinesis always sets.
+        change = dict(action=action[operation], xid=xid, schema=schema, table=name)
+        cols = [dict(name=col[0], type=col[1], value=col[3]) for col in row]
+        if operation == 'delete':
+            change['identity'] = cols[:1]
+        else:
+            change['columns'] = cols
+        yield json.dumps(change)
+    yield json.dumps({'action': 'C', 'xid': xid})
+
+
+def pgoutput_text(value):
+    if isinstance(value, bool):
+        return b't' if value else b'f'
+    return str(value).encode('utf-8')
+
+
+def pgoutput_tuple(values):
+    data = struct.pack('>H', len(values))
+    for value in values:
+        if value is None:
+            data += b'n'
+            continue
+        value = pgoutput_text(value)
+        data += b't' + struct.pack('>i', len(value)) + value
+    return data
+
+
+def pgoutput_relation(oid, table, row):
+    schema, name = table.split('.')
+    data = b'R' + struct.pack('>I', oid) + schema.encode('utf-8') + b'\0' + name.encode('utf-8') + b'\0d'
+    data += struct.pack('>H', len(row))
+    for col_name, wal2json_type, _, _ in row:
+        data += struct.pack('>b', col_name == 'id') + col_name.encode('utf-8') + b'\0'
+        data += struct.pack('>Ii', TYPE_OIDS[wal2json_type], -1)
+    return data
+
+
+def pgoutput_payloads(xid, xact, relations):
+    """
+    :param relations: OIDs of the tables whose Relation message was sent, updated.
+    """
+    yield b'B' + struct.pack('>QqI', 0, 0, xid)
+    for table, operation, row in xact:
+        oid = 16384 + int(table.rsplit('_', 1)[1])
+        if oid not in relations:
+            relations.add(oid)
+            yield pgoutput_relation(oid, table, row)
+
+        values = [col[3] for col in row]
+        if operation == 'delete':
+            # Only the key of the old row, the other columns are null.
+            yield b'D' + struct.pack('>I', oid) + b'K' + pgoutput_tuple(values[:1] + [None] * (len(values) - 1))
+        else:
+            yield operation[0].upper().encode('ascii') + struct.pack('>I', oid) + b'N' + pgoutput_tuple(values)
+    yield b'C' + struct.pack('>bQQq', 0, 0, 0, 0)
+
+
+def replication_stream(plugin, transactions, rows_per_xact, columns, tables, hot_rows=None):
+    """
+    :param plugin: one of PLUGINS, wal2json2 being wal2json with format-version 2.
+    :return: list of ReplicationMessage with bytes payloads and increasing LSNs.
+    """
+    if plugin == 'pgoutput':
+        relations = set()
+        payloads = lambda xid, xact: pgoutput_payloads(xid, xact, relations)
+    else:
+        payloads = globals()['{}_payloads'.format(plugin)]
+    cursor = NullCursor()
+    messages = []
+    for xid, xact in changes(transactions, rows_per_xact, columns, tables, hot_rows):
+        for payload in payloads(xid, xact):
+            if not isinstance(payload, bytes):
+                payload = payload.encode('utf-8')
+            messages.append(ReplicationMessage(payload, len(payload), (len(messages) + 1) * 100, cursor))
+    return messages
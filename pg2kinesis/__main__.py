@@ -1,16 +1,57 @@
 from __future__ import division
+import os
+import re
 import time
 
 import click
 
+from . import metrics
 from .slot import SlotReader
+from .spill import SpillDrainer, SpillLog
+from .compression import get_compressor
 from .formatter import get_formatter
-from .stream import StreamWriter
+from .grouping import TransactionGrouper
+from .json_codec import available_json_codecs, get_json_codec
+from .parallel import FormatterPool
+from .stream import AdaptiveFlushPolicy, FlushPolicy, KeyCoalescer, PipelinedStreamWriter, RoutingStreamWriter, \
+    StreamWriter
+from .tracker import LSNTracker
 from .log import logger
 
 
 SUPPORTED_OPERATIONS = ['update', 'insert', 'delete', 'truncate']
 
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def parse_stream_routes(ctx, param, value):
+    """
+    :return: list of (table pattern, stream name) from PATTERN=STREAM values.
+    """
+    routes = []
+    for route in value:
+        # Patterns may contain "=", stream names cannot.
+        pattern, sep, name = route.rpartition('=')
+        if not sep or not pattern or not name:
+            raise click.BadParameter('"{}" is not PATTERN=STREAM'.format(route))
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise click.BadParameter('"{}": {}'.format(pattern, e))
+        routes.append((pattern, name))
+    return routes
+
+
+def compression_ratio(stream_writers):
+    """
+    :return: bytes before compression per byte sent over all stream_writers, None
+             if nothing was compressed.
+    """
+    compressed = sum(writer.compressed_bytes for writer in stream_writers)
+    if not compressed:
+        return None
+    return sum(writer.uncompressed_bytes for writer in stream_writers) / compressed
+
 @click.command()
 @click.option('--pg-dbname', '-d', help='Database to connect to.')
 @click.option('--pg-host', '-h', default='',
@@ -21,13 +62,41 @@ SUPPORTED_OPERATIONS = ['update', 'insert', 'delete', 'truncate']
 @click.option('--pg-slot-name', '-s', default='pg2kinesis',
               help='Postgres replication slot name.')
 @click.option('--pg-slot-output-plugin', default='test_decoding',
-              type=click.Choice(['test_decoding', 'wal2json']),
+              type=click.Choice(['test_decoding', 'wal2json', 'pgoutput']),
               help='Postgres replication slot output plugin')
+@click.option('--pg-publication', default='pg2kinesis',
+              help='pgoutput: publication to stream. --create-slot creates it for all tables if it does not '
+                   'exist.')
+@click.option('--wal2json-format-version', default='1', type=click.Choice(['1', '2']),
+              help='wal2json output format. 2 emits one message per row rather than per transaction.')
+@click.option('--wal2json-actions', default=False, is_flag=True,
+              help='Have wal2json only send the --operations replicated. Requires wal2json 2.0+.')
+@click.option('--wal2json-add-tables',
+              help='wal2json add-tables option: only send changes of these tables, e.g. '
+                   '"public.*,audit.log".')
+@click.option('--wal2json-filter-tables',
+              help='wal2json filter-tables option: do not send changes of these tables.')
+@click.option('--wal2json-stream-threshold', default=16 * 1048576, type=int,
+              help='wal2json version 1 transactions larger than this many bytes are parsed incrementally.')
 @click.option('--stream-name', '-k', default='pg2kinesis',
               help='Kinesis stream name.')
+@click.option('--stream-route', multiple=True, metavar='PATTERN=STREAM', callback=parse_stream_routes,
+              help='Send tables whose schema qualified name matches the regular expression PATTERN to the '
+                   'Kinesis stream STREAM rather than --stream-name, repeatable, the first match wins. Every '
+                   'stream is sent to from its own thread.')
 @click.option('--message-formatter', '-f', default='CSVPayload',
-              type=click.Choice(['CSVPayload', 'CSV']),
-              help='Kinesis record formatter.')
+              type=click.Choice(['CSVPayload', 'CSV', 'MessagePack']),
+              help='Kinesis record formatter. MessagePack requires the msgpack package.')
+@click.option('--json-codec', default='auto', type=click.Choice(['auto'] + available_json_codecs()),
+              help='JSON library parsing wal2json and writing CSVPayload. auto picks the fastest installed.')
+@click.option('--format-workers', default=0, type=int,
+              help='Format in this many worker processes rather than on the replication thread.')
+@click.option('--format-batch-size', default=100, type=int,
+              help='Format workers: replication messages handed to a worker at a time.')
+@click.option('--group-transactions', default=False, is_flag=True,
+              help='Send the messages of each transaction as one record, split into parts of up to 1MB.')
+@click.option('--coalesce-keys', default=False, is_flag=True,
+              help='Only send the last change of a row put since the last send. Deletes are kept in order.')
 @click.option('--table-pat', help='Optional regular expression for table names.')
 @click.option('--full-change', default=False, is_flag=True,
               help='Emit all columns of a changed row.')
@@ -37,82 +106,346 @@ SUPPORTED_OPERATIONS = ['update', 'insert', 'delete', 'truncate']
               help='Deletes the slot on start if it exists and then creates.')
 @click.option('--operations', default='all', type=click.Choice(['all'] + SUPPORTED_OPERATIONS),
               multiple=True, help = 'Which operations to replicate to kinesis, Default: all')
+@click.option('--pipeline', default=False, is_flag=True,
+              help='Send to Kinesis from a background thread fed by a bounded queue.')
+@click.option('--max-queue-count', default=10000, type=int,
+              help='Pipeline mode: messages queued before replication is held back.')
+@click.option('--max-queue-bytes', default=64 * 1048576, type=int,
+              help='Pipeline mode: bytes queued before replication is held back.')
+@click.option('--put-records', default=False, is_flag=True,
+              help='Batch aggregated records into PutRecords requests.')
+@click.option('--linger-ms', default=13000, type=int,
+              help='Milliseconds to hold messages back to fill aggregates before sending them, 0 to only send '
+                   'full ones.')
+@click.option('--max-batch-bytes', type=int,
+              help='Send as soon as this many bytes are pending.')
+@click.option('--max-batch-records', type=int,
+              help='Send as soon as this many messages are pending.')
+@click.option('--adaptive-linger', default=False, is_flag=True,
+              help='Linger down to --min-linger-ms while traffic is too light to fill a batch within '
+                   '--linger-ms.')
+@click.option('--min-linger-ms', default=100, type=int,
+              help='Adaptive linger: milliseconds to linger at least.')
+@click.option('--spill-dir', type=click.Path(file_okay=False),
+              help='Append records to a log in this directory, rather than backing off, while Kinesis throttles '
+                   'or cannot be reached, and send them from there in the background. Survives restarts.')
+@click.option('--spill-segment-bytes', default=64 * 1048576, type=int,
+              help='Spill log: size of each of its files.')
+@click.option('--shard-count', default=1, type=int,
+              help='Shards to create the Kinesis stream with if it does not exist.')
+@click.option('--partition-by', default='xid', type=click.Choice(['xid', 'key']),
+              help='Partition records by transaction id or by table and primary key.')
+@click.option('--compression', default='none', type=click.Choice(['none', 'zstd', 'gzip']),
+              help='Compress records sent to Kinesis. zstd falls back to gzip if zstandard is not installed. '
+                   'Turns on --pipeline so compression runs on the sender thread.')
+@click.option('--compression-level', type=int, help='Codec specific compression level.')
+@click.option('--compress-records', default=False, is_flag=True,
+              help='Compress each user record rather than each aggregated record.')
+@click.option('--lag-sample-interval', default=10, type=int,
+              help='Seconds between samples of replication lag, 0 to turn off.')
+@click.option('--metrics-port', type=int,
+              help='Serve Prometheus metrics over HTTP on this port.')
 def main(pg_dbname, pg_host, pg_port, pg_user, pg_sslmode, pg_slot_name, pg_slot_output_plugin,
-         stream_name, message_formatter, table_pat, operations, full_change, create_slot, recreate_slot):
+         pg_publication, wal2json_format_version, wal2json_actions, wal2json_add_tables,
+         wal2json_filter_tables, wal2json_stream_threshold, stream_name, stream_route, message_formatter,
+         json_codec, format_workers, format_batch_size, group_transactions, coalesce_keys, table_pat,
+         operations, full_change, create_slot, recreate_slot, pipeline, max_queue_count, max_queue_bytes,
+         put_records, linger_ms, max_batch_bytes, max_batch_records, adaptive_linger, min_linger_ms,
+         spill_dir, spill_segment_bytes, shard_count, partition_by, compression, compression_level,
+         compress_records, lag_sample_interval, metrics_port):
+    wal2json_format_version = int(wal2json_format_version)
+    # The formatter only filters, and pays for it, when given operations.
+    format_operations = None
     if 'all' in operations:
         operations = SUPPORTED_OPERATIONS
+    else:
+        format_operations = operations
 
     if full_change:
-        assert message_formatter == 'CSVPayload', 'Full changes must be formatted as JSON.'
-        assert pg_slot_output_plugin == 'wal2json', 'Full changes must use wal2json.'
+        assert message_formatter in ('CSVPayload', 'MessagePack'), \
+            'Full changes must be formatted as JSON or MessagePack.'
+        assert pg_slot_output_plugin in ('wal2json', 'pgoutput'), 'Full changes must use wal2json or pgoutput.'
+    if group_transactions:
+        assert partition_by == 'xid', 'Transaction groups must be partitioned by xid.'
+    if coalesce_keys:
+        assert not full_change, 'Only changes of primary keys can be coalesced.'
+        assert not group_transactions, 'Transaction groups cannot be coalesced.'
+
+    plugin_options = {}
+    if pg_slot_output_plugin == 'wal2json':
+        # Filtered by postgres, never decoded, sent or parsed.
+        if wal2json_actions:
+            plugin_options['actions'] = ','.join(operations)
+        if wal2json_add_tables:
+            plugin_options['add-tables'] = wal2json_add_tables
+        if wal2json_filter_tables:
+            plugin_options['filter-tables'] = wal2json_filter_tables
 
     logger.info('Starting pg2kinesis replicating the following operations: %s', ','.join(operations))
     logger.info('Getting kinesis stream writer')
-    writer = StreamWriter(stream_name)
+    compressor = get_compressor(compression, compression_level) if compression != 'none' else None
+    linger = linger_ms / 1000 if linger_ms else None
+    if adaptive_linger:
+        flush_policy = AdaptiveFlushPolicy(linger, max_batch_bytes, max_batch_records, min_linger_ms / 1000)
+        shortest_linger = flush_policy.min_linger
+    else:
+        flush_policy = FlushPolicy(linger, max_batch_bytes, max_batch_records)
+        shortest_linger = linger
+    # How often the flush policy is checked without new messages.
+    tick_interval = min(1, shortest_linger or 1)
+
+    # Compressing on the replication thread would hold up keepalives, sending to
+    # several streams from it would have one throttle all of them.
+    pipeline = pipeline or compressor is not None or bool(stream_route)
+    tracker = LSNTracker()
+    # stream name -> StreamWriter, and the writer messages for it are put to.
+    stream_writers = {}
+    writers = {}
+    spill_logs = []
+    drainers = []
+    for name in [stream_name] + [name for _, name in stream_route]:
+        if name in writers:
+            continue
+        spill_log = SpillLog(os.path.join(spill_dir, name), spill_segment_bytes) if spill_dir else None
+        stream_writers[name] = writers[name] = StreamWriter(
+            name, batch=put_records, shard_count=shard_count, partition_by=partition_by, compressor=compressor,
+            compress_records=compress_records, flush_policy=flush_policy, tracker=tracker,
+            coalescer=KeyCoalescer() if coalesce_keys else None, spill_log=spill_log)
+        if spill_log is not None:
+            # Also sends what an earlier run left behind.
+            spill_logs.append(spill_log)
+            drainers.append(SpillDrainer(spill_log, stream_writers[name].put_record, tick_interval).start())
+        if pipeline:
+            writers[name] = PipelinedStreamWriter(stream_writers[name], max_queue_count, max_queue_bytes,
+                                                  poll_interval=tick_interval).start()
+
+    writer = writers[stream_name]
+    if stream_route:
+        writer = RoutingStreamWriter([(pattern, writers[name]) for pattern, name in stream_route], writer)
+
+    metrics.COMPRESSION_RATIO.set_function(lambda: compression_ratio(stream_writers.values()))
+    metrics.SPILL_BYTES.set_function(lambda: sum(spill_log.pending_bytes for spill_log in spill_logs))
+
+    metrics.IN_FLIGHT_BYTES.set_function(lambda: writer.pending_bytes)
+    metrics.RECEIVED_LSN.set_function(lambda: writer.tracker.received_lsn)
+    metrics.FLUSHED_LSN.set_function(lambda: writer.tracker.acked_lsn)
+    if metrics_port is not None:
+        metrics.start_http_server(metrics_port)
 
     with SlotReader(pg_dbname, pg_host, pg_port, pg_user, pg_sslmode, pg_slot_name,
-                    pg_slot_output_plugin) as reader:
+                    pg_slot_output_plugin, wal2json_format_version, plugin_options,
+                    pg_publication) as reader:
 
         if recreate_slot:
             reader.delete_slot()
             reader.create_slot()
         elif create_slot:
             reader.create_slot()
+        if (create_slot or recreate_slot) and pg_slot_output_plugin == 'pgoutput':
+            # Only publishes the operations replicated.
+            reader.create_publication(operations)
 
-        pk_map = reader.primary_key_map
+        # pgoutput sends primary keys along with the rows.
+        pk_map = reader.primary_key_map if pg_slot_output_plugin != 'pgoutput' else {}
+        if lag_sample_interval:
+            reader.start_lag_sampler(lag_sample_interval, lambda: writer.tracker.received_lsn)
         formatter = get_formatter(message_formatter, pk_map,
-                                  pg_slot_output_plugin, full_change, table_pat)
+                                  pg_slot_output_plugin, full_change, table_pat,
+                                  wal2json_format_version=wal2json_format_version,
+                                  stream_threshold=wal2json_stream_threshold,
+                                  primary_key_lookup=reader.table_primary_key,
+                                  json_codec=get_json_codec(json_codec),
+                                  operations=format_operations)
 
-        consume = Consume(formatter, writer, operations)
+        grouper = None
+        if group_transactions:
+            # A transaction routed to several streams is grouped once per stream.
+            grouper = TransactionGrouper(formatter, key=writer.writer_for if stream_route else None)
 
-        # Blocking. Responds to Control-C.
-        reader.process_replication_stream(consume)
+        if format_workers:
+            consume = ParallelConsume(FormatterPool(formatter, format_workers, format_batch_size),
+                                      writer, operations, grouper=grouper)
+        else:
+            consume = Consume(formatter, writer, operations, grouper=grouper)
+
+        try:
+            # Blocking. Responds to Control-C.
+            reader.process_replication_stream(consume, consume.tick, tick_interval)
+        finally:
+            try:
+                consume.close()
+            finally:
+                # Sends what is pending. Postgres does not hear of it, so it is resent on the next start.
+                writer.close()
+                # What is still spilled is sent on the next start.
+                for drainer in drainers:
+                    drainer.close()
+                for spill_log in spill_logs:
+                    spill_log.close()
 
 class Consume(object):
-    def __init__(self, formatter, writer, filter_operations):
-        self.cum_msg_count = 0
-        self.cum_msg_size = 0
-        self.msg_window_size = 0
-        self.msg_window_count = 0
-        self.cur_window = 0
+    def __init__(self, formatter, writer, filter_operations, feedback_interval=10, grouper=None):
+        """
+        :param feedback_interval: seconds between keepalive feedback messages sent
+                                  even if no more changes have been acknowledged.
+        :param grouper: optional grouping.TransactionGrouper the messages of every
+                        transaction are put through, to be put as groups.
+        """
+        self.flushed_lsn = None
+        self.last_feedback = 0
 
         self.formatter = formatter
         self.writer = writer
+        self.tracker = writer.tracker
         self.filter_operations = filter_operations
+        self.feedback_interval = feedback_interval
+        self.grouper = grouper
+        # (table, operation) -> message count and bytes metrics.
+        self._message_metrics = {}
 
     def should_send_to_kinesis(self, fmt_msg):
-        return fmt_msg.change.operation in self.filter_operations
+        # test_decoding spells operations in upper case.
+        return fmt_msg.change.operation.lower() in self.filter_operations
+
+    def send_feedback(self, cursor):
+        """
+        Reports the last received LSN as written and the last LSN the tracker has
+        seen acknowledged as flushed and applied. Sent whenever the latter moves and
+        at least every feedback_interval seconds so the primary can recycle WAL.
+        """
+        acked_lsn = self.tracker.acked_lsn
+        now = time.time()
+
+        if acked_lsn != self.flushed_lsn or now - self.last_feedback >= self.feedback_interval:
+            # psycopg2 treats 0 as "no change".
+            cursor.send_feedback(write_lsn=self.tracker.received_lsn or 0,
+                                 flush_lsn=acked_lsn or 0,
+                                 apply_lsn=acked_lsn or 0)
+            self.last_feedback = now
+
+            if acked_lsn != self.flushed_lsn:
+                self.flushed_lsn = acked_lsn
+                logger.info('Flushed LSN: {}'.format(acked_lsn))
+
+    def tick(self, cursor):
+        """
+        Called periodically while replicating, messages or not, so the writer
+        flushes once its send window has passed and feedback keeps flowing.
+        """
+        self.writer.put_message(None)
+        self.send_feedback(cursor)
+
+    def close(self):
+        pass
+
+    def count_message(self, fmt_msg):
+        key = (fmt_msg.change.table, fmt_msg.change.operation)
+        try:
+            count, size = self._message_metrics[key]
+        except KeyError:
+            count, size = self._message_metrics[key] = (metrics.MESSAGES.labels(*key),
+                                                        metrics.MESSAGE_BYTES.labels(*key))
+        count.value += 1
+        size.value += len(fmt_msg.fmt_msg)
 
     def __call__(self, change):
-        self.cum_msg_count += 1
-        self.cum_msg_size += change.data_size
+        metrics.REPLICATION_MESSAGES.inc()
+        metrics.REPLICATION_BYTES.inc(change.data_size)
 
-        self.msg_window_size += change.data_size
-        self.msg_window_count += 1
+        # The formatter may stream, so hold the LSN back until all of its messages
+        # have been put and released it below.
+        self.tracker.add(change.data_start)
 
+        # Streaming formatters do most of their work while being iterated, which
+        # this does not time.
+        start = timer()
         fmt_msgs = self.formatter(change.payload)
+        metrics.FORMAT_SECONDS.observe(timer() - start)
+
+        self.put_messages(change.data_start, fmt_msgs, self.ends_transaction(change.payload))
+        self.send_feedback(change.cursor)
+
+    def ends_transaction(self, payload):
+        # Only grouping needs to know.
+        return self.grouper is not None and self.formatter.ends_transaction(payload)
 
-        progress_msg = 'xid: {:12} win_count:{:>10} win_size:{:>10}mb cum_count:{:>10} cum_size:{:>10}mb'
+    def put_messages(self, lsn, fmt_msgs, commit=False):
+        """
+        Puts the messages formatted from the replication message at lsn, which the
+        tracker must hold, then releases lsn.
 
+        :param commit: whether the replication message ended a transaction.
+        """
         for fmt_msg in fmt_msgs:
             if not self.should_send_to_kinesis(fmt_msg):
-                fmt_msg = None
-
-            did_put = self.writer.put_message(fmt_msg)
-            if did_put:
-                change.cursor.send_feedback(flush_lsn=change.data_start)
-                logger.info('Flushed LSN: {}'.format(change.data_start))
-
-            int_time = int(time.time())
-            if not int_time % 10 and int_time != self.cur_window:
-                logger.info(progress_msg.format(
-                    self.formatter.cur_xact, self.msg_window_count,
-                    self.msg_window_size / 1048576, self.cum_msg_count,
-                    self.cum_msg_size / 1048576))
-
-                self.cur_window = int_time
-                self.msg_window_size = 0
-                self.msg_window_count = 0
+                # The tick gives the writer its chance to flush on its send window.
+                continue
+            if self.grouper is not None:
+                # Held by the tracker until the group packing it is delivered.
+                self.tracker.add(lsn)
+                self.count_message(fmt_msg)
+                self.put_groups(self.grouper.add(fmt_msg, lsn))
+            else:
+                self.tracker.add(lsn)
+                self.writer.put_message(fmt_msg, lsn)
+                self.count_message(fmt_msg)
+
+        if commit:
+            self.put_groups(self.grouper.commit())
+        self.tracker.ack([lsn])
+
+    def put_groups(self, groups):
+        for group_msg, lsns in groups:
+            self.writer.put_message(group_msg, lsns)
+
+
+class ParallelConsume(Consume):
+    """
+    Consume formatting in a parallel.FormatterPool. Replication messages count as
+    received, and their messages are put, in the order they were read once
+    formatted, possibly on a later call or tick.
+    """
+    def __init__(self, pool, writer, filter_operations, feedback_interval=10, grouper=None):
+        super(ParallelConsume, self).__init__(pool.formatter, writer, filter_operations, feedback_interval,
+                                              grouper)
+        self.pool = pool
+        # LSNs of the replication messages being formatted that end a transaction.
+        self._commit_lsns = set()
+
+    def put_results(self, block=False):
+        for lsn, fmt_msgs in self.pool.results(block):
+            # Only now, as the tracker needs LSNs in order.
+            self.tracker.add(lsn)
+            commit = lsn in self._commit_lsns
+            if commit:
+                self._commit_lsns.discard(lsn)
+            self.put_messages(lsn, fmt_msgs, commit)
+
+    def tick(self, cursor):
+        self.pool.submit()
+        self.put_results()
+        super(ParallelConsume, self).tick(cursor)
+
+    def close(self):
+        """
+        Puts everything still being formatted, then stops the pool.
+        """
+        try:
+            self.pool.submit()
+            self.put_results(block=True)
+        finally:
+            self.pool.close()
+
+    def __call__(self, change):
+        metrics.REPLICATION_MESSAGES.inc()
+        metrics.REPLICATION_BYTES.inc(change.data_size)
+
+        if self.ends_transaction(change.payload):
+            self._commit_lsns.add(change.data_start)
+        self.pool.put(change.payload, change.data_start)
+
+        self.put_results()
+        self.send_feedback(change.cursor)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,86 @@
+"""
+Compression of the data sent to Kinesis, either whole aggregated records or each
+user record in them.
+
+Compressed data starts with HEADER_MAGIC and a byte naming the codec, so
+consumers can tell it apart from uncompressed records: 0xFE never starts text,
+MessagePack arrays or KPL aggregated records. decompress undoes compress.
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .log import logger
+
+HEADER_MAGIC = b'\xfePGK'
+
+
+class GzipCompressor(object):
+    name = 'gzip'
+    codec_id = b'g'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        # wbits 31: gzip container rather than a bare zlib stream.
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return HEADER_MAGIC + self.codec_id + compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def decompress(data):
+        return zlib.decompress(data, 31)
+
+
+class ZstdCompressor(object):
+    """
+    Requires the zstandard package.
+    """
+    name = 'zstd'
+    codec_id = b'z'
+
+    def __init__(self, level=3):
+        self.level = level
+        self._compressor = zstandard.ZstdCompressor(level=level)
+
+    def compress(self, data):
+        return HEADER_MAGIC + self.codec_id + self._compressor.compress(data)
+
+    @staticmethod
+    def decompress(data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+COMPRESSORS = {GzipCompressor.codec_id: GzipCompressor, ZstdCompressor.codec_id: ZstdCompressor}
+
+
+def get_compressor(name, level=None):
+    """
+    :param name: 'zstd', falling back to 'gzip' if zstandard is not installed, or 'gzip'.
+    :param level: codec specific compression level, its default if None.
+    :return: a compressor instance.
+    """
+    if name == 'zstd' and zstandard is None:
+        logger.warning('zstandard is not installed, compressing with gzip instead')
+        name = 'gzip'
+
+    for compressor in COMPRESSORS.values():
+        if compressor.name == name:
+            return compressor() if level is None else compressor(level)
+
+    raise ValueError('Unknown compression "{}"'.format(name))
+
+
+def decompress(data):
+    """
+    :param data: a Kinesis record or user record.
+    :return: data decompressed if it carries a compression header, else as is.
+    """
+    header_size = len(HEADER_MAGIC) + 1
+    if data[:len(HEADER_MAGIC)] != HEADER_MAGIC:
+        return data
+
+    return COMPRESSORS[data[len(HEADER_MAGIC):header_size]].decompress(data[header_size:])
@@ -1,46 +1,298 @@
 from __future__ import unicode_literals
 
+import hashlib
 import json
+import numbers
 import re
 import sys
 
+from . import pgoutput
+from .json_codec import get_json_codec
 from .log import logger
 
 from collections import namedtuple
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from operator import itemgetter
+
 # Tuples representing changes as pulled from database
 Change = namedtuple('Change', 'xid, table, operation, pkey')
 FullChange = namedtuple('FullChange', 'xid, change')
 FullChange.operation = property(lambda self: self.change.get('kind'))
+FullChange.table = property(lambda self: '{}.{}'.format(self.change.get('schema'), self.change.get('table')))
 
 # Final product of Formatter, a Change and the Change formatted.
+# Change.pkey is a string, or a list of strings for composite primary keys.
 Message = namedtuple('Message', 'change, fmt_msg')
 
-COL_TYPE_VALUE_TEMPLATE_PAT = r"{col_name}\[{col_type}\]:'?([\w\-]+)'?"
+# Change of a Message packing count messages of transaction xid, see
+# Formatter.group_message. table is the table of the first of them.
+TransactionGroup = namedtuple('TransactionGroup', 'xid, table, part, final, count')
+
 MISSING_TABLE_ERR = 'Unable to locate table: "{}"'
 MISSING_PK_ERR = 'Unable to locate primary key for table "{}"'
 
+# wal2json format-version 2 row actions.
+WAL2JSON_V2_KINDS = {'I': 'insert', 'U': 'update', 'D': 'delete'}
+
+# test_decoding tuples are space separated name[type]:value columns. Names may be
+# double quoted identifiers, types may contain spaces and brackets and values are
+# bare or single quoted with embedded quotes doubled:
+#   id[integer]:1 "Full Name"[character varying]:'O''Brien jr' tags[text[]]:'{a,b}'
+TD_TYPE_PAT = r'\[[^\]]*(?:\](?!:)[^\]]*)*\]:'
+TD_VALUE_PAT = r"(?:([^'\s]\S*|(?=\s|$))|'([^']*(?:''[^']*)*)')"
+# Any column, or a label such as "old-key:" or "(no-tuple-data)".
+TD_TOKEN_PAT = r"""(?:(?:[^\s\["]+|"[^"]*(?:""[^"]*)*")""" + TD_TYPE_PAT + \
+               r"(?:[^'\s]\S*|'[^']*(?:''[^']*)*'|(?=\s|$))|[^\s\[]+)"
+
+# Column names test_decoding prints without double quotes.
+TD_BARE_NAME_RE = re.compile(r'[a-z_][a-z0-9_]*\Z')
+
+JSON_DECODER = json.JSONDecoder()
+JSON_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+WAL2JSON_XID_RE = re.compile(r'"xid"\s*:\s*(\d+)')
+WAL2JSON_CHANGE_RE = re.compile(r'"change"\s*:\s*\[')
+# Bytes of a streamed wal2json payload decoded at a time, grown for larger rows.
+WAL2JSON_STREAM_WINDOW = 1048576
+# How wal2json format-version 2 starts rows, up to a table name without escapes.
+# Options such as include-xids, include-timestamp and include-lsn add scalar
+# fields between the action and the schema.
+WAL2JSON_V2_ROW_RE = re.compile(br'\{\s*"action"\s*:\s*"([IUD])"\s*,'
+                                br'(?:\s*"\w+"\s*:\s*(?:"[^"\\]*"|[\w.+-]+)\s*,)*'
+                                br'\s*"schema"\s*:\s*"[^"\\]*"\s*,\s*"table"\s*:\s*"([^"\\]*)"')
+
+
+def compile_test_decoding_key_pattern(col_names):
+    """
+    Builds the pattern extracting the values of col_names from the tuple part of
+    a test_decoding change. It tokenizes whole columns from the start of the tuple
+    in a single pass and stops once the last of col_names has been found, so unlike
+    a plain search it is never fooled by text inside an earlier quoted value.
+
+    :param col_names: names of the columns, unquoted, in the order they appear in
+                      the table.
+    :return: compiled pattern, the value of the n-th column is read with
+             read_test_decoding_value(mat, 2 * n + 1).
+    """
+    pat = r'\s*(?:' + TD_TOKEN_PAT + r'\s+)*?'
+    for i, col_name in enumerate(col_names):
+        if i:
+            pat += r'(?:\s+' + TD_TOKEN_PAT + r')*?\s+'
+        pat += '(?:{}|"{}")'.format(re.escape(col_name), re.escape(col_name.replace('"', '""')))
+        pat += TD_TYPE_PAT + TD_VALUE_PAT
+
+    return re.compile(pat)
+
+
+class TupleKeyReader(object):
+    """
+    Reads the values of a table's primary key columns from the tuple part of its
+    test_decoding changes.
+
+    Each column is first found with a search for its name[type]:value at the start
+    of a token, which is confirmed to be outside a quoted value by the quotes just
+    before it, or if those are not conclusive by an even count of quotes before
+    it. The search starts with the literal name[type]: so the regex engine can skip
+    straight to it. Names Postgres may quote are also searched double quoted and,
+    should the type have changed, with any type. Only when that fails,
+    e.g. because key-like text appears in an earlier value, is the tuple tokenized
+    from the start with compile_test_decoding_key_pattern. A double quoted column
+    name holding single quotes and key-like text before the key could fool the
+    search.
+    """
+    def __init__(self, col_names, col_types=None):
+        """
+        :param col_names: names of the columns, unquoted, in the order they appear in
+                          the table.
+        :param col_types: types of the columns as test_decoding prints them, if known.
+        """
+        self.col_names = col_names
+        col_types = col_types or [None] * len(col_names)
+        self._searches = [self._compile_searches(col_name, col_type)
+                          for col_name, col_type in zip(col_names, col_types)]
+        self._single_search = self._searches[0][0] if len(col_names) == 1 else None
+        self._tokenizer = None
+
+    @staticmethod
+    def _compile_searches(col_name, col_type):
+        """
+        :return: list of search functions to try in turn for the column.
+        """
+        names = ['"' + col_name.replace('"', '""') + '"']
+        if TD_BARE_NAME_RE.match(col_name):
+            # Reserved words are quoted too, so the bare name is only tried first.
+            names.insert(0, col_name)
+
+        # Literal text the match starts with, then the rest of the pattern. The type
+        # only goes stale with DDL, so both typed searches go first.
+        parts = [(name + '[', TD_TYPE_PAT[2:] + TD_VALUE_PAT) for name in names]
+        if col_type:
+            parts = [(name + '[' + col_type + ']:', TD_VALUE_PAT) for name in names] + parts
+        return [re.compile(re.escape(literal) + r'(?<!\S' + re.escape(literal) + ')' + rest).search
+                for literal, rest in parts]
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = compile_test_decoding_key_pattern(self.col_names)
+        return self._tokenizer
+
+    def __call__(self, data):
+        """
+        :return: list of the key values, or None if data lacks a key column.
+        """
+        search = self._single_search
+        if search is not None:
+            # Most keys are a single column found by its first search after no
+            # quote, or after one that is neither doubled nor follows ":" so must
+            # close a value. Those are spared the loop and the calls.
+            mat = search(data)
+            if mat is not None:
+                last = data.rfind("'", 0, mat.start())
+                if last == -1 or data[last - 1] not in "':":
+                    value, quoted = mat.groups()
+                    return [quoted.replace("''", "'") if value is None else value]
+
+        values = []
+        pos = 0
+        for searches in self._searches:
+            mat = self._search(searches, data, pos)
+            if mat is None:
+                return self._tokenize(data)
+            value = mat.group(1)
+            values.append(value if value is not None else mat.group(2).replace("''", "'"))
+            pos = mat.end()
+        return values
+
+    def _search(self, searches, data, pos):
+        """
+        :return: match of the first of searches found outside quoted values after
+                 pos, or None.
+        """
+        for search in searches:
+            mat = search(data, pos)
+            if mat is not None:
+                return mat if self._outside_quotes(data, pos, mat.start()) else None
+        return None
+
+    @staticmethod
+    def _outside_quotes(data, pos, start):
+        """
+        :param pos: offset outside quoted values before start.
+        :return: whether start is outside quoted values too.
+        """
+        last = data.rfind("'", pos, start)
+        if last == -1:
+            return True
+
+        # Quotes are doubled inside values, and values are opened after "]:". So a
+        # run of quotes not following "]:" holds no opener, and an odd run ends
+        # with the value's closing quote.
+        first = last
+        while first > pos and data[first - 1] == "'":
+            first -= 1
+        if first - 2 >= pos and data[first - 2:first] != ']:':
+            return (last - first) % 2 == 0
+
+        return data.count("'", pos, start) % 2 == 0
+
+    def _tokenize(self, data):
+        mat = self.tokenizer.match(data)
+        return mat and [read_test_decoding_value(mat, group) for group in range(1, mat.re.groups, 2)]
+
+
+def read_test_decoding_value(mat, group=1):
+    """
+    :return: the value captured by TD_VALUE_PAT starting at group, unquoted.
+    """
+    value = mat.group(group)
+    if value is None:
+        value = mat.group(group + 1).replace("''", "'")
+    return value
+
+
 class Formatter(object):
     VERSION = 0
     TYPE = 'CDC'
+    GROUP_TYPE = 'TXN'
     IGNORED_CHANGES = {'COMMIT'}
 
     def __init__(self, primary_key_map, output_plugin='test_decoding',
-                 full_change=False, table_pat=None):
+                 full_change=False, table_pat=None, wal2json_format_version=1,
+                 stream_threshold=None, primary_key_lookup=None, json_codec=None, operations=None):
+        """
+        :param stream_threshold: wal2json version 1 payloads longer than this are
+                                 parsed one change at a time, see _iter_wal2json_changes.
+        :param primary_key_lookup: optional callable taking a schema qualified table
+                                   name and returning its primary_key_map entry, or
+                                   None if there is no such table. See _refresh_primary_key.
+        :param json_codec: codec from json_codec parsing wal2json payloads and, for
+                           formatters writing JSON, encoding messages. The fastest
+                           installed if None.
+        :param operations: names of the operations to format, e.g. ['insert'], all
+                           if None. Rows of other operations are dropped before
+                           their key is extracted or, where possible, before they
+                           are parsed at all.
+        """
 
         self._primary_key_patterns = {}
+        # (table, layout) -> positions of the primary key columns, see _key_positions.
+        self._key_positions_cache = {}
         self.output_plugin = output_plugin
-        self.primary_key_map = primary_key_map
+        self.wal2json_format_version = wal2json_format_version
+        self.stream_threshold = stream_threshold
+        self.primary_key_map = {}
+        self.primary_key_lookup = primary_key_lookup
+        self.json_codec = json_codec or get_json_codec()
         self.full_change = full_change
-        self.table_pat = table_pat if table_pat is not None else r'[\w_\.]+'
-        self.table_re = re.compile(self.table_pat)
+        # Kept as given, so copies made e.g. by FormatterPool only filter if this does.
+        self.table_pat = table_pat
+        self.table_re = re.compile(table_pat if table_pat is not None else r'[\w_\.]+')
+        self.operations = frozenset(op.lower() for op in operations) if operations is not None else None
+        # Whether any row may be dropped, see _skip_wal2json_v2_row.
+        self._filtering = operations is not None or table_pat is not None
         self.cur_xact = ''
+        # pgoutput: relation OID -> (Relation, schema qualified name, key positions).
+        self._relations = {}
+        # pgoutput: type OID -> name, for types that are not built in.
+        self._type_names = {}
 
         for k, v in getattr(primary_key_map, 'iteritems', primary_key_map.items)():
-            # ":" added to make later look up not need to trim trailing ":".
-            self._primary_key_patterns[k + ":"] = re.compile(
-                COL_TYPE_VALUE_TEMPLATE_PAT.format(col_name=v.col_name, col_type=v.col_type)
-            )
+            self._set_primary_key(k, v)
+
+    def _set_primary_key(self, table, primary_key):
+        self.primary_key_map[table] = primary_key
+        # ":" added to make later look up not need to trim trailing ":".
+        # Tables without a primary key get None.
+        self._primary_key_patterns[table + ":"] = primary_key and TupleKeyReader(
+            [item.col_name for item in primary_key], [item.col_type for item in primary_key])
+
+        for cache_key in [k for k in self._key_positions_cache if k[0] == table]:
+            del self._key_positions_cache[cache_key]
+
+    def _refresh_primary_key(self, table):
+        """
+        Looks table's primary key up again. Called when a table is missing from
+        primary_key_map or one of its rows does not carry its key, which is how
+        DDL shows up in the stream, so tables created or altered while running
+        cost one small query instead of a crash.
+
+        :return: True if table's entry was added or changed.
+        """
+        if self.primary_key_lookup is None:
+            return False
+
+        primary_key = self.primary_key_lookup(table)
+        if primary_key is None or primary_key == self.primary_key_map.get(table):
+            return False
+
+        logger.info('Primary key of {} is now: {}'.format(
+            table, ', '.join(item.col_name for item in primary_key) or 'none'))
+        self._set_primary_key(table, primary_key)
+        return True
 
     def _preprocess_test_decoding_change(self, change):
         """
@@ -48,7 +300,7 @@ class Formatter(object):
         into a Change tuple currently only looking for primary key.
 
         They look like this:
-            "table table_test: UPDATE: uuid[uuid]:'00079f3e-0479-4475-acff-4f225cc5188a' another_col[text]'bling'"
+            "table table_test: UPDATE: uuid[uuid]:'00079f3e-0479-4475-acff-4f225cc5188a' another_col[text]:'bling'"
 
         :param change: a message payload from postgres' test_decoding plugin.
         :return: A list of type Change
@@ -63,16 +315,19 @@ class Formatter(object):
         elif rec[0] == 'table':
             table_name = rec[1][:-1]
 
-            if self.table_re.search(table_name):
-                try:
-                    mat = self._primary_key_patterns[rec[1]].search(rec[3])
-                except KeyError:
+            if self._wants_operation(rec[2][:-1]) and self.table_re.search(table_name):
+                if rec[1] not in self._primary_key_patterns and not self._refresh_primary_key(table_name):
                     self._log_and_raise(MISSING_TABLE_ERR.format(rec[1]))
                 else:
-                    if mat:
-                        pkey = mat.groups()[0]
+                    reader = self._primary_key_patterns[rec[1]]
+                    pkey = reader and reader(rec[3])
+                    if not pkey and self._refresh_primary_key(table_name):
+                        reader = self._primary_key_patterns[rec[1]]
+                        pkey = reader and reader(rec[3])
+
+                    if pkey:
                         return [Change(xid=self.cur_xact, table=table_name,
-                                       operation=rec[2][:-1], pkey=pkey)]
+                                       operation=rec[2][:-1], pkey=self._pkey(pkey))]
                     else:
                         self._log_and_raise(MISSING_PK_ERR.format(table_name))
         else:
@@ -100,10 +355,14 @@ class Formatter(object):
                 ]
             }
         :param change: a message payload from postgres wal2json plugin.
-        :return: A list of type Change or FullChange
+        :return: A list of type Change or FullChange, or a generator of them if the
+                 payload is longer than stream_threshold.
         """
 
-        change_dictionary = json.loads(change)
+        if self.stream_threshold and len(change) > self.stream_threshold:
+            return self._iter_wal2json_changes(change)
+
+        change_dictionary = self.json_codec.loads(change)
         if not change_dictionary:
             return []
 
@@ -111,25 +370,410 @@ class Formatter(object):
         changes = []
 
         for change in change_dictionary['change']:
-            table_name = change['table']
-            schema = change['schema']
-            if self.table_re.search(table_name):
-                if self.full_change:
-                    changes.append(FullChange(xid=self.cur_xact, change=change))
+            pp_change = self._wal2json_row(change)
+            if pp_change is not None:
+                changes.append(pp_change)
+        return changes
+
+    def _iter_wal2json_changes(self, change):
+        """
+        Streaming counterpart of _preprocess_wal2json_change for very large
+        transactions. Elements of the "change" array are decoded and yielded one at
+        a time, so the whole transaction is never held as python objects and its
+        first rows can be sent before the rest has been parsed. A payload in bytes
+        is decoded to text a window of WAL2JSON_STREAM_WINDOW bytes at a time
+        rather than copied whole.
+
+        :param change: a message payload from postgres wal2json plugin.
+        :return: A generator of type Change or FullChange
+        """
+        binary = isinstance(change, bytes) and not isinstance(change, str)
+        size = WAL2JSON_STREAM_WINDOW if binary else len(change)
+        # Byte offsets of the window in change, text is the window decoded.
+        start = 0
+        text, end = self._decode_window(change, start, size) if binary else (change, len(change))
+
+        array_mat = WAL2JSON_CHANGE_RE.search(text)
+        while not array_mat and end < len(change):
+            size *= 2
+            text, end = self._decode_window(change, start, size)
+            array_mat = WAL2JSON_CHANGE_RE.search(text)
+        if not array_mat:
+            self._log_and_raise('Unknown change: "{}"'.format(text[:256]))
+            return
+
+        # wal2json writes the xid ahead of the change array.
+        xid_mat = WAL2JSON_XID_RE.search(text, 0, array_mat.start())
+        if xid_mat:
+            self.cur_xact = int(xid_mat.group(1))
+
+        pos = JSON_WHITESPACE_RE.match(text, array_mat.end()).end()
+        # Whether the window was just moved to pos.
+        moved = False
+        while True:
+            try:
+                if text[pos] == ']':
+                    break
+                row, next_pos = JSON_DECODER.raw_decode(text, pos)
+                next_pos = JSON_WHITESPACE_RE.match(text, next_pos).end()
+                if text[next_pos] == ',':
+                    next_pos = JSON_WHITESPACE_RE.match(text, next_pos + 1).end()
+            except (ValueError, IndexError):
+                if end >= len(change):
+                    raise
+                # The window ends inside the row or right after it: move the window
+                # to start at the row, growing it if the row did not fit.
+                if moved:
+                    size *= 2
+                start += len(text[:pos].encode('utf-8'))
+                text, end = self._decode_window(change, start, size)
+                pos = JSON_WHITESPACE_RE.match(text).end()
+                moved = True
+                continue
+
+            moved = False
+            pp_change = self._wal2json_row(row)
+            if pp_change is not None:
+                yield pp_change
+            pos = next_pos
+
+    @staticmethod
+    def _decode_window(data, start, size):
+        """
+        :return: tuple of up to size bytes of data from start decoded, ending on a
+                 whole character, and the offset they end at.
+        """
+        end = min(start + size, len(data))
+        # Back off continuation bytes of a character the window would split.
+        while end < len(data) and ord(data[end:end + 1]) & 0xC0 == 0x80:
+            end -= 1
+        return data[start:end].decode('utf-8'), end
+
+    def _wal2json_row(self, change):
+        """
+        :param change: an element of a wal2json version 1 "change" array.
+        :return: a Change or FullChange, or None if its table is filtered out.
+        """
+        table_name = change['table']
+        schema = change['schema']
+        if self._wants_operation(change['kind']) and self.table_re.search(table_name):
+            if self.full_change:
+                return FullChange(xid=self.cur_xact, change=change)
+            else:
+                full_table = '{}.{}'.format(schema, table_name)
+                if full_table not in self.primary_key_map and not self._refresh_primary_key(full_table):
+                    self._log_and_raise(MISSING_TABLE_ERR.format(full_table))
                 else:
-                    try:
-                        full_table = '{}.{}'.format(schema, table_name)
-                        primary_key = self.primary_key_map[full_table]
-                    except KeyError:
-                        self._log_and_raise(MISSING_TABLE_ERR.format(full_table))
+                    if 'columnnames' in change:
+                        names, values, layout = change['columnnames'], change['columnvalues'], 'columns'
                     else:
-                        value_index = change['columnnames'].index(primary_key.col_name)
-                        pkey = str(change['columnvalues'][value_index])
-                        changes.append(Change(xid=self.cur_xact,
-                                              table=full_table,
-                                              operation=change['kind'].lower(),
-                                              pkey=pkey))
-        return changes
+                        # Deletes only carry the old key.
+                        oldkeys = change.get('oldkeys', {})
+                        names, values, layout = oldkeys.get('keynames', []), oldkeys.get('keyvalues'), 'oldkeys'
+
+                    positions = self._key_positions(full_table, layout, self.primary_key_map[full_table], names)
+                    if positions is None and self._refresh_primary_key(full_table):
+                        positions = self._key_positions(full_table, layout, self.primary_key_map[full_table], names)
+
+                    if positions is None:
+                        self._log_and_raise(MISSING_PK_ERR.format(full_table))
+                    else:
+                        return Change(xid=self.cur_xact,
+                                      table=full_table,
+                                      operation=change['kind'].lower(),
+                                      pkey=self._pkey([str(values[i]) for i in positions]))
+        return None
+
+    def _wants_operation(self, operation):
+        # test_decoding spells operations in upper case.
+        return self.operations is None or operation.lower() in self.operations
+
+    def _key_positions(self, table, layout, primary_key, columns, name_of=None):
+        """
+        Finds where the primary key columns are in a row. Positions are cached per
+        table and row layout and only checked against the key's column names on
+        later rows, so this costs O(key columns) rather than O(row width) unless
+        the table's columns changed.
+
+        :param layout: distinguishes differently shaped rows of the same table.
+        :param primary_key: the table's entry of primary_key_map.
+        :param columns: the row's column names, or columns passed through name_of.
+        :return: list of positions in key order, or None if the key is not all there.
+        """
+        if not primary_key:
+            return None
+
+        name_of = name_of or (lambda col: col)
+        cache_key = (table, layout, len(columns))
+        positions = self._key_positions_cache.get(cache_key)
+
+        if positions is not None:
+            for position, item in zip(positions, primary_key):
+                if name_of(columns[position]) != item.col_name:
+                    positions = None
+                    break
+
+        if positions is None:
+            index = dict((name_of(col), i) for i, col in enumerate(columns))
+            try:
+                positions = [index[item.col_name] for item in primary_key]
+            except KeyError:
+                return None
+            self._key_positions_cache[cache_key] = positions
+
+        return positions
+
+    @staticmethod
+    def _pkey(values):
+        # Single column keys stay plain strings.
+        return values[0] if len(values) == 1 else values
+
+    def _preprocess_wal2json_v2_change(self, change):
+        """
+        Takes a message payload from the wal2json plugin with format-version 2 and
+        distills it into a list of at most one Change or FullChange tuple. Unlike
+        version 1 every row is its own message, so memory is bounded by row size
+        rather than transaction size.
+
+        They look like this:
+            {"action": "B", "xid": 1234567890}
+            {
+                "action": "I",
+                "schema": "public",
+                "table": "some_table",
+                "columns": [{"name": "id", "type": "integer", "value": 42}]
+            }
+            {"action": "D", "schema": "public", "table": "some_table",
+             "identity": [{"name": "id", "type": "integer", "value": 42}]}
+            {"action": "C", "xid": 1234567890}
+
+        Rows are reshaped to the version 1 layout so full changes look the same
+        whichever format version produced them. Truncates and logical messages are
+        ignored as they are with version 1.
+
+        :param change: a message payload from postgres wal2json plugin.
+        :return: A list of type Change or FullChange
+        """
+
+        if self._filtering and self._skip_wal2json_v2_row(change):
+            return []
+
+        change = self.json_codec.loads(change)
+        action = change['action']
+
+        if action == 'B':
+            self.cur_xact = change.get('xid', self.cur_xact)
+        elif action in ('C', 'T', 'M'):
+            pass
+        elif action in WAL2JSON_V2_KINDS:
+            if self._wants_operation(WAL2JSON_V2_KINDS[action]) and self.table_re.search(change['table']):
+                return self._wal2json_v2_row(change, WAL2JSON_V2_KINDS[action])
+        else:
+            self._log_and_raise('Unknown change: "{}"'.format(action))
+
+        return []
+
+    def _skip_wal2json_v2_row(self, change):
+        """
+        :param change: a message payload from postgres wal2json plugin.
+        :return: True if change is a row of an operation or table that is not
+                 wanted, judged from its first bytes without parsing it.
+        """
+        mat = isinstance(change, bytes) and WAL2JSON_V2_ROW_RE.match(change)
+        if not mat:
+            return False
+
+        return not (self._wants_operation(WAL2JSON_V2_KINDS[mat.group(1).decode('ascii')]) and
+                    self.table_re.search(mat.group(2).decode('utf-8')))
+
+    def _preprocess_pgoutput_change(self, change):
+        """
+        Takes a pgoutput message and distills it into a list of at most one Change
+        or FullChange tuple. Relation and Type messages are cached, rows are only
+        decoded once their operation and table are known to be wanted.
+
+        The primary key is the relation's replica identity as flagged in its
+        Relation message, so primary_key_map is not used. Full changes have the
+        version 1 wal2json layout with values as postgres prints them and type
+        names from pg_type. Like wal2json, they leave out TOASTed values an update
+        did not change. Truncates are ignored as they are with wal2json.
+
+        :param change: a pgoutput message as bytes, see pgoutput.
+        :return: A list of type Change or FullChange
+        """
+        operation = pgoutput.ROW_TAGS.get(change[:1])
+        if operation is None:
+            msg = pgoutput.decode(change)
+            if isinstance(msg, pgoutput.Begin):
+                self.cur_xact = msg.xid
+            elif isinstance(msg, pgoutput.Relation):
+                self._set_relation(msg)
+            elif isinstance(msg, pgoutput.Type):
+                self._type_names[msg.oid] = msg.name
+            return []
+
+        oid = pgoutput.relation_oid(change)
+        if oid not in self._relations:
+            self._log_and_raise('Unknown relation: {}'.format(oid))
+            return []
+
+        relation, table, positions = self._relations[oid]
+        if not (self._wants_operation(operation) and self.table_re.search(relation.name)):
+            return []
+
+        msg = pgoutput.decode(change)
+        if self.full_change:
+            return [FullChange(xid=self.cur_xact, change=self._pgoutput_row(operation, msg))]
+
+        values = msg.old if operation == 'delete' else msg.new
+        key = [values[i] for i in positions]
+        if not key or any(value is None or value is pgoutput.UNCHANGED_TOAST for value in key):
+            self._log_and_raise(MISSING_PK_ERR.format(table))
+            return []
+
+        return [Change(xid=self.cur_xact, table=table, operation=operation,
+                       pkey=self._pkey([value.decode('utf-8') for value in key]))]
+
+    def _set_relation(self, relation):
+        table = '{}.{}'.format(relation.namespace, relation.name)
+        positions = [i for i, col in enumerate(relation.columns) if col.flags & pgoutput.KEY_COLUMN]
+        self._relations[relation.oid] = (relation, table, positions)
+
+    def _pgoutput_row(self, operation, msg):
+        """
+        :return: msg as an element of a wal2json version 1 "change" array.
+        """
+        relation, _, positions = self._relations[msg.oid]
+        row = dict(kind=operation, schema=relation.namespace, table=relation.name)
+
+        def value(data):
+            return data if data is None else data.decode('utf-8')
+
+        def type_name(col):
+            return pgoutput.BUILTIN_TYPES.get(col.type_oid) or self._type_names.get(col.type_oid, str(col.type_oid))
+
+        if operation != 'delete':
+            cols = [(col, data) for col, data in zip(relation.columns, msg.new) if data is not pgoutput.UNCHANGED_TOAST]
+            row.update(columnnames=[col.name for col, _ in cols],
+                       columntypes=[type_name(col) for col, _ in cols],
+                       columnvalues=[value(data) for _, data in cols])
+
+        if operation != 'insert':
+            # Updates only carry the old key if it changed.
+            old = msg.old if msg.old is not None else msg.new
+            keys = [relation.columns[i] for i in positions]
+            row['oldkeys'] = dict(keynames=[col.name for col in keys],
+                                  keytypes=[type_name(col) for col in keys],
+                                  keyvalues=[value(old[i]) for i in positions])
+        return row
+
+    def _wal2json_v2_row(self, change, kind):
+        columns = change.get('columns', [])
+        identity = change.get('identity', [])
+
+        if self.full_change:
+            row = dict(kind=kind, schema=change['schema'], table=change['table'],
+                       columnnames=[col['name'] for col in columns],
+                       columntypes=[col['type'] for col in columns],
+                       columnvalues=[col.get('value') for col in columns])
+            if identity:
+                row['oldkeys'] = dict(keynames=[col['name'] for col in identity],
+                                      keytypes=[col['type'] for col in identity],
+                                      keyvalues=[col.get('value') for col in identity])
+            return [FullChange(xid=self.cur_xact, change=row)]
+
+        full_table = '{}.{}'.format(change['schema'], change['table'])
+        if full_table not in self.primary_key_map and not self._refresh_primary_key(full_table):
+            self._log_and_raise(MISSING_TABLE_ERR.format(full_table))
+        else:
+            # Deletes only carry the replica identity.
+            row, layout = (columns, 'columns') if columns else (identity, 'identity')
+            name_of = itemgetter('name')
+            positions = self._key_positions(full_table, layout, self.primary_key_map[full_table], row, name_of)
+            if positions is None and self._refresh_primary_key(full_table):
+                positions = self._key_positions(full_table, layout, self.primary_key_map[full_table], row, name_of)
+
+            if positions is None:
+                self._log_and_raise(MISSING_PK_ERR.format(full_table))
+            else:
+                pkey = [str(row[i].get('value')) for i in positions]
+                return [Change(xid=self.cur_xact, table=full_table,
+                               operation=kind, pkey=self._pkey(pkey))]
+
+        return []
+
+    def begin_xid(self, change):
+        """
+        Recognises the messages starting a transaction without fully parsing the
+        rest, for whoever needs to know which transaction later messages belong to
+        without formatting them, see parallel.FormatterPool.
+
+        :param change: a message payload.
+        :return: the xid change begins, as the formatter reads it, or None.
+        """
+        if self.output_plugin == 'test_decoding':
+            if change[:6] in (b'BEGIN ', 'BEGIN '):
+                return self._text(change).split(' ', 2)[1]
+        elif self.output_plugin == 'pgoutput':
+            if change[:1] == b'B':
+                return pgoutput.decode(change).xid
+        elif self.output_plugin == 'wal2json' and self.wal2json_format_version == 2:
+            # Begins are tiny, only parse what may be one.
+            if change[:32].find(b'"B"' if isinstance(change, bytes) else '"B"') != -1:
+                change = self.json_codec.loads(change)
+                if change.get('action') == 'B':
+                    return change.get('xid')
+        return None
+
+    def ends_transaction(self, change):
+        """
+        Recognises the messages ending a transaction, like begin_xid.
+
+        :param change: a message payload.
+        :return: whether change is the last message of its transaction.
+        """
+        if self.output_plugin == 'test_decoding':
+            return change[:7] in (b'COMMIT ', 'COMMIT ')
+        elif self.output_plugin == 'pgoutput':
+            return change[:1] == b'C'
+        elif self.output_plugin == 'wal2json' and self.wal2json_format_version == 2:
+            if change[:32].find(b'"C"' if isinstance(change, bytes) else '"C"') != -1:
+                return self.json_codec.loads(change).get('action') == 'C'
+            return False
+        # wal2json version 1 sends every transaction as one message.
+        return self.output_plugin == 'wal2json'
+
+    def group_message(self, fmt_msgs, part, final):
+        """
+        Packs messages of one transaction into a single one. It starts with a
+        header line of VERSION, GROUP_TYPE, xid, part, 'more' if further parts of
+        the transaction follow or 'last' if not, and the number of messages,
+        followed by one message per line::
+
+            0,TXN,<xid>,<part>,<more|last>,<count>
+            0,CDC,<xid>,<table>,<operation>,<primary key>
+            ...
+
+        :param fmt_msgs: list of Messages of the same transaction, in order.
+        :param part: how many parts of the transaction came before.
+        :return: Message with a TransactionGroup as its change.
+        """
+        group = self._transaction_group(fmt_msgs, part, final)
+        header = '{},{},{},{},{},{}'.format(self.VERSION, self.GROUP_TYPE, group.xid, part,
+                                            'last' if final else 'more', group.count)
+        return Message(change=group, fmt_msg='\n'.join([header] + [fmt_msg.fmt_msg for fmt_msg in fmt_msgs]))
+
+    @staticmethod
+    def _transaction_group(fmt_msgs, part, final):
+        first = fmt_msgs[0].change
+        return TransactionGroup(xid=first.xid, table=first.table, part=part, final=final, count=len(fmt_msgs))
+
+    @staticmethod
+    def _text(change):
+        # Payloads come as bytes unless replication was started with decode=True.
+        if isinstance(change, bytes) and not isinstance(change, str):
+            return change.decode('utf-8')
+        return change
 
     @staticmethod
     def _log_and_raise(msg):
@@ -138,10 +782,18 @@ class Formatter(object):
 
     def __call__(self, change):
         if self.output_plugin == 'test_decoding':
-            pp_changes = self._preprocess_test_decoding_change(change)
+            pp_changes = self._preprocess_test_decoding_change(self._text(change))
+        elif self.output_plugin == 'wal2json' and self.wal2json_format_version == 2:
+            pp_changes = self._preprocess_wal2json_v2_change(change)
         elif self.output_plugin == 'wal2json':
             pp_changes = self._preprocess_wal2json_change(change)
-        return [self.produce_formatted_message(pp_change) for pp_change in pp_changes]
+        elif self.output_plugin == 'pgoutput':
+            pp_changes = self._preprocess_pgoutput_change(change)
+
+        if isinstance(pp_changes, list):
+            return [self.produce_formatted_message(pp_change) for pp_change in pp_changes]
+        # Streamed, so stay lazy.
+        return (self.produce_formatted_message(pp_change) for pp_change in pp_changes)
 
     def produce_formatted_message(self, change):
         raise NotImplementedError
@@ -150,8 +802,12 @@ class Formatter(object):
 class CSVFormatter(Formatter):
     VERSION = 0
     def produce_formatted_message(self, change):
+        xid, table, operation, pkey = change
+        if isinstance(pkey, list):
+            # Composite keys take one field per column.
+            pkey = ','.join(pkey)
         fmt_msg = '{},{},{},{},{},{}'.format(CSVFormatter.VERSION,
-                                             CSVFormatter.TYPE, *change)
+                                             CSVFormatter.TYPE, xid, table, operation, pkey)
         return Message(change=change, fmt_msg=fmt_msg)
 
 
@@ -159,10 +815,120 @@ class CSVPayloadFormatter(Formatter):
     VERSION = 0
     def produce_formatted_message(self, change):
         fmt_msg = '{},{},{}'.format(CSVFormatter.VERSION, CSVFormatter.TYPE,
-                                    json.dumps(change._asdict()))
+                                    self.json_codec.dumps(change._asdict()))
         return Message(change=change, fmt_msg=fmt_msg)
 
 
-def get_formatter(name, primary_key_map, output_plugin, full_change, table_pat):
+class BinaryFormatter(Formatter):
+    """
+    Base of formatters writing bytes rather than text. Full changes do not repeat
+    their table's column names and types on every row: each distinct table
+    version gets a schema, sent along with the first of its rows in every
+    transaction and referenced by id from the rest. Transactions therefore stay
+    self-describing whichever shard they land on and wherever a consumer starts
+    reading, while wide tables changing many rows at once only pay for their
+    values. Schema ids are derived from the schema, so stable across restarts.
+
+    Subclasses implement encode.
+    """
+    VERSION = 0
+
+    def __init__(self, *args, **kwargs):
+        super(BinaryFormatter, self).__init__(*args, **kwargs)
+        # (table, columns, types, key names, key types) -> schema id
+        self._schema_ids = {}
+        self._schema_xid = None
+        # Table versions described in the current transaction.
+        self._sent_schemas = set()
+
+    def encode(self, record):
+        """
+        :param record: list of None, bool, int, float, str, lists and dicts.
+        :return: bytes
+        """
+        raise NotImplementedError
+
+    def produce_formatted_message(self, change):
+        if isinstance(change, FullChange):
+            record = self._full_change_record(change)
+        else:
+            record = [self.VERSION, self.TYPE, change.xid, change.table, change.operation, change.pkey]
+
+        return Message(change=change, fmt_msg=self.encode(record))
+
+    def group_message(self, fmt_msgs, part, final):
+        """
+        Packs messages of one transaction into a single one: the header
+        [VERSION, GROUP_TYPE, xid, part, 'more' or 'last', count] followed by the
+        count messages, each encoded on its own.
+        """
+        group = self._transaction_group(fmt_msgs, part, final)
+        header = self.encode([self.VERSION, self.GROUP_TYPE, group.xid, part, 'last' if final else 'more',
+                              group.count])
+        return Message(change=group, fmt_msg=b''.join([header] + [fmt_msg.fmt_msg for fmt_msg in fmt_msgs]))
+
+    def _full_change_record(self, full_change):
+        """
+        :return: [VERSION, TYPE, xid, table, operation, schema id, column values,
+                  old key values, schema or None]
+        """
+        change = full_change.change
+        oldkeys = change.get('oldkeys') or {}
+        table = full_change.table
+        version = (table,
+                   tuple(change.get('columnnames', ())), tuple(change.get('columntypes', ())),
+                   tuple(oldkeys.get('keynames', ())), tuple(oldkeys.get('keytypes', ())))
+
+        schema_id = self._schema_ids.get(version)
+        if schema_id is None:
+            digest = hashlib.md5(json.dumps(version).encode('utf-8')).hexdigest()
+            # 64 bits make collisions unlikely even among many thousands of tables.
+            schema_id = self._schema_ids[version] = int(digest[:16], 16)
+
+        if full_change.xid != self._schema_xid:
+            self._schema_xid = full_change.xid
+            self._sent_schemas = set()
+
+        schema = None
+        if version not in self._sent_schemas:
+            self._sent_schemas.add(version)
+            schema = dict(columnnames=version[1], columntypes=version[2], keynames=version[3], keytypes=version[4])
+
+        return [self.VERSION, self.TYPE, full_change.xid, table, full_change.operation, schema_id,
+                change.get('columnvalues'), oldkeys.get('keyvalues'), schema]
+
+
+class MessagePackFormatter(BinaryFormatter):
+    """
+    Writes every message as a MessagePack array, see BinaryFormatter for the
+    layout of full changes. Requires the msgpack package.
+    """
+    def __init__(self, *args, **kwargs):
+        if msgpack is None:
+            raise ImportError('MessagePackFormatter requires msgpack: pip install msgpack')
+
+        super(MessagePackFormatter, self).__init__(*args, **kwargs)
+        self._packer = msgpack.Packer(use_bin_type=True)
+
+    def encode(self, record):
+        try:
+            return self._packer.pack(record)
+        except OverflowError:
+            # numeric columns can hold integers wider than MessagePack's 64 bits.
+            self._packer.reset()
+            return self._packer.pack(_wide_ints_to_str(record))
+
+
+def _wide_ints_to_str(obj):
+    if isinstance(obj, (list, tuple)):
+        return [_wide_ints_to_str(item) for item in obj]
+    elif isinstance(obj, dict):
+        return dict((key, _wide_ints_to_str(value)) for key, value in obj.items())
+    elif isinstance(obj, numbers.Integral) and not -2 ** 63 <= obj < 2 ** 64:
+        return str(obj)
+    return obj
+
+
+def get_formatter(name, primary_key_map, output_plugin, full_change, table_pat, **kwargs):
     formatter_f = getattr(sys.modules[__name__], '%sFormatter' % name)
-    return formatter_f(primary_key_map, output_plugin, full_change, table_pat)
+    return formatter_f(primary_key_map, output_plugin, full_change, table_pat, **kwargs)
@@ -0,0 +1,100 @@
+"""
+Grouping of the messages of each transaction into as few Kinesis user records
+as fit, rather than one user record per changed row.
+
+Consumers then read a transaction as one record, or a few consecutive ones
+when it is too large for one, instead of reassembling it row by row, and both
+sides pay the per record overhead of aggregation once per group. See
+Formatter.group_message for the layout of a group.
+"""
+from collections import OrderedDict
+
+import aws_kinesis_agg
+
+# Leaves room in an aggregated record for the partition key and framing.
+MAX_GROUP_BYTES = aws_kinesis_agg.MAX_BYTES_PER_RECORD - 1024
+
+
+class _Group(object):
+    def __init__(self):
+        self.messages = []
+        self.lsns = []
+        self.size = 0
+        self.part = 0
+
+
+class TransactionGrouper(object):
+    """
+    Collects the messages of the current transaction and packs them with
+    formatter.group_message once it commits. A transaction that would take a
+    group past max_bytes is split: the messages collected so far are packed as
+    a part with more to follow, and the remaining ones make up the next part.
+    """
+    def __init__(self, formatter, max_bytes=MAX_GROUP_BYTES, key=None):
+        """
+        :param key: optional callable taking a schema qualified table name and
+                    returning which group its messages join, e.g. the writer of
+                    the stream they are routed to. One group per transaction if None.
+        """
+        self.formatter = formatter
+        self.max_bytes = max_bytes
+        self.key = key
+
+        self._xid = None
+        # key -> _Group of the current transaction.
+        self._groups = OrderedDict()
+
+    @property
+    def pending_count(self):
+        """
+        :return: messages collected but not packed yet.
+        """
+        return sum(len(group.messages) for group in self._groups.values())
+
+    def add(self, fmt_msg, lsn):
+        """
+        :param lsn: LSN of the replication message fmt_msg came from.
+        :return: list of (group Message, LSNs of the messages it packs) completed
+                 by adding fmt_msg, usually empty.
+        """
+        parts = []
+        if fmt_msg.change.xid != self._xid:
+            # The previous transaction's commit was not seen, e.g. it was filtered.
+            parts = self.commit()
+            self._xid = fmt_msg.change.xid
+
+        key = self.key(fmt_msg.change.table) if self.key is not None else None
+        try:
+            group = self._groups[key]
+        except KeyError:
+            group = self._groups[key] = _Group()
+
+        data = fmt_msg.fmt_msg
+        # Each message takes a line in text groups.
+        size = len(data if isinstance(data, bytes) else data.encode('utf-8')) + 1
+        if group.messages and group.size + size > self.max_bytes:
+            parts.append(self._pack(group, False))
+
+        group.messages.append(fmt_msg)
+        group.lsns.append(lsn)
+        group.size += size
+        return parts
+
+    def commit(self):
+        """
+        Ends the current transaction.
+
+        :return: list of (group Message, LSNs) of its last parts.
+        """
+        parts = [self._pack(group, True) for group in self._groups.values() if group.messages]
+        self._groups.clear()
+        self._xid = None
+        return parts
+
+    def _pack(self, group, final):
+        part = (self.formatter.group_message(group.messages, group.part, final), group.lsns)
+        group.messages = []
+        group.lsns = []
+        group.size = 0
+        group.part += 1
+        return part
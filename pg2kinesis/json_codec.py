@@ -0,0 +1,114 @@
+"""
+JSON codecs for parsing wal2json payloads and encoding Kinesis messages.
+
+orjson and python-rapidjson are several times faster than the standard library
+at both, so the first of them that is installed is used unless a codec is
+asked for by name. All of them accept payloads as bytes as well as text.
+"""
+import json
+import string
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import rapidjson
+except ImportError:
+    rapidjson = None
+
+# orjson silently parses integer literals too wide for 64 bits as floats and
+# wal2json writes numeric columns as bare numbers, so payloads with a run of 19
+# or more digits are parsed by the standard library. Mapping every digit to 0
+# and searching for the run is several times faster than a regex.
+try:
+    DIGITS_TO_ZERO = bytes.maketrans(b'123456789', b'000000000')
+except AttributeError:
+    # Python 2
+    DIGITS_TO_ZERO = string.maketrans(b'123456789', b'000000000')
+WIDE_INT_DIGITS = b'0' * 19
+
+
+def has_wide_int(data):
+    """
+    :param data: JSON as bytes or text.
+    :return: True if data may hold an integer literal not fitting in 64 bits.
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return data.translate(DIGITS_TO_ZERO).find(WIDE_INT_DIGITS) != -1
+
+
+class JSONCodec(object):
+    """
+    The standard library json module, always available.
+    """
+    name = 'json'
+
+    def loads(self, data):
+        if isinstance(data, bytes) and not isinstance(data, str):
+            # Python 3 before 3.6 only parses text.
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    def dumps(self, obj):
+        """
+        :return: obj as JSON text.
+        """
+        return json.dumps(obj)
+
+
+class OrjsonCodec(JSONCodec):
+    """
+    orjson, writing compact JSON. Payloads holding integers too wide for it and
+    objects it cannot encode are handed to the standard library instead.
+    """
+    name = 'orjson'
+
+    def loads(self, data):
+        if has_wide_int(data):
+            return super(OrjsonCodec, self).loads(data)
+        return orjson.loads(data)
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            return super(OrjsonCodec, self).dumps(obj)
+
+
+class RapidjsonCodec(JSONCodec):
+    """
+    python-rapidjson, writing compact JSON.
+    """
+    name = 'rapidjson'
+
+    def loads(self, data):
+        return rapidjson.loads(data)
+
+    def dumps(self, obj):
+        return rapidjson.dumps(obj)
+
+
+# Fastest first.
+JSON_CODECS = [(OrjsonCodec, orjson), (RapidjsonCodec, rapidjson), (JSONCodec, json)]
+
+
+def available_json_codecs():
+    """
+    :return: names of the codecs whose library is installed, fastest first.
+    """
+    return [codec.name for codec, module in JSON_CODECS if module is not None]
+
+
+def get_json_codec(name=None):
+    """
+    :param name: one of available_json_codecs(), the fastest if None or 'auto'.
+    :return: a codec instance.
+    """
+    for codec, module in JSON_CODECS:
+        if module is not None and name in (None, 'auto', codec.name):
+            return codec()
+
+    raise ValueError('JSON codec "{}" is not installed.'.format(name))
@@ -0,0 +1,271 @@
+"""
+Process metrics in the Prometheus text exposition format, served over HTTP by
+start_http_server.
+
+Updates are plain attribute arithmetic without locks so they stay cheap on the
+replication hot path. Metrics updated by the StreamWriters, which run on sender
+and spill drainer threads, one per routed stream, are created shared and lock
+their updates instead. Gauges reading other state are evaluated when scraped.
+"""
+import bisect
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from .log import logger
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, shared=False):
+        """
+        :param shared: lock updates, for metrics updated from several threads.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.shared = shared
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        :return: the child metric for values, one per label name, to update.
+        """
+        try:
+            return self._children[values]
+        except KeyError:
+            with self._lock:
+                return self._children.setdefault(values, self._new_child())
+
+    def collect(self):
+        """
+        :return: the metric's lines in the text exposition format.
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            lines.extend(self._collect_child(values, child))
+        return lines
+
+    def _collect_child(self, values, child):
+        return ['{}{} {}'.format(self.name, _format_labels(self.labelnames, values), _format_value(child.get()))]
+
+
+class _Value(object):
+    def __init__(self, shared=False):
+        self.value = 0
+        self.function = None
+        if shared:
+            self._lock = threading.Lock()
+            self.inc = self._locked_inc
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def _locked_inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """
+        :param function: called for the value on every scrape instead.
+        """
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function() or 0
+        return self.value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value(self.shared)
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _Value(self.shared)
+
+    def set(self, value):
+        self._children[()].value = value
+
+    def set_function(self, function):
+        self._children[()].set_function(function)
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets, shared=False):
+        self.buckets = buckets
+        # Not cumulative, collect sums them up.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        if shared:
+            self._lock = threading.Lock()
+            self.observe = self._locked_observe
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def _locked_observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(), registry=None, shared=False):
+        """
+        :param buckets: increasing upper bounds, +Inf is implied.
+        """
+        self.buckets = list(buckets)
+        super(Histogram, self).__init__(name, documentation, labelnames, registry, shared)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets, self.shared)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def _collect_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], child.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name, _format_labels(self.labelnames, values, 'le="{}"'.format(_format_value(bound))),
+                _format_value(cumulative)))
+        labels = _format_labels(self.labelnames, values)
+        lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(child.sum)))
+        lines.append('{}_count{} {}'.format(self.name, labels, _format_value(cumulative)))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def exposition(self):
+        """
+        :return: every registered metric in the text exposition format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+LATENCY_BUCKETS = (.0001, .0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 524288, 1048576)
+
+REPLICATION_MESSAGES = Counter('pg2kinesis_replication_messages_total',
+                               'Messages read from the replication slot.')
+REPLICATION_BYTES = Counter('pg2kinesis_replication_bytes_total',
+                            'Payload bytes read from the replication slot.')
+MESSAGES = Counter('pg2kinesis_messages_total',
+                   'Formatted messages put to Kinesis.', ['table', 'operation'])
+MESSAGE_BYTES = Counter('pg2kinesis_message_bytes_total',
+                        'Bytes of formatted messages put to Kinesis.', ['table', 'operation'])
+FORMAT_SECONDS = Histogram('pg2kinesis_format_seconds',
+                           'Time formatting a replication message.', buckets=LATENCY_BUCKETS)
+AGGREGATE_BYTES = Histogram('pg2kinesis_aggregate_bytes',
+                            'Size of aggregated records sent, after compression.', buckets=SIZE_BUCKETS,
+                            shared=True)
+PUT_SECONDS = Histogram('pg2kinesis_put_seconds',
+                        'Latency of PutRecord and PutRecords requests.', ['request'], buckets=LATENCY_BUCKETS,
+                        shared=True)
+THROTTLE_RETRIES = Counter('pg2kinesis_throttle_retries_total',
+                           'Requests or records retried after Kinesis throttled them.', shared=True)
+UNCOMPRESSED_BYTES = Counter('pg2kinesis_uncompressed_bytes_total', 'Bytes compressed.', shared=True)
+COMPRESSED_BYTES = Counter('pg2kinesis_compressed_bytes_total', 'Bytes compressed to.', shared=True)
+COMPRESSION_RATIO = Gauge('pg2kinesis_compression_ratio', 'Bytes before compression per byte sent.')
+FLUSHES = Counter('pg2kinesis_flushes_total',
+                  'Sends of pending records by what triggered them: size, time, shutdown or manual.', ['reason'],
+                  shared=True)
+COALESCED_MESSAGES = Counter('pg2kinesis_coalesced_messages_total',
+                             'Messages dropped for a later change of the same row.', shared=True)
+SPILLED_RECORDS = Counter('pg2kinesis_spilled_records_total',
+                          'Aggregated records appended to the spill log rather than sent.', shared=True)
+SPILL_BYTES = Gauge('pg2kinesis_spill_bytes', 'Bytes in the spill log not sent yet.')
+IN_FLIGHT_BYTES = Gauge('pg2kinesis_in_flight_bytes', 'Bytes of messages put but not yet sent.')
+REPLICATION_LAG_BYTES = Gauge('pg2kinesis_replication_lag_bytes',
+                              'WAL written on the primary since the last LSN flushed to Kinesis.')
+RECEIVE_LAG_BYTES = Gauge('pg2kinesis_receive_lag_bytes',
+                          'WAL written on the primary since the last LSN received.')
+RETAINED_WAL_BYTES = Gauge('pg2kinesis_retained_wal_bytes',
+                           'WAL the replication slot keeps on the primary.')
+RECEIVED_LSN = Gauge('pg2kinesis_received_lsn', 'Last LSN read from the replication slot.')
+FLUSHED_LSN = Gauge('pg2kinesis_flushed_lsn', 'Last LSN acknowledged as flushed to postgres.')
+
+
+def start_http_server(port, addr='', registry=REGISTRY):
+    """
+    Serves registry on every path of port from a daemon thread.
+
+    :return: the HTTPServer.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            payload = registry.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((addr, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='pg2kinesis-metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on port %s' % server.server_address[1])
+    return server
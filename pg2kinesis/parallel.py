@@ -0,0 +1,186 @@
+"""
+Formatting of replication messages in a pool of worker processes.
+
+Parsing payloads and encoding messages is pure python, so a single process
+formats on one core. FormatterPool hands batches of consecutive payloads to
+worker processes, each with its own copy of the formatter, and returns the
+results in the order the payloads were read, so aggregation, LSN
+acknowledgements and feedback see exactly what formatting inline would give.
+
+Workers cannot query postgres. A batch needing a primary key looked up is
+formatted again by the formatter the pool was made from, which can, and the keys
+it learns are passed on to the workers with every later batch.
+
+pgoutput rows refer to relations described by earlier messages, which another
+worker may have formatted. The pool caches those messages as well and sends
+every batch along with the relations its rows refer to.
+"""
+from collections import deque
+import multiprocessing
+
+from . import pgoutput
+from .log import logger
+
+# Set in every worker process by _init_worker.
+_formatter = None
+
+
+class PrimaryKeyLookupDeferred(Exception):
+    """
+    Raised by a worker's formatter instead of looking a table's primary key up.
+    """
+
+
+def _defer_primary_key_lookup(table):
+    raise PrimaryKeyLookupDeferred(table)
+
+
+def _init_worker(formatter_class, args, kwargs):
+    global _formatter
+    _formatter = formatter_class(*args, primary_key_lookup=_defer_primary_key_lookup, **kwargs)
+
+
+def _format_batch(xid, payloads, primary_keys, relations=None, type_names=None):
+    """
+    :param xid: transaction the first payload belongs to, unless it begins one.
+    :param primary_keys: primary_key_map entries learnt since the pool started.
+    :param relations: pgoutput relations the payloads refer to, by OID.
+    :param type_names: pgoutput names of types that are not built in, by OID.
+    :return: list of lists of formatter Messages, one per payload.
+    """
+    for table, primary_key in primary_keys.items():
+        if _formatter.primary_key_map.get(table) != primary_key:
+            _formatter._set_primary_key(table, primary_key)
+    if relations:
+        _formatter._relations.update(relations)
+        _formatter._type_names.update(type_names)
+
+    _formatter.cur_xact = xid
+    return [list(_formatter(payload)) for payload in payloads]
+
+
+def _get_context():
+    # Workers are started fresh rather than forked from a process running the
+    # sender, lag sampler and metrics threads. Python 2 only forks.
+    get_context = getattr(multiprocessing, 'get_context', None)
+    return get_context('spawn') if get_context else multiprocessing
+
+
+class FormatterPool(object):
+    """
+    Formats payloads put to it in processes worker processes, batch_size at a
+    time. Wholly streamed wal2json transactions are materialised by the worker.
+    """
+    def __init__(self, formatter, processes, batch_size=100, max_pending_batches=None):
+        """
+        :param formatter: Formatter whose settings workers copy, which also formats
+                          batches needing a primary key lookup.
+        :param max_pending_batches: batches submitted before results blocks on the
+                                    oldest, twice processes if None.
+        """
+        self.formatter = formatter
+        self.processes = processes
+        self.batch_size = batch_size
+        self.max_pending_batches = max_pending_batches or 2 * processes
+
+        self._initial_primary_keys = dict(formatter.primary_key_map)
+        self._primary_keys = {}
+        self._xid = formatter.cur_xact
+        # Payloads and LSNs not submitted yet.
+        self._batch_xid = self._xid
+        self._payloads = []
+        self._lsns = []
+        # pgoutput: relations referred to by the payloads not submitted yet.
+        self._oids = set()
+        # (xid, payloads, lsns, AsyncResult) oldest first.
+        self._pending = deque()
+
+        args = (formatter.primary_key_map, formatter.output_plugin, formatter.full_change, formatter.table_pat)
+        kwargs = dict(wal2json_format_version=formatter.wal2json_format_version,
+                      stream_threshold=formatter.stream_threshold, json_codec=formatter.json_codec,
+                      operations=formatter.operations)
+        self._pool = _get_context().Pool(processes, _init_worker, (type(formatter), args, kwargs))
+
+    @property
+    def pending_count(self):
+        """
+        :return: payloads put but not returned by results yet.
+        """
+        return len(self._payloads) + sum(len(payloads) for _, payloads, _, _ in self._pending)
+
+    def put(self, payload, lsn):
+        """
+        Queues payload for formatting, submitting a batch once batch_size are queued
+        or right away if no batch is being formatted.
+        """
+        if self.formatter.output_plugin == 'pgoutput':
+            oid = pgoutput.relation_oid(payload)
+            if oid is not None:
+                self._oids.add(oid)
+            elif payload[:1] in (b'R', b'Y'):
+                # Rows queued so far refer to the relation as it was.
+                self.submit()
+                self.formatter(payload)
+
+        if not self._payloads:
+            self._batch_xid = self._xid
+        self._payloads.append(payload)
+        self._lsns.append(lsn)
+
+        xid = self.formatter.begin_xid(payload)
+        if xid is not None:
+            self._xid = xid
+
+        if len(self._payloads) >= self.batch_size or not self._pending:
+            self.submit()
+
+    def submit(self):
+        """
+        Submits what is queued, if anything, as a batch.
+        """
+        if not self._payloads:
+            return
+
+        args = (self._batch_xid, self._payloads, self._primary_keys)
+        if self._oids:
+            relations = self.formatter._relations
+            args += (dict((oid, relations[oid]) for oid in self._oids if oid in relations),
+                     self.formatter._type_names)
+        result = self._pool.apply_async(_format_batch, args)
+        self._pending.append((self._batch_xid, self._payloads, self._lsns, result))
+        self._payloads = []
+        self._lsns = []
+        self._oids = set()
+
+    def results(self, block=False):
+        """
+        Yields results in the order payloads were put, stopping at the first batch
+        still being formatted unless block or too many batches are pending.
+
+        :return: generator of (lsn, list of formatter Messages) per payload.
+        """
+        while self._pending and (block or self._pending[0][3].ready() or
+                                 len(self._pending) > self.max_pending_batches):
+            xid, payloads, lsns, result = self._pending.popleft()
+            try:
+                fmt_msgs = result.get()
+            except PrimaryKeyLookupDeferred as e:
+                fmt_msgs = self._format_inline(xid, payloads, e)
+
+            for lsn, msgs in zip(lsns, fmt_msgs):
+                yield lsn, msgs
+
+    def _format_inline(self, xid, payloads, deferred):
+        logger.info('Formatting a batch inline to look up the primary key of {}'.format(deferred))
+        self.formatter.cur_xact = xid
+        fmt_msgs = [list(self.formatter(payload)) for payload in payloads]
+
+        # Rare, so just compare the whole map.
+        self._primary_keys = dict((table, primary_key)
+                                  for table, primary_key in self.formatter.primary_key_map.items()
+                                  if self._initial_primary_keys.get(table) != primary_key)
+        return fmt_msgs
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
@@ -0,0 +1,162 @@
+"""
+Decoding of pgoutput, the output plugin behind postgres' built in logical
+replication, protocol version 1. Messages are binary and column values come in
+postgres' text representation, see
+https://www.postgresql.org/docs/current/protocol-logicalrep-message-formats.html
+
+Rows only carry the OID of their relation. Relation messages describing it are
+sent ahead of its first row in every session and after its columns change, so
+readers cache them by OID.
+
+Tuple values are left as bytes, None for NULL or UNCHANGED_TOAST for TOASTed
+values an update did not touch, so callers only decode what they use.
+"""
+from collections import namedtuple
+import struct
+
+Begin = namedtuple('Begin', 'final_lsn, commit_time, xid')
+Commit = namedtuple('Commit', 'flags, lsn, end_lsn, commit_time')
+Origin = namedtuple('Origin', 'lsn, name')
+Relation = namedtuple('Relation', 'oid, namespace, name, replica_identity, columns')
+Column = namedtuple('Column', 'flags, name, type_oid, type_modifier')
+Type = namedtuple('Type', 'oid, namespace, name')
+Insert = namedtuple('Insert', 'oid, new')
+# old is the replica identity key, the whole old row with REPLICA IDENTITY FULL,
+# or None if the key did not change.
+Update = namedtuple('Update', 'oid, old, new')
+Delete = namedtuple('Delete', 'oid, old')
+Truncate = namedtuple('Truncate', 'options, oids')
+
+# Column flag of replica identity columns, the primary key unless the table's
+# REPLICA IDENTITY says otherwise.
+KEY_COLUMN = 1
+
+UNCHANGED_TOAST = object()
+
+# Tags of the messages carrying a row, which all start with its relation's OID.
+ROW_TAGS = {b'I': 'insert', b'U': 'update', b'D': 'delete'}
+
+# Names of the built in types, pgoutput only sends Type messages for the others.
+BUILTIN_TYPES = {
+    16: 'bool', 17: 'bytea', 18: 'char', 19: 'name', 20: 'int8', 21: 'int2', 23: 'int4', 25: 'text',
+    26: 'oid', 114: 'json', 142: 'xml', 650: 'cidr', 700: 'float4', 701: 'float8', 790: 'money',
+    829: 'macaddr', 869: 'inet', 1000: '_bool', 1005: '_int2', 1007: '_int4', 1009: '_text',
+    1015: '_varchar', 1016: '_int8', 1042: 'bpchar', 1043: 'varchar', 1082: 'date', 1083: 'time',
+    1114: 'timestamp', 1115: '_timestamp', 1182: '_date', 1184: 'timestamptz', 1186: 'interval',
+    1231: '_numeric', 1266: 'timetz', 1560: 'bit', 1562: 'varbit', 1700: 'numeric', 2950: 'uuid',
+    2951: '_uuid', 3802: 'jsonb', 3807: '_jsonb',
+}
+
+_INT32 = struct.Struct('>i')
+_UINT32 = struct.Struct('>I')
+_BEGIN = struct.Struct('>QqI')
+_COMMIT = struct.Struct('>bQQq')
+_RELATION_COLUMN = struct.Struct('>Ii')
+
+
+def relation_oid(data):
+    """
+    :return: the OID of the relation of a row message, None for other messages.
+    """
+    if data[:1] in ROW_TAGS:
+        return _UINT32.unpack_from(data, 1)[0]
+    return None
+
+
+def _read_string(data, pos):
+    end = data.index(b'\0', pos)
+    return data[pos:end].decode('utf-8'), end + 1
+
+
+def _read_tuple(data, pos):
+    """
+    :return: tuple of column values and the position after them.
+    """
+    count = struct.unpack_from('>H', data, pos)[0]
+    pos += 2
+    values = []
+    for _ in range(count):
+        kind = data[pos:pos + 1]
+        pos += 1
+        if kind == b't':
+            size = _INT32.unpack_from(data, pos)[0]
+            pos += 4
+            values.append(data[pos:pos + size])
+            pos += size
+        elif kind == b'n':
+            values.append(None)
+        elif kind == b'u':
+            values.append(UNCHANGED_TOAST)
+        else:
+            raise ValueError('Unknown pgoutput tuple value kind {!r}'.format(kind))
+    return tuple(values), pos
+
+
+def _decode_relation(data):
+    oid = _UINT32.unpack_from(data, 1)[0]
+    namespace, pos = _read_string(data, 5)
+    name, pos = _read_string(data, pos)
+    replica_identity = data[pos:pos + 1].decode('ascii')
+    count = struct.unpack_from('>H', data, pos + 1)[0]
+    pos += 3
+
+    columns = []
+    for _ in range(count):
+        flags = struct.unpack_from('>b', data, pos)[0]
+        col_name, pos = _read_string(data, pos + 1)
+        type_oid, type_modifier = _RELATION_COLUMN.unpack_from(data, pos)
+        pos += _RELATION_COLUMN.size
+        columns.append(Column(flags, col_name, type_oid, type_modifier))
+
+    # An empty namespace stands for pg_catalog.
+    return Relation(oid, namespace or 'pg_catalog', name, replica_identity, tuple(columns))
+
+
+def _decode_update(data):
+    oid = _UINT32.unpack_from(data, 1)[0]
+    old = None
+    pos = 5
+    if data[pos:pos + 1] in (b'K', b'O'):
+        old, pos = _read_tuple(data, pos + 1)
+    if data[pos:pos + 1] != b'N':
+        raise ValueError('pgoutput update without a new tuple')
+    new, _ = _read_tuple(data, pos + 1)
+    return Update(oid, old, new)
+
+
+def _decode_truncate(data):
+    count = _UINT32.unpack_from(data, 1)[0]
+    options = struct.unpack_from('>b', data, 5)[0]
+    return Truncate(options, struct.unpack_from('>{}I'.format(count), data, 6))
+
+
+def decode(data):
+    """
+    :param data: a pgoutput message as bytes.
+    :return: one of the message namedtuples above.
+    """
+    tag = data[:1]
+    if tag == b'B':
+        return Begin(*_BEGIN.unpack_from(data, 1))
+    elif tag == b'C':
+        return Commit(*_COMMIT.unpack_from(data, 1))
+    elif tag == b'I':
+        if data[5:6] != b'N':
+            raise ValueError('pgoutput insert without a new tuple')
+        return Insert(_UINT32.unpack_from(data, 1)[0], _read_tuple(data, 6)[0])
+    elif tag == b'U':
+        return _decode_update(data)
+    elif tag == b'D':
+        return Delete(_UINT32.unpack_from(data, 1)[0], _read_tuple(data, 6)[0])
+    elif tag == b'R':
+        return _decode_relation(data)
+    elif tag == b'Y':
+        oid = _UINT32.unpack_from(data, 1)[0]
+        namespace, pos = _read_string(data, 5)
+        return Type(oid, namespace, _read_string(data, pos)[0])
+    elif tag == b'T':
+        return _decode_truncate(data)
+    elif tag == b'O':
+        return Origin(struct.unpack_from('>Q', data, 1)[0], _read_string(data, 9)[0])
+
+    raise ValueError('Unknown pgoutput message {!r}'.format(tag))
@@ -1,11 +1,15 @@
 from collections import namedtuple
+import select
 import threading
+import time
 
 import psycopg2
 import psycopg2.extras
 import psycopg2.extensions
 import psycopg2.errorcodes
+import psycopg2.sql
 
+from . import metrics
 from .log import logger
 
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE, None)
@@ -13,36 +17,75 @@ psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY, None)
 
 PrimaryKeyMapItem = namedtuple('PrimaryKeyMapItem', 'table_name, col_name, col_type, col_ord_pos')
 
+timer = getattr(time, 'monotonic', time.time)
+
+
+def parse_lsn(lsn):
+    """
+    :param lsn: LSN as postgres prints it, e.g. '16/B374D848', or None.
+    :return: the LSN as an integer, like psycopg2's data_start, or None.
+    """
+    if lsn is None:
+        return None
+    high, low = lsn.split('/')
+    return int(high, 16) << 32 | int(low, 16)
+
 
 class SlotReader(object):
-    PK_SQL = """
-    SELECT CONCAT(table_schema, '.', table_name), column_name, data_type, ordinal_position
-    FROM information_schema.tables
-    LEFT JOIN (
-        SELECT CONCAT(table_schema, '.', table_name), column_name, data_type, c.ordinal_position,
-                    table_catalog, table_schema, table_name
-        FROM information_schema.table_constraints
-        JOIN information_schema.key_column_usage AS kcu
-            USING (constraint_catalog, constraint_schema, constraint_name,
-                        table_catalog, table_schema, table_name)
-        JOIN information_schema.columns AS c
-            USING (table_catalog, table_schema, table_name, column_name)
-        WHERE constraint_type = 'PRIMARY KEY'
-    ) as q using (table_catalog, table_schema, table_name)
-    ORDER BY ordinal_position;
+    # pg_catalog rather than information_schema: the latter's views join every
+    # table through privilege checks and take minutes on databases with tens of
+    # thousands of partitions. One row per primary key column, a NULL key for
+    # tables without one.
+    PK_SELECT = """
+    SELECT n.nspname || '.' || c.relname AS table_name, a.attname AS col_name,
+           format_type(a.atttypid, NULL) AS col_type, a.attnum AS col_ord_pos
+    FROM pg_catalog.pg_class AS c
+    JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+    LEFT JOIN pg_catalog.pg_index AS i ON i.indrelid = c.oid AND i.indisprimary
+    LEFT JOIN pg_catalog.pg_attribute AS a ON a.attrelid = c.oid AND a.attnum = ANY(i.indkey)
+    WHERE c.relkind IN ('r', 'p')
+      AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+      AND n.nspname !~ '^pg_toast'
+    """
+
+    PK_SQL = PK_SELECT + 'ORDER BY col_ord_pos;'
+
+    # Functions were renamed from xlog to wal in 10, confirmed_flush_lsn came in 9.6.
+    LAG_SQL = """
+    SELECT {current}::text, {confirmed_flush}::text, restart_lsn::text
+    FROM pg_catalog.pg_replication_slots
+    WHERE slot_name = %s;
     """
 
+    TABLE_PK_SQL = PK_SELECT + 'AND n.nspname = %s AND c.relname = %s ORDER BY col_ord_pos;'
+
     def __init__(self, database, host, port, user, sslmode, slot_name,
-                 output_plugin='test_decoding'):
+                 output_plugin='test_decoding', wal2json_format_version=1,
+                 plugin_options=None, publication='pg2kinesis'):
+        """
+        :param plugin_options: options for the output plugin added to those
+                               process_replication_stream passes, e.g. wal2json's
+                               filters so postgres does not send what would be dropped.
+        :param publication: pgoutput only, the publication naming the tables and
+                            operations to stream, see create_publication.
+        """
         # Cool fact: using connections as context manager doesn't close them on
         # success after leaving with block
         self._db_confg = dict(database=database, host=host, port=port, user=user, sslmode=sslmode)
         self._repl_conn = None
         self._repl_cursor = None
         self._normal_conn = None
+        self._meta_conn = None
         self.slot_name = slot_name
         self.output_plugin = output_plugin
+        self.wal2json_format_version = wal2json_format_version
+        self.plugin_options = plugin_options or {}
+        self.publication = publication
+        # Bytes of WAL written since what was last acknowledged as flushed, see sample_lag.
         self.cur_lag = 0
+        self.retained_wal = 0
+        self.receive_lag = 0
+        self._stop_sampling = threading.Event()
 
     def __enter__(self):
         self._normal_conn = self._get_connection()
@@ -56,6 +99,7 @@ class SlotReader(object):
         """
         Be a good citizen and try to clean up on the way out.
         """
+        self._stop_sampling.set()
 
         try:
             self._repl_cursor.close()
@@ -72,6 +116,12 @@ class SlotReader(object):
         except Exception:
             pass
 
+        if self._meta_conn is not None:
+            try:
+                self._meta_conn.close()
+            except Exception:
+                pass
+
     def _get_connection(self, connection_factory=None, cursor_factory=None):
         return psycopg2.connect(connection_factory=connection_factory,
                                 cursor_factory=cursor_factory, **self._db_confg)
@@ -87,12 +137,101 @@ class SlotReader(object):
 
     @property
     def primary_key_map(self):
+        """
+        :return: dict of table name to a tuple of PrimaryKeyMapItem, one per
+                 primary key column in table column order. Empty for tables
+                 without a primary key.
+        """
         logger.info('Getting primary key map')
         result = map(PrimaryKeyMapItem._make, self._execute_and_fetch(SlotReader.PK_SQL))
-        pk_map = {rec.table_name: rec for rec in result}
+        pk_map = {}
+        for rec in result:
+            key = pk_map.setdefault(rec.table_name, ())
+            if rec.col_name is not None:
+                pk_map[rec.table_name] = key + (rec,)
 
         return pk_map
 
+    def table_primary_key(self, table_name):
+        """
+        Looks up a single table's primary key, for tables created or altered
+        after primary_key_map was read. Runs on its own connection, opened on
+        first use, so it can be called from within the replication callback.
+
+        :param table_name: schema qualified table name.
+        :return: the table's primary_key_map entry, None if there is no such table.
+        """
+        if self._meta_conn is None:
+            self._meta_conn = self._get_connection()
+            self._meta_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+        schema, _, table = table_name.partition('.')
+        with self._meta_conn.cursor() as cur:
+            cur.execute(SlotReader.TABLE_PK_SQL, (schema, table))
+            rows = [PrimaryKeyMapItem._make(row) for row in cur.fetchall()]
+
+        if not rows:
+            return None
+
+        return tuple(row for row in rows if row.col_name is not None)
+
+    def sample_lag(self, received_lsn=None):
+        """
+        Compares the server's current WAL position with the slot and with the last
+        message received, setting:
+
+        cur_lag: bytes not yet acknowledged as flushed, i.e. confirmed_flush_lsn.
+        retained_wal: bytes of WAL the slot keeps on the primary, from restart_lsn.
+        receive_lag: bytes not yet received, from the latest data_start.
+
+        :param received_lsn: data_start of the latest message received, if any.
+        :return: cur_lag
+        """
+        version = self._normal_conn.server_version
+        sql = SlotReader.LAG_SQL.format(
+            current='pg_current_wal_lsn()' if version >= 100000 else 'pg_current_xlog_location()',
+            confirmed_flush='confirmed_flush_lsn' if version >= 90600 else 'NULL')
+
+        rows = self._execute_and_fetch(sql, self.slot_name)
+        if not rows:
+            logger.warning('Slot %s not found while sampling lag' % self.slot_name)
+            return self.cur_lag
+
+        current, confirmed_flush, restart = [parse_lsn(lsn) for lsn in rows[0]]
+
+        self.retained_wal = current - restart if restart is not None else 0
+        self.cur_lag = current - confirmed_flush if confirmed_flush is not None else self.retained_wal
+        self.receive_lag = max(current - received_lsn, 0) if received_lsn is not None else self.cur_lag
+
+        metrics.REPLICATION_LAG_BYTES.set(self.cur_lag)
+        metrics.RETAINED_WAL_BYTES.set(self.retained_wal)
+        metrics.RECEIVE_LAG_BYTES.set(self.receive_lag)
+        logger.info('Lag: %s bytes unflushed, %s bytes unreceived, %s bytes of WAL retained' %
+                    (self.cur_lag, self.receive_lag, self.retained_wal))
+
+        return self.cur_lag
+
+    def start_lag_sampler(self, interval=10, received_lsn=None):
+        """
+        Runs sample_lag every interval seconds on a daemon thread, until exit. It
+        has the normal connection to itself once the primary key map is read.
+
+        :param received_lsn: optional callable returning the data_start of the
+                             latest message received.
+        """
+        def run():
+            while not self._stop_sampling.wait(interval):
+                try:
+                    self.sample_lag(received_lsn and received_lsn())
+                except Exception:
+                    # Lag is informational, never worth stopping replication for.
+                    logger.exception('Could not sample replication lag')
+
+        thread = threading.Thread(target=run, name='pg2kinesis-lag-sampler')
+        thread.daemon = True
+        thread.start()
+        return thread
+
     def create_slot(self):
         logger.info('Creating slot %s' % self.slot_name)
         try:
@@ -107,6 +246,34 @@ class SlotReader(object):
             else:
                 logger.info('Slot %s is already present.' % self.slot_name)
 
+    def create_publication(self, operations=None):
+        """
+        Creates the publication pgoutput streams, for all tables, unless it exists.
+        Publications can list tables instead, create one by hand to only stream some.
+
+        :param operations: publish only these of insert, update, delete and truncate,
+                           all if None. Postgres 10 cannot publish truncate.
+        """
+        if self._execute_and_fetch('SELECT 1 FROM pg_publication WHERE pubname = %s', self.publication):
+            logger.info('Publication %s is already present.' % self.publication)
+            return
+
+        logger.info('Creating publication %s' % self.publication)
+        sql = psycopg2.sql.SQL('CREATE PUBLICATION {} FOR ALL TABLES').format(
+            psycopg2.sql.Identifier(self.publication))
+        publishable = ['insert', 'update', 'delete']
+        if self._normal_conn.server_version >= 110000:
+            publishable.append('truncate')
+        if operations is not None:
+            operations = [operation for operation in operations if operation in publishable]
+
+        with self._normal_conn.cursor() as cur:
+            if operations is None or set(operations) == set(publishable):
+                # Postgres' default publishes everything it can.
+                cur.execute(sql)
+            else:
+                cur.execute(sql + psycopg2.sql.SQL(' WITH (publish = %s)'), (', '.join(operations),))
+
     def delete_slot(self):
         logger.info('Deleting slot %s' % self.slot_name)
         try:
@@ -119,11 +286,45 @@ class SlotReader(object):
             else:
                 logger.info('Slot %s was not found.' % self.slot_name)
 
-    def process_replication_stream(self, consume):
+    def process_replication_stream(self, consume, tick=None, tick_interval=1):
+        """
+        Reads the slot until consume raises psycopg2.extras.StopReplication.
+
+        Rather than blocking in consume_stream until the next message arrives, this
+        waits on the connection at most until the next tick so flushes and feedback
+        happen on schedule however little is being replicated.
+
+        :param consume: called with every replication message.
+        :param tick: called with the replication cursor every tick_interval seconds.
+        """
         logger.info('Starting the consumption of slot "%s"!' % self.slot_name)
-        if self.output_plugin == 'wal2json':
+        if self.output_plugin == 'wal2json' and self.wal2json_format_version == 2:
+            # One message per row instead of one per transaction.
+            options = {'format-version': 2, 'include-xids': 1}
+        elif self.output_plugin == 'wal2json':
             options = {'include-xids': 1}
+        elif self.output_plugin == 'pgoutput':
+            options = {'proto_version': '1', 'publication_names': self.publication}
         else:
             options = None
-        self._repl_cursor.start_replication(self.slot_name, options=options)
-        self._repl_cursor.consume_stream(consume)
+        if self.plugin_options:
+            options = dict(options or {}, **self.plugin_options)
+        cursor = self._repl_cursor
+        cursor.start_replication(self.slot_name, options=options)
+
+        next_tick = timer() + tick_interval
+        try:
+            while True:
+                msg = cursor.read_message()
+                if msg is not None:
+                    consume(msg)
+                else:
+                    select.select([cursor], [], [], max(0, next_tick - timer()))
+
+                # Advanced without a tick too, or waits would stop blocking once it passed.
+                if timer() >= next_tick:
+                    if tick is not None:
+                        tick(cursor)
+                    next_tick = timer() + tick_interval
+        except psycopg2.extras.StopReplication:
+            pass
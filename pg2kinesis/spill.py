@@ -0,0 +1,288 @@
+"""
+Durable local spill log of the records Kinesis could not take.
+
+With a spill log a StreamWriter no longer backs off, holding up replication,
+and eventually dies while Kinesis throttles or cannot be reached. It appends
+the record to the log instead and acknowledges its messages once the append
+is on disk, so postgres can recycle the WAL behind it. Records put while the
+log holds anything are appended too, keeping them in order, and a SpillDrainer
+sends the log to Kinesis from a background thread. Whatever it did not send
+is sent after a restart.
+
+The log is a directory of segment files, each preallocated and memory mapped.
+A segment holds records of a 4 byte length, a 4 byte CRC32 and the record's
+partition key, explicit hash key and data, and ends at the first zero length.
+The file named CHECKPOINT records how far the drainer got. Records sent just
+before a crash may be sent again, like the rest of pg2kinesis is at least once.
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from .log import logger
+
+CHECKPOINT = 'CHECKPOINT'
+SEGMENT_SUFFIX = '.spill'
+
+_HEADER = struct.Struct('>II')
+_KEY_LENGTH = struct.Struct('>H')
+_CHECKPOINT = struct.Struct('>QQ')
+
+
+def _encode(partition_key, explicit_hash_key, data):
+    body = b''
+    for key in (partition_key, explicit_hash_key or ''):
+        key = key.encode('utf-8')
+        body += _KEY_LENGTH.pack(len(key)) + key
+    return body + data
+
+
+def _decode(body):
+    keys = []
+    pos = 0
+    for _ in range(2):
+        length = _KEY_LENGTH.unpack_from(body, pos)[0]
+        pos += _KEY_LENGTH.size
+        keys.append(body[pos:pos + length].decode('utf-8'))
+        pos += length
+    return keys[0], keys[1] or None, body[pos:]
+
+
+class _Segment(object):
+    def __init__(self, path, size=None):
+        """
+        :param size: create the file with this many bytes, open it if None.
+        """
+        self.path = path
+        mode = 'r+b' if size is None else 'w+b'
+        self.file = open(path, mode)
+        if size is not None:
+            self.file.truncate(size)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+    def read(self, offset):
+        """
+        :return: tuple of the body of the record at offset and the offset after it,
+                 or None at the end of the segment or a torn record.
+        """
+        if offset + _HEADER.size > self.size:
+            return None
+        length, crc = _HEADER.unpack_from(self.map, offset)
+        start = offset + _HEADER.size
+        if not length or start + length > self.size:
+            return None
+        body = self.map[start:start + length]
+        if zlib.crc32(body) & 0xffffffff != crc:
+            return None
+        return body, start + length
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SpillLog(object):
+    """
+    Append-only log of records for one stream. append is called by the writer's
+    thread, peek and pop by a SpillDrainer's.
+    """
+    def __init__(self, directory, segment_bytes=64 * 1048576):
+        """
+        :param directory: created if it does not exist. Records left from an earlier
+                          run are drained first.
+        :param segment_bytes: size of each segment file, larger records get a
+                              segment of their own.
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.pending_count = 0
+        self.pending_bytes = 0
+
+        self._cond = threading.Condition()
+        # segment number -> _Segment, oldest first.
+        self._segments = {}
+        self._read_segment = self._read_offset = 0
+        self._write_segment = self._write_offset = 0
+        # Offset after the record last returned by peek.
+        self._peeked = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._recover()
+
+    def _path(self, number):
+        return os.path.join(self.directory, '{:020d}{}'.format(number, SEGMENT_SUFFIX))
+
+    def _recover(self):
+        numbers = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                         if name.endswith(SEGMENT_SUFFIX))
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT), 'rb') as f:
+                self._read_segment, self._read_offset = _CHECKPOINT.unpack(f.read(_CHECKPOINT.size))
+        except (IOError, OSError, struct.error):
+            self._read_segment, self._read_offset = (numbers[0] if numbers else 0), 0
+
+        for number in numbers:
+            if number < self._read_segment:
+                os.remove(self._path(number))
+                continue
+
+            segment = self._segments[number] = _Segment(self._path(number))
+            offset = self._read_offset if number == self._read_segment else 0
+            record = segment.read(offset)
+            while record is not None:
+                self.pending_count += 1
+                self.pending_bytes += len(record[0])
+                offset = record[1]
+                record = segment.read(offset)
+            self._write_segment, self._write_offset = number, offset
+
+        if not self._segments:
+            self._read_offset = 0
+            self._write_segment, self._write_offset = self._read_segment, 0
+        elif self._read_segment not in self._segments:
+            # Crashed after dropping the segment the checkpoint is in.
+            self._read_segment, self._read_offset = min(self._segments), 0
+
+        if self.pending_count:
+            logger.info('Draining {} records spilled to {}'.format(self.pending_count, self.directory))
+
+    def _new_segment(self, size):
+        number = self._write_segment + 1 if self._segments else self._write_segment
+        self._segments[number] = _Segment(self._path(number), size)
+        self._sync_directory()
+        self._write_segment, self._write_offset = number, 0
+        return self._segments[number]
+
+    def _sync_directory(self):
+        # Makes the new segment itself durable, not just its contents.
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def append(self, partition_key, explicit_hash_key, data):
+        """
+        Appends a record, returning once it is on disk.
+        """
+        body = _encode(partition_key, explicit_hash_key, data)
+        # Room for the record and the zero length ending the segment.
+        needed = 2 * _HEADER.size + len(body)
+        with self._cond:
+            segment = self._segments.get(self._write_segment)
+            if segment is None or self._write_offset + needed > segment.size:
+                segment = self._new_segment(max(self.segment_bytes, needed))
+
+            offset = self._write_offset
+            end = offset + _HEADER.size + len(body)
+            segment.map[offset + _HEADER.size:end] = body
+            # A torn earlier append may have left garbage behind.
+            segment.map[end:end + _HEADER.size] = b'\0' * _HEADER.size
+            segment.map[offset:offset + _HEADER.size] = _HEADER.pack(len(body), zlib.crc32(body) & 0xffffffff)
+            segment.map.flush()
+
+            self._write_offset = end
+            self.pending_count += 1
+            self.pending_bytes += len(body)
+            self._cond.notify_all()
+
+    def peek(self, timeout=None):
+        """
+        :return: the oldest record not popped as (partition key, explicit hash key
+                 or None, data), or None if there was none within timeout seconds.
+        """
+        with self._cond:
+            if not self.pending_count:
+                self._cond.wait(timeout)
+                if not self.pending_count:
+                    return None
+
+            record = self._segments[self._read_segment].read(self._read_offset)
+            while record is None:
+                # The writer moved on to the next segment.
+                self._segments.pop(self._read_segment).close()
+                os.remove(self._path(self._read_segment))
+                self._read_segment = min(self._segments)
+                self._read_offset = 0
+                record = self._segments[self._read_segment].read(0)
+
+            body, self._peeked = record
+            return _decode(body)
+
+    def pop(self):
+        """
+        Drops the record last returned by peek, once sent.
+        """
+        with self._cond:
+            length = self._peeked - self._read_offset - _HEADER.size
+            self._read_offset = self._peeked
+            self._peeked = None
+            self.pending_count -= 1
+            self.pending_bytes -= length
+            self._write_checkpoint()
+
+    def _write_checkpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(_CHECKPOINT.pack(self._read_segment, self._read_offset))
+        # Atomic on POSIX, also over an existing checkpoint.
+        os.rename(path + '.tmp', path)
+
+    def close(self):
+        with self._cond:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments = {}
+
+
+class SpillDrainer(object):
+    """
+    Sends the records of a SpillLog, oldest first, from a background thread.
+    Failed sends are retried until they succeed or the drainer is closed.
+    """
+    def __init__(self, log, send, poll_interval=1):
+        """
+        :param send: callable taking a record's partition key, explicit hash key
+                     and data and sending it, raising if it could not.
+        """
+        self.log = log
+        self.send = send
+        self.poll_interval = poll_interval
+
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pg2kinesis-drainer')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopping.is_set():
+            record = self.log.peek(self.poll_interval)
+            if record is None:
+                continue
+
+            try:
+                self.send(*record)
+            except Exception:
+                logger.exception('Sending a spilled record failed, retrying')
+                self._stopping.wait(self.poll_interval)
+            else:
+                self.log.pop()
+
+    def close(self, timeout=None):
+        """
+        Stops draining, what is left is drained on the next start.
+        """
+        self._stopping.set()
+        self._thread.join(timeout)
@@ -1,23 +1,218 @@
+from __future__ import division
+from collections import OrderedDict, deque
+import bisect
+import hashlib
+import itertools
+import re
+import threading
 import time
+
+import aws_kinesis_agg
 import aws_kinesis_agg.aggregator
 import boto3
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+from . import metrics
 from .log import logger
+from .tracker import LSNTracker
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Kinesis PutRecords request limits.
+MAX_RECORDS_PER_BATCH = 500
+MAX_BYTES_PER_BATCH = 5 * 1048576
+
+
+class FlushPolicy(object):
+    """
+    Decides when a StreamWriter sends what it has pending: once linger seconds
+    have passed since its last send, or once max_batch_bytes or max_batch_records
+    are pending. Aggregates and PutRecords batches are still sent whenever they
+    reach the Kinesis limits.
+    """
+    def __init__(self, linger=13, max_batch_bytes=None, max_batch_records=None):
+        """
+        :param linger: seconds, None to only flush on size.
+        """
+        self.linger = linger
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_records = max_batch_records
+
+    def flush_reason(self, writer, elapsed):
+        """
+        :param elapsed: seconds since writer last sent.
+        :return: 'size' or 'time' if writer should flush now, else None.
+        """
+        if self.max_batch_bytes and writer.pending_bytes >= self.max_batch_bytes:
+            return 'size'
+        if self.max_batch_records and writer.pending_records >= self.max_batch_records:
+            return 'size'
+        if self.linger is not None and elapsed >= self.linger:
+            return 'time'
+        return None
+
+
+class AdaptiveFlushPolicy(FlushPolicy):
+    """
+    Lingers for as little as min_linger while traffic is light and up to linger
+    while it is heavy: a flush is only held back past min_linger if, at the rate
+    messages arrived since the last send, the batch would fill within linger.
+    Without max_batch_bytes the batch is one aggregate, or one PutRecords request
+    in batch mode.
+    """
+    def __init__(self, linger=13, max_batch_bytes=None, max_batch_records=None, min_linger=.1):
+        super(AdaptiveFlushPolicy, self).__init__(linger, max_batch_bytes, max_batch_records)
+        self.min_linger = min_linger
+
+    def flush_reason(self, writer, elapsed):
+        reason = super(AdaptiveFlushPolicy, self).flush_reason(writer, elapsed)
+        if reason or elapsed < self.min_linger:
+            return reason
+
+        pending_bytes = writer.pending_bytes
+        if not pending_bytes:
+            return None
+
+        max_bytes = self.max_batch_bytes or (MAX_BYTES_PER_BATCH if writer.batch
+                                             else aws_kinesis_agg.MAX_BYTES_PER_RECORD)
+        filled = pending_bytes / max_bytes
+        if self.max_batch_records:
+            filled = max(filled, writer.pending_records / self.max_batch_records)
+
+        if self.linger is None or filled * self.linger < elapsed:
+            return 'time'
+        return None
+
+
+class KeyCoalescer(object):
+    """
+    Collapses the messages of a row, by table and primary key, into the last of
+    them, for consumers that only need to know which rows changed. What is left
+    keeps the order of the stream: every row's last change where it happened.
+
+    A delete is never collapsed into a later change of its row, so a row deleted
+    and inserted again still reaches consumers as a delete followed by an
+    insert. Changes of other operations, e.g. truncates, are kept, and changes
+    after them are not collapsed into changes before them.
+    """
+    ROW_OPERATIONS = frozenset(['insert', 'update', 'delete'])
+
+    def __init__(self, max_bytes=16 * 1048576):
+        """
+        :param max_bytes: bytes of messages left after which the writer flushes,
+                          whatever its flush policy.
+        """
+        self.max_bytes = max_bytes
+        self.pending_bytes = 0
+        # id -> (Message, LSNs of the messages it stands for) in stream order.
+        self._entries = OrderedDict()
+        # (table, pkey) -> id of the entry of the row's last change.
+        self._rows = {}
+        self._ids = itertools.count()
+
+    @property
+    def pending_count(self):
+        return len(self._entries)
+
+    @property
+    def full(self):
+        return self.pending_bytes >= self.max_bytes
+
+    def add(self, fmt_msg, lsn=None):
+        """
+        :param fmt_msg: a formatter Message of a Change.
+        :param lsn: LSN or list of LSNs, as for StreamWriter.put_message.
+        """
+        lsns = []
+        change = fmt_msg.change
+        if change.operation.lower() in self.ROW_OPERATIONS:
+            pkey = tuple(change.pkey) if isinstance(change.pkey, list) else change.pkey
+            row = (change.table, pkey)
+            entry_id = self._rows.get(row)
+            if entry_id is not None:
+                last_msg, last_lsns = self._entries[entry_id]
+                if last_msg.change.operation.lower() != 'delete':
+                    del self._entries[entry_id]
+                    self.pending_bytes -= len(last_msg.fmt_msg)
+                    # Only acknowledged once the change standing for it is delivered.
+                    lsns = last_lsns
+                    metrics.COALESCED_MESSAGES.inc()
+            entry_id = self._rows[row] = next(self._ids)
+        else:
+            self._rows.clear()
+            entry_id = next(self._ids)
+
+        if isinstance(lsn, list):
+            lsns.extend(lsn)
+        elif lsn is not None:
+            lsns.append(lsn)
+        self._entries[entry_id] = (fmt_msg, lsns)
+        self.pending_bytes += len(fmt_msg.fmt_msg)
+
+    def drain(self):
+        """
+        :return: list of (Message, LSNs) left, in stream order, forgetting them.
+        """
+        entries = list(self._entries.values())
+        self._entries.clear()
+        self._rows.clear()
+        self.pending_bytes = 0
+        return entries
+
 
 class StreamWriter(object):
-    def __init__(self, stream_name, back_off_limit=60, send_window=13):
+    def __init__(self, stream_name, back_off_limit=60, send_window=13, batch=False, endpoint_url=None,
+                 shard_count=1, partition_by='xid', tracker=None, compressor=None, compress_records=False,
+                 flush_policy=None, coalescer=None, spill_log=None):
+        """
+        :param send_window: seconds to linger before flushing, 0 to only flush on
+                            size. Ignored if flush_policy is given.
+        :param batch: send aggregates with PutRecords, up to MAX_RECORDS_PER_BATCH
+                      or MAX_BYTES_PER_BATCH per request, instead of one put_record each.
+        :param endpoint_url: optional Kinesis endpoint, e.g. a local stub.
+        :param shard_count: shards to create the stream with if it does not exist.
+        :param partition_by: 'xid' to use the transaction id as partition key, or
+                             'key' to hash table and primary key, see partition_key.
+        :param tracker: LSNTracker acknowledging the LSNs of delivered messages.
+        :param compressor: optional compressor from compression applied to every
+                           aggregated record, so runs wherever put_message does.
+        :param compress_records: compress each user record instead, which keeps
+                                 aggregates readable by standard deaggregation.
+        :param flush_policy: FlushPolicy deciding when to send pending messages.
+        :param coalescer: optional KeyCoalescer messages are collected in until the
+                          next flush, so only the last change of a row put since the
+                          last flush is sent.
+        :param spill_log: optional spill.SpillLog records are appended to rather than
+                          backing off while Kinesis throttles or cannot be reached,
+                          and while it holds records. Drained by a spill.SpillDrainer.
+        """
         self.stream_name = stream_name
         self.back_off_limit = back_off_limit
         self.last_send = 0
+        self.tracker = tracker if tracker is not None else LSNTracker()
+        self.batch = batch
+        self.partition_by = partition_by
+        self.compressor = compressor
+        self.compress_records = compress_records
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self.flush_policy = flush_policy if flush_policy is not None else FlushPolicy(send_window or None)
+        self.coalescer = coalescer
+        self.spill_log = spill_log
 
-        self._kinesis = boto3.client('kinesis')
+        self._kinesis = boto3.client('kinesis', endpoint_url=endpoint_url)
         self._sequence_number_for_ordering = '0'
+        self._sequence_numbers = {}
         self._record_agg = aws_kinesis_agg.aggregator.RecordAggregator()
-        self._send_window = send_window
+        # LSNs of the messages in each aggregator's current aggregate.
+        self._agg_lsns = {}
+        self._batch = []
+        self._batch_bytes = 0
+        self._shard_starts = []
+        self._shard_aggs = {}
 
         try:
-            self._kinesis.create_stream(StreamName=stream_name, ShardCount=1)
+            self._kinesis.create_stream(StreamName=stream_name, ShardCount=shard_count)
         except ClientError as e:
             # ResourceInUseException is raised when the stream already exists
             if e.response['Error']['Code'] != 'ResourceInUseException':
@@ -29,38 +224,317 @@ class StreamWriter(object):
         # waits up to 180 seconds for stream to exist
         waiter.wait(StreamName=self.stream_name)
 
-    def put_message(self, fmt_msg):
-        agg_record = None
+        if partition_by == 'key':
+            self._load_shard_map()
+
+    @property
+    def compression_ratio(self):
+        """
+        :return: bytes before compression per byte sent so far, None if nothing was compressed.
+        """
+        if not self.compressed_bytes:
+            return None
+        return self.uncompressed_bytes / self.compressed_bytes
+
+    def _compress(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        compressed = self.compressor.compress(data)
+        self.uncompressed_bytes += len(data)
+        self.compressed_bytes += len(compressed)
+        metrics.UNCOMPRESSED_BYTES.inc(len(data))
+        metrics.COMPRESSED_BYTES.inc(len(compressed))
+        return compressed
+
+    @property
+    def pending_bytes(self):
+        """
+        :return: bytes coalesced, aggregated or batched but not sent yet.
+        """
+        pending = self._batch_bytes + sum(record_agg.get_size_bytes() for record_agg in self._aggregators()
+                                          if record_agg.get_num_user_records())
+        if self.coalescer is not None:
+            pending += self.coalescer.pending_bytes
+        return pending
+
+    @property
+    def pending_records(self):
+        """
+        :return: user records coalesced, aggregated or batched but not sent yet.
+        """
+        pending = (sum(agg_record.get_num_user_records() for agg_record, _, _ in self._batch) +
+                   sum(record_agg.get_num_user_records() for record_agg in self._aggregators()))
+        if self.coalescer is not None:
+            pending += self.coalescer.pending_count
+        return pending
+
+    def _agg_contents(self, agg_record):
+        """
+        :return: agg_record's partition key, explicit hash key and data, compressed
+                 unless user records are.
+        """
+        pk, ehk, data = agg_record.get_contents()
+        if self.compressor and not self.compress_records:
+            data = self._compress(data)
+        return pk, ehk, data
+
+    def _load_shard_map(self):
+        """
+        Reads the hash key ranges of the open shards. Every aggregate is sent with the
+        starting hash key of one shard as its ExplicitHashKey so all of its user
+        records land on that shard. A stale map after resharding still routes each
+        aggregate to a single shard, it is only less evenly spread.
+        """
+        starts = []
+        for page in self._kinesis.get_paginator('describe_stream').paginate(StreamName=self.stream_name):
+            for shard in page['StreamDescription']['Shards']:
+                if 'EndingSequenceNumber' not in shard['SequenceNumberRange']:
+                    starts.append(int(shard['HashKeyRange']['StartingHashKey']))
+
+        self._shard_starts = sorted(starts)
+        logger.info('Partitioning by key over %s shards' % len(self._shard_starts))
+
+    @staticmethod
+    def partition_key(change):
+        """
+        :return: md5 hex digest of a Change's table and primary key. FullChanges do
+                 not carry a primary key so fall back to their schema qualified table.
+        """
+        if hasattr(change, 'pkey'):
+            pkey = ','.join(change.pkey) if isinstance(change.pkey, list) else change.pkey
+            key = '{}:{}'.format(change.table, pkey)
+        else:
+            key = '{}.{}'.format(change.change.get('schema'), change.change.get('table'))
+
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
 
-        if fmt_msg:
-            agg_record = self._record_agg.add_user_record(str(fmt_msg.change.xid), fmt_msg.fmt_msg)
+    def _shard_for(self, partition_key):
+        # Same mapping as Kinesis: the md5 of the partition key as a 128 bit integer.
+        hash_key = int(partition_key, 16)
+        return max(bisect.bisect_right(self._shard_starts, hash_key) - 1, 0)
 
-        # agg_record will be a complete record if aggregation is full.
-        if agg_record or (self._send_window and time.time() - self.last_send > self._send_window):
-            agg_record = agg_record if agg_record else self._record_agg.clear_and_get()
-            self._send_agg_record(agg_record)
-            self.last_send = time.time()
+    def _aggregators(self):
+        if self.partition_by == 'key':
+            return list(self._shard_aggs.values())
+        return [self._record_agg]
+
+    def _add_user_record(self, fmt_msg):
+        """
+        :return: tuple of the aggregator fmt_msg was added to and the full aggregate
+                 record it returned, if any.
+        """
+        data = fmt_msg.fmt_msg
+        if self.compressor and self.compress_records:
+            data = self._compress(data)
+
+        if self.partition_by != 'key':
+            return self._record_agg, self._record_agg.add_user_record(str(fmt_msg.change.xid), data)
+
+        pk = self.partition_key(fmt_msg.change)
+        shard = self._shard_for(pk)
+        try:
+            record_agg = self._shard_aggs[shard]
+        except KeyError:
+            record_agg = self._shard_aggs[shard] = aws_kinesis_agg.aggregator.RecordAggregator()
+
+        return record_agg, record_agg.add_user_record(pk, data, str(self._shard_starts[shard]))
+
+    def _aggregate(self, fmt_msg, lsn):
+        """
+        :return: tuple of the full aggregate record adding fmt_msg returned, if any,
+                 and the LSNs of the messages in it.
+        """
+        record_agg, agg_record = self._add_user_record(fmt_msg)
+        lsns = self._agg_lsns.setdefault(record_agg, [])
+        if agg_record:
+            # A full aggregate does not contain fmt_msg, only what came before it.
+            self._agg_lsns[record_agg] = []
+        if isinstance(lsn, list):
+            self._agg_lsns[record_agg].extend(lsn)
+        elif lsn is not None:
+            self._agg_lsns[record_agg].append(lsn)
+        return agg_record, lsns
+
+    def put_message(self, fmt_msg, lsn=None):
+        """
+        Adds fmt_msg to the current aggregate and sends the aggregate if it is full
+        or everything pending if the flush policy says so.
+
+        :param fmt_msg: a formatter Message or None to only check the flush policy.
+        :param lsn: optional LSN of the replication message fmt_msg came from, it is
+                    acknowledged to the tracker once fmt_msg has been delivered. A
+                    list of LSNs for messages packing several, see grouping.
+        :return: the aggregate record sent, if any. In batch mode, or when the flush
+                 policy flushed, the list of aggregate records sent.
+        """
+        if fmt_msg and self.coalescer is not None:
+            # Aggregated when flushed.
+            self.coalescer.add(fmt_msg, lsn)
+            if self.coalescer.full:
+                return self.flush('size')
+        elif fmt_msg:
+            agg_record, lsns = self._aggregate(fmt_msg, lsn)
+            # agg_record will be a complete record if aggregation is full.
+            if agg_record:
+                if not self.batch:
+                    metrics.FLUSHES.labels('size').inc()
+                return self._send(agg_record, lsns)
+
+        reason = self.flush_policy.flush_reason(self, time.time() - self.last_send)
+        if reason:
+            return self.flush(reason)
+
+        return None
+
+    def flush(self, reason='manual'):
+        """
+        Sends everything coalesced, aggregated or batched so far regardless of the
+        flush policy.
+
+        :param reason: why, counted in the flushes metric if anything was sent.
+        :return: list of aggregate records sent, or None.
+        """
+        sent = []
+        if self.coalescer is not None:
+            for fmt_msg, lsns in self.coalescer.drain():
+                agg_record, agg_lsns = self._aggregate(fmt_msg, lsns)
+                if agg_record and self.batch:
+                    sent.extend(self._send(agg_record, agg_lsns) or [])
+                elif agg_record:
+                    sent.append(self._send(agg_record, agg_lsns))
+
+        for record_agg in self._aggregators():
+            agg_record = record_agg.clear_and_get()
+            lsns = self._agg_lsns.pop(record_agg, [])
+            if agg_record is None:
+                continue
+
+            if self.batch:
+                sent.extend(self._put_batch(agg_record, lsns) or [])
+            else:
+                sent.append(self._send(agg_record, lsns))
+
+        if self.batch:
+            sent.extend(self._put_batch(None, None, flush=True) or [])
+
+        if sent:
+            metrics.FLUSHES.labels(reason).inc()
+        self.last_send = time.time()
+        return sent or None
+
+    def close(self):
+        """
+        Sends whatever is still pending.
+        """
+        self.flush('shutdown')
+
+    def _send(self, agg_record, lsns):
+        if self.batch:
+            return self._put_batch(agg_record, lsns)
+
+        self._send_agg_record(agg_record)
+        self.last_send = time.time()
+        self.tracker.ack(lsns)
 
         return agg_record
 
+    def _put_batch(self, agg_record, lsns, flush=False):
+        """
+        Adds agg_record to the pending PutRecords batch, sending the batch first if
+        agg_record would push it over the request limits and afterwards if flush.
+
+        :return: list of aggregate records sent, or None.
+        """
+        sent = []
+
+        if agg_record is not None:
+            pk, ehk, data = self._agg_contents(agg_record)
+            size = len(pk) + len(data)
+            metrics.AGGREGATE_BYTES.observe(len(data))
+            entry = {'Data': data, 'PartitionKey': pk}
+            if ehk:
+                entry['ExplicitHashKey'] = ehk
+
+            if self._batch and (len(self._batch) >= MAX_RECORDS_PER_BATCH or
+                                self._batch_bytes + size > MAX_BYTES_PER_BATCH):
+                metrics.FLUSHES.labels('size').inc()
+                sent.extend(self._flush_batch())
+
+            self._batch.append((agg_record, entry, lsns))
+            self._batch_bytes += size
+
+        if flush:
+            sent.extend(self._flush_batch())
+        elif len(self._batch) >= MAX_RECORDS_PER_BATCH:
+            metrics.FLUSHES.labels('size').inc()
+            sent.extend(self._flush_batch())
+
+        return sent or None
+
+    def _flush_batch(self):
+        batch = self._batch
+        self._batch = []
+        self._batch_bytes = 0
+
+        self._send_batch([entry for _, entry, _ in batch])
+        self.last_send = time.time()
+        for _, _, lsns in batch:
+            self.tracker.ack(lsns)
+
+        return [agg_record for agg_record, _, _ in batch]
+
     def _send_agg_record(self, agg_record):
         if agg_record is None:
             return
 
-        pk, _, data = agg_record.get_contents()
+        pk, ehk, data = self._agg_contents(agg_record)
         logger.info('Sending %s records. Size %s. PK: %s' %
-                    (agg_record.get_num_user_records(), agg_record.get_size_bytes(), pk))
+                    (agg_record.get_num_user_records(), len(data), pk))
+        if self.compressor:
+            logger.info('Compression ratio: %.2f' % self.compression_ratio)
+        metrics.AGGREGATE_BYTES.observe(len(data))
+
+        if self.spill_log is not None and self.spill_log.pending_count:
+            # Behind what was spilled already.
+            self._spill([(pk, ehk, data)])
+        else:
+            self.put_record(pk, ehk, data, spill=self.spill_log is not None)
+
+    def put_record(self, pk, ehk, data, spill=False):
+        """
+        Sends one record with PutRecord, backing off while throttled.
 
+        :param spill: append the record to the spill log instead of backing off, or
+                      if Kinesis cannot be reached.
+        """
+        kwargs = {}
+        if ehk:
+            kwargs['ExplicitHashKey'] = ehk
+
+        put_seconds = metrics.PUT_SECONDS.labels('put_record')
         back_off = .05
         while back_off < self.back_off_limit:
+            start = timer()
             try:
                 result = self._kinesis.put_record(Data=data,
                                                   PartitionKey=pk,
-                                                  SequenceNumberForOrdering=self._sequence_number_for_ordering,
-                                                  StreamName=self.stream_name)
+                                                  SequenceNumberForOrdering=self._sequence_numbers.get(
+                                                      ehk, self._sequence_number_for_ordering),
+                                                  StreamName=self.stream_name,
+                                                  **kwargs)
 
+            except BotoCoreError as e:
+                if not spill:
+                    raise
+                logger.warning(e)
+                return self._spill([(pk, ehk, data)])
             except ClientError as e:
+                put_seconds.observe(timer() - start)
                 if e.response['Error']["Code"] == 'ProvisionedThroughputExceededException':
+                    metrics.THROTTLE_RETRIES.inc()
+                    if spill:
+                        return self._spill([(pk, ehk, data)])
                     back_off *= 2
                     logger.warning('Provisioned throughput exceeded: sleeping %ss' % back_off)
                     time.sleep(back_off)
@@ -68,7 +542,298 @@ class StreamWriter(object):
                     logger.error(e)
                     raise
             else:
+                put_seconds.observe(timer() - start)
                 logger.debug('Sequence number: %s' % result['SequenceNumber'])
+                if ehk:
+                    # Strictly order aggregates pinned to the same shard.
+                    self._sequence_numbers[ehk] = result['SequenceNumber']
                 break
         else:
             raise Exception('ProvisionedThroughputExceededException caused a backed off too many times!')
+
+    def _send_batch(self, records):
+        """
+        Sends records with PutRecords. After a partially failed response the failed
+        entries are retried, using the same back off as _send_agg_record, or spilled
+        with a spill log. So that they stay in order, every entry following a failed
+        one to the same explicit hash key, or partition key without one, goes with
+        them even if it was accepted, and may then be delivered twice.
+        """
+        if not records:
+            return
+
+        logger.info('Sending batch of %s aggregate records.' % len(records))
+        if self.compressor:
+            logger.info('Compression ratio: %.2f' % self.compression_ratio)
+
+        spill = self.spill_log is not None
+        if spill and self.spill_log.pending_count:
+            return self._spill_entries(records)
+
+        put_seconds = metrics.PUT_SECONDS.labels('put_records')
+        back_off = .05
+        while back_off < self.back_off_limit:
+            start = timer()
+            try:
+                result = self._kinesis.put_records(Records=records, StreamName=self.stream_name)
+            except BotoCoreError as e:
+                if not spill:
+                    raise
+                logger.warning(e)
+                return self._spill_entries(records)
+            except ClientError as e:
+                put_seconds.observe(timer() - start)
+                if e.response['Error']["Code"] == 'ProvisionedThroughputExceededException':
+                    metrics.THROTTLE_RETRIES.inc()
+                    if spill:
+                        return self._spill_entries(records)
+                    back_off *= 2
+                    logger.warning('Provisioned throughput exceeded: sleeping %ss' % back_off)
+                    time.sleep(back_off)
+                else:
+                    logger.error(e)
+                    raise
+            else:
+                put_seconds.observe(timer() - start)
+                if not result.get('FailedRecordCount'):
+                    break
+
+                records = self._failed_entries(records, result['Records'])
+                metrics.THROTTLE_RETRIES.inc(len(records))
+                if spill:
+                    return self._spill_entries(records)
+                back_off *= 2
+                logger.warning('%s records failed: sleeping %ss' % (len(records), back_off))
+                time.sleep(back_off)
+        else:
+            raise Exception('ProvisionedThroughputExceededException caused a backed off too many times!')
+
+    @staticmethod
+    def _failed_entries(entries, results):
+        """
+        :return: the entries that failed and those after them with the same key.
+        """
+        failed_keys = set()
+        failed = []
+        for entry, result in zip(entries, results):
+            key = entry.get('ExplicitHashKey') or entry['PartitionKey']
+            if result.get('ErrorCode') or key in failed_keys:
+                failed_keys.add(key)
+                failed.append(entry)
+        return failed
+
+    def _spill_entries(self, entries):
+        self._spill([(entry['PartitionKey'], entry.get('ExplicitHashKey'), entry['Data']) for entry in entries])
+
+    def _spill(self, records):
+        """
+        Appends records of (partition key, explicit hash key, data) to the spill log,
+        returning once they are on disk.
+        """
+        if not self.spill_log.pending_count:
+            logger.warning('Kinesis is not keeping up, spilling to %s' % self.spill_log.directory)
+        for pk, ehk, data in records:
+            self.spill_log.append(pk, ehk, data)
+        metrics.SPILLED_RECORDS.inc(len(records))
+
+
+class SendQueue(object):
+    """
+    FIFO bounded by both the number of items and their total size in bytes.
+
+    A put only blocks once either cap is reached. An item is always accepted into
+    an empty queue so that a single oversized message cannot wedge the pipeline.
+    Once the consumer closed the queue with an error, put raises it instead.
+    """
+    def __init__(self, max_count, max_bytes):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.count = 0
+        self.bytes = 0
+
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._error = None
+
+    def _is_full(self):
+        return self.count and (self.count >= self.max_count or self.bytes >= self.max_bytes)
+
+    def put(self, item, size):
+        with self._cond:
+            while True:
+                if self._error is not None:
+                    raise self._error
+                if not self._is_full():
+                    break
+                self._cond.wait()
+
+            self._items.append((item, size))
+            self.count += 1
+            self.bytes += size
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        :return: the oldest item, or None if nothing arrived within timeout seconds.
+        """
+        with self._cond:
+            if not self._items:
+                self._cond.wait(timeout)
+                if not self._items:
+                    return None
+
+            item, size = self._items.popleft()
+            self.count -= 1
+            self.bytes -= size
+            self._cond.notify_all()
+
+            return item
+
+    def close(self, error):
+        """
+        Wakes up blocked puts, which raise error as will any later put.
+        """
+        with self._cond:
+            self._error = error
+            self._cond.notify_all()
+
+
+class PipelinedStreamWriter(object):
+    """
+    Decouples the replication stream from Kinesis by putting messages on a bounded
+    SendQueue that a background thread drains into a StreamWriter.
+
+    The replication callback is only held up once the queue is full, so throttling
+    back offs no longer stop keepalives from reaching postgres. Only messages the
+    sender actually delivered are acknowledged to the tracker.
+
+    The sender checks the flush policy at least every poll_interval seconds.
+    """
+    def __init__(self, writer, max_queue_count=10000, max_queue_bytes=64 * 1048576, poll_interval=1):
+        self.writer = writer
+        self.poll_interval = poll_interval
+
+        self._queue = SendQueue(max_queue_count, max_queue_bytes)
+        self._error = None
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pg2kinesis-sender')
+        self._thread.daemon = True
+
+    @property
+    def tracker(self):
+        return self.writer.tracker
+
+    @property
+    def queued_count(self):
+        return self._queue.count
+
+    @property
+    def queued_bytes(self):
+        return self._queue.bytes
+
+    @property
+    def pending_bytes(self):
+        return self._queue.bytes + self.writer.pending_bytes
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def put_message(self, fmt_msg, lsn=None):
+        # Surface sender failures on the replication thread so the process stops.
+        if self._error is not None:
+            raise self._error
+
+        size = len(fmt_msg.fmt_msg) if fmt_msg else 0
+        self._queue.put((fmt_msg, lsn), size)
+
+    def _run(self):
+        try:
+            while not self._stopping.is_set():
+                item = self._queue.get(self.poll_interval)
+                if item is None:
+                    # Nothing new, give the flush policy a chance to flush.
+                    self.writer.put_message(None)
+                else:
+                    self.writer.put_message(*item)
+        except Exception as e:
+            logger.exception('Sender thread failed')
+            self._error = e
+            # Fail a replication thread waiting on a full queue rather than hang it.
+            self._queue.close(e)
+
+    def close(self, timeout=None):
+        """
+        Stops the sender, then sends what is still queued or pending unless the
+        sender failed or did not stop within timeout seconds.
+        """
+        self._stopping.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        if self._error is not None or self._thread.is_alive():
+            return
+
+        item = self._queue.get(0)
+        while item is not None:
+            self.writer.put_message(*item)
+            item = self._queue.get(0)
+        self.writer.close()
+
+
+class RoutingStreamWriter(object):
+    """
+    Puts every message to one of several writers chosen by its table, so a busy
+    table can be sent to a Kinesis stream of its own without holding up the rest.
+    The writers share one tracker, so an LSN is only acknowledged once all the
+    writers its messages went to delivered them.
+    """
+    def __init__(self, routes, default):
+        """
+        :param routes: list of (table pattern, writer). Messages go to the writer of
+                       the first pattern matching their whole schema qualified table.
+        :param default: writer for tables no pattern matches.
+        """
+        self.routes = [(re.compile(r'(?:{})\Z'.format(pattern)), writer) for pattern, writer in routes]
+        self.default = default
+        self.writers = [default]
+        for _, writer in routes:
+            if writer not in self.writers:
+                self.writers.append(writer)
+
+        if any(writer.tracker is not default.tracker for writer in self.writers):
+            raise ValueError('Routed writers must share their tracker')
+
+        # table -> writer
+        self._table_writers = {}
+
+    @property
+    def tracker(self):
+        return self.default.tracker
+
+    @property
+    def pending_bytes(self):
+        return sum(writer.pending_bytes for writer in self.writers)
+
+    def writer_for(self, table):
+        try:
+            return self._table_writers[table]
+        except KeyError:
+            writer = next((writer for pattern, writer in self.routes if pattern.match(table)), self.default)
+            return self._table_writers.setdefault(table, writer)
+
+    def put_message(self, fmt_msg, lsn=None):
+        """
+        :param fmt_msg: a formatter Message, or None to give every writer a chance
+                        to flush.
+        :return: what the writer returned, None if fmt_msg is None.
+        """
+        if fmt_msg is None:
+            for writer in self.writers:
+                writer.put_message(None)
+            return None
+
+        return self.writer_for(fmt_msg.change.table).put_message(fmt_msg, lsn)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
@@ -0,0 +1,62 @@
+from collections import deque
+import threading
+
+
+class LSNTracker(object):
+    """
+    In flight window of replication messages, in the order they were read.
+
+    Consume adds every replication message with the number of Kinesis messages
+    it produced and writers acknowledge the LSN of every message once the
+    aggregate holding it has been delivered. acked_lsn is the highest LSN for
+    which it and everything read before it has been delivered, no matter in
+    which order aggregates complete. It is safe to use from several threads.
+    """
+    def __init__(self):
+        self.received_lsn = None
+        self.acked_lsn = None
+
+        self._lock = threading.Lock()
+        # [lsn, messages not yet delivered] oldest first.
+        self._window = deque()
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._window)
+
+    def add(self, lsn, count=1):
+        """
+        :param lsn: LSN of a replication message, never lower than the previous one.
+        :param count: how many messages it was put to writers as. 0 if none, e.g. for
+                      BEGIN or filtered changes, which are acknowledged as soon as
+                      everything before them is.
+        """
+        with self._lock:
+            if self._window and self._window[-1][0] == lsn:
+                self._window[-1][1] += count
+            else:
+                entry = [lsn, count]
+                self._window.append(entry)
+                self._entries[lsn] = entry
+
+            self.received_lsn = lsn
+            self._advance()
+
+    def ack(self, lsns):
+        """
+        :param lsns: LSN of each delivered message, repeated once per message.
+        """
+        if not lsns:
+            return
+
+        with self._lock:
+            for lsn in lsns:
+                self._entries[lsn][1] -= 1
+            self._advance()
+
+    def _advance(self):
+        while self._window and self._window[0][1] <= 0:
+            lsn, _ = self._window.popleft()
+            # Equal LSNs share an entry, so this is the only one for lsn.
+            del self._entries[lsn]
+            self.acked_lsn = lsn
@@ -41,6 +41,11 @@ INSTALL_REQUIRES = [
     'psycopg2>=2.7.4',
 ]
 
+EXTRAS_REQUIRE = {
+    'msgpack': ['msgpack>=0.5.0'],
+    'zstd': ['zstandard>=0.9.0'],
+}
+
 ###############################################################################
 
 HERE = os.path.abspath(os.path.dirname(__file__))
@@ -92,6 +97,7 @@ if __name__ == "__main__":
         zip_safe=True,
         classifiers=CLASSIFIERS,
         install_requires=INSTALL_REQUIRES,
+        extras_require=EXTRAS_REQUIRE,
         entry_points={
             'console_scripts': ['pg2kinesis=pg2kinesis.__main__:main'],
         }
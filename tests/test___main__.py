@@ -1,16 +1,21 @@
 from __future__ import unicode_literals
+import time
 
+import click
 from mock import Mock, call, patch
+import pytest
 
-from pg2kinesis.__main__ import Consume
-from pg2kinesis.formatter import Message, Change, FullChange
+from pg2kinesis import metrics
+from pg2kinesis.__main__ import Consume, compression_ratio, parse_stream_routes
+from pg2kinesis.formatter import CSVFormatter, Message, Change, FullChange
+from pg2kinesis.grouping import TransactionGrouper
+from pg2kinesis.tracker import LSNTracker
 
 
 def test_consume():
-    mock_formatter = Mock(return_value='fmt_msg')
-    # required to avoid formatting error if cur_xact is logged
-    mock_formatter.cur_xact = 'TEST_TRANSACTION'
-    mock_writer = Mock()
+    fmt_msgs = [Message(Change(1, 'public.blue', 'insert', '1'), 'fmt_msg')] * 7
+    mock_formatter = Mock(return_value=fmt_msgs)
+    mock_writer = Mock(tracker=LSNTracker())
 
     consume = Consume(mock_formatter, mock_writer, ['insert', 'update', 'delete', 'truncate'])
 
@@ -21,40 +26,44 @@ def test_consume():
 
     mock_writer.put_message = Mock(return_value=False)
     consume.should_send_to_kinesis = Mock(return_value=True)
+    consume.last_feedback = time.time()
     consume(mock_change)
     assert mock_writer.put_message.called, 'Sanity'
-    assert call.cursor.send_feedback(flush_lsn=10) not in mock_change.mock_calls, \
-        'we did not send feedback!'
+    assert not mock_change.cursor.send_feedback.called, 'we did not send feedback!'
 
+    mock_writer.tracker.ack([10] * len(fmt_msgs))
     mock_writer.put_message = Mock(return_value=True)
+    mock_change.data_start = 11
     consume(mock_change)
     assert mock_writer.put_message.called, 'Sanity'
-    assert call.cursor.send_feedback(flush_lsn=10) in mock_change.mock_calls, \
-        'we sent feedback!'
+    assert call.cursor.send_feedback(write_lsn=11, flush_lsn=10, apply_lsn=10) in mock_change.mock_calls, \
+        'we sent feedback for what was acknowledged!'
 
 
-    mock_time = Mock()
-    mock_time.return_value = 11.0
+def test_consume_metrics():
+    fmt_msgs = [Message(Change(1, 'public.blue', 'insert', '1'), 'fmt_msg'),
+                Message(FullChange(1, {'kind': 'delete', 'schema': 'public', 'table': 'red'}), 'full_msg'),
+                Message(Change(1, 'public.blue', 'update', '1'), 'filtered')]
+    mock_writer = Mock(tracker=LSNTracker())
+    consume = Consume(Mock(return_value=fmt_msgs), mock_writer, ['insert', 'delete'])
 
-    consume.msg_window_size = 0
-    consume.msg_window_count = 0
-    consume.cur_window = 10
-    with patch('time.time', mock_time):
-        consume(mock_change)
-        assert consume.cur_window == 10, 'cur window not updated if time is non-10-multiple'
-        assert consume.msg_window_size == 100, 'msg_window_size not reset if time is non-10-multiple'
-        assert consume.msg_window_count == 1, 'msg_window_count not reset if time is non-10-multiple'
+    replication_messages = metrics.REPLICATION_MESSAGES.labels().value
+    replication_bytes = metrics.REPLICATION_BYTES.labels().value
+    formatted = metrics.FORMAT_SECONDS.labels().counts[:]
+    blue = metrics.MESSAGES.labels('public.blue', 'insert').value
+    blue_bytes = metrics.MESSAGE_BYTES.labels('public.blue', 'insert').value
+    red = metrics.MESSAGES.labels('public.red', 'delete').value
 
-    mock_time.return_value = 20.0
-    with patch('time.time', mock_time):
-        consume(mock_change)
-        assert consume.cur_window == 20, 'cur window updated if time is multiple of 10'
-        assert consume.msg_window_size == 0, 'msg_window_size reset if time is multiple of 10'
-        assert consume.msg_window_count == 0, 'msg_window_count reset if time is multiple of 10'
+    for data_start in (10, 11):
+        consume(Mock(data_start=data_start, data_size=100, payload='PAYLOAD'))
 
-    with patch('time.time', mock_time):
-        consume(mock_change)
-        assert consume.msg_window_size == 100, 'msg_window_size not reset if time is same as cur_window'
+    assert metrics.REPLICATION_MESSAGES.labels().value == replication_messages + 2
+    assert metrics.REPLICATION_BYTES.labels().value == replication_bytes + 200
+    assert sum(metrics.FORMAT_SECONDS.labels().counts) == sum(formatted) + 2
+    assert metrics.MESSAGES.labels('public.blue', 'insert').value == blue + 2
+    assert metrics.MESSAGE_BYTES.labels('public.blue', 'insert').value == blue_bytes + 14
+    assert metrics.MESSAGES.labels('public.red', 'delete').value == red + 2
+    assert ('public.blue', 'update') not in consume._message_metrics, 'Filtered messages not counted'
 
 
 def test_consume_excludes():
@@ -71,13 +80,14 @@ def test_consume_excludes():
     ])
     mock_formatter.cur_xact = 'TEST_TRANSACTION'
     mock_change = Mock(data_start=10, data_size=100, payload='PAYLOAD')
-    mock_writer = Mock()
+    mock_writer = Mock(tracker=LSNTracker())
     mock_writer.put_message.return_value = False
 
     consume = Consume(mock_formatter, mock_writer, ['delete'])
     consume(mock_change)
 
-    mock_writer.put_message.assert_has_calls([call(None), call(None)])
+    mock_writer.put_message.assert_not_called()
+    assert mock_writer.tracker.acked_lsn == 10, 'Nothing to deliver so acknowledged right away'
 
 
 def test_consume_includes():
@@ -96,11 +106,164 @@ def test_consume_includes():
     mock_formatter.cur_xact = 'TEST_TRANSACTION'
     mock_change = Mock(data_start=10, data_size=100, payload='PAYLOAD', cursor=Mock())
     mock_change.cursor.send_feedback.return_value = True
-    mock_writer = Mock()
-    mock_writer.put_message.return_value = True
+    mock_writer = Mock(tracker=LSNTracker())
+    mock_writer.put_message.side_effect = lambda msg, lsn: mock_writer.tracker.ack([lsn])
 
     consume = Consume(mock_formatter, mock_writer, ['delete'])
     consume(mock_change)
 
-    mock_writer.put_message.assert_has_calls([call(msg) for msg in formatted_messages])
-    mock_change.cursor.send_feedback.assert_has_calls([call(flush_lsn=mock_change.data_start)])
+    mock_writer.put_message.assert_has_calls([call(msg, 10) for msg in formatted_messages])
+    mock_change.cursor.send_feedback.assert_has_calls([call(write_lsn=10, flush_lsn=10, apply_lsn=10)])
+
+
+def test_consume_feedback():
+    formatted_messages = [Message(Change(1, 'my_table', 'insert', 1), 'formatted_message1')]
+    mock_formatter = Mock(return_value=formatted_messages)
+    mock_formatter.cur_xact = 'TEST_TRANSACTION'
+    mock_writer = Mock(tracker=LSNTracker())
+
+    consume = Consume(mock_formatter, mock_writer, ['insert'], feedback_interval=10)
+    cursor = Mock()
+
+    with patch('time.time', Mock(return_value=100.0)):
+        consume(Mock(data_start=10, data_size=100, payload='PAYLOAD', cursor=cursor))
+        consume(Mock(data_start=20, data_size=100, payload='PAYLOAD', cursor=cursor))
+    assert cursor.send_feedback.call_args_list == [call(write_lsn=10, flush_lsn=0, apply_lsn=0)], \
+        'Keepalive on first message only, nothing acknowledged'
+
+    mock_writer.tracker.ack([20])
+    with patch('time.time', Mock(return_value=101.0)):
+        consume.send_feedback(cursor)
+    assert cursor.send_feedback.call_count == 1, 'Out of order acknowledgement does not move flush'
+
+    mock_writer.tracker.ack([10])
+    with patch('time.time', Mock(return_value=102.0)):
+        consume.send_feedback(cursor)
+    cursor.send_feedback.assert_called_with(write_lsn=20, flush_lsn=20, apply_lsn=20)
+
+    with patch('time.time', Mock(return_value=111.0)):
+        consume.send_feedback(cursor)
+    assert cursor.send_feedback.call_count == 2, 'Within the interval'
+
+    with patch('time.time', Mock(return_value=112.0)):
+        consume.send_feedback(cursor)
+    assert cursor.send_feedback.call_count == 3, 'Keepalive after the interval'
+
+
+def test_consume_tick():
+    tracker = LSNTracker()
+    mock_writer = Mock(tracker=tracker)
+    mock_writer.put_message.side_effect = lambda msg: tracker.ack([10])
+    tracker.add(10)
+
+    consume = Consume(Mock(), mock_writer, ['insert'])
+    cursor = Mock()
+    consume.tick(cursor)
+
+    mock_writer.put_message.assert_called_once_with(None)
+    cursor.send_feedback.assert_called_once_with(write_lsn=10, flush_lsn=10, apply_lsn=10)
+
+
+def test_consume_streamed_formatter():
+    tracker = LSNTracker()
+    mock_writer = Mock(tracker=tracker)
+    mock_writer.put_message.side_effect = lambda msg, lsn: tracker.ack([lsn])
+    seen = []
+
+    def formatter(payload):
+        for i in range(3):
+            yield Message(Change(1, 'my_table', 'insert', i), 'formatted_message')
+            seen.append(tracker.acked_lsn)
+
+    mock_formatter = Mock(side_effect=formatter)
+    mock_formatter.cur_xact = 'TEST_TRANSACTION'
+
+    consume = Consume(mock_formatter, mock_writer, ['insert'])
+    consume(Mock(data_start=10, data_size=100, payload='PAYLOAD'))
+
+    assert mock_writer.put_message.call_count == 3
+    assert seen == [None, None, None], 'Not acknowledged while the formatter could still yield'
+    assert tracker.acked_lsn == 10
+
+
+def test_parallel_consume():
+    from pg2kinesis.__main__ import ParallelConsume
+    tracker = LSNTracker()
+    mock_writer = Mock(tracker=tracker)
+    mock_writer.put_message.side_effect = lambda msg, lsn=None: msg and tracker.ack([lsn])
+    msg = Message(Change(1, 'my_table', 'insert', 1), 'formatted_message')
+
+    pool = Mock()
+    pool.results.return_value = iter([])
+    consume = ParallelConsume(pool, mock_writer, ['insert'])
+    cursor = Mock()
+    consume(Mock(data_start=10, data_size=100, payload='PAYLOAD1', cursor=cursor))
+    consume(Mock(data_start=20, data_size=100, payload='PAYLOAD2', cursor=cursor))
+
+    assert pool.put.call_args_list == [call('PAYLOAD1', 10), call('PAYLOAD2', 20)]
+    assert not mock_writer.put_message.called
+    assert tracker.acked_lsn is None, 'Held back while formatting'
+
+    pool.results.return_value = iter([(10, [msg]), (20, [])])
+    consume.tick(cursor)
+    assert pool.submit.called, 'Partial batches submitted on tick'
+    mock_writer.put_message.assert_any_call(msg, 10)
+    assert tracker.acked_lsn == 20
+    cursor.send_feedback.assert_called_with(write_lsn=20, flush_lsn=20, apply_lsn=20)
+
+    pool.results.return_value = iter([])
+    consume.close()
+    pool.results.assert_called_with(True)
+    assert pool.close.called
+
+
+def test_consume_grouped():
+    tracker = LSNTracker()
+    mock_writer = Mock(tracker=tracker)
+    formatter = CSVFormatter({})
+    formatter_results = {
+        'BEGIN 1': [],
+        'ROW 1': [formatter.produce_formatted_message(Change(1, 'public.blue', 'insert', '1'))],
+        'ROW 2': [formatter.produce_formatted_message(Change(1, 'public.blue', 'delete', '2'))],
+        'COMMIT 1': [],
+    }
+    mock_formatter = Mock(side_effect=lambda payload: formatter_results[payload],
+                          ends_transaction=lambda payload: payload.startswith('COMMIT'))
+
+    consume = Consume(mock_formatter, mock_writer, ['insert', 'delete'], grouper=TransactionGrouper(formatter))
+    cursor = Mock()
+    for lsn, payload in enumerate(['BEGIN 1', 'ROW 1', 'ROW 2']):
+        consume(Mock(data_start=lsn, data_size=10, payload=payload, cursor=cursor))
+    assert not mock_writer.put_message.called, 'Held until the commit'
+    assert tracker.acked_lsn == 0, 'Rows held until their group is delivered'
+
+    consume(Mock(data_start=3, data_size=10, payload='COMMIT 1', cursor=cursor))
+    [(group_msg, lsns)] = [c[0] for c in mock_writer.put_message.call_args_list]
+    assert lsns == [1, 2]
+    assert group_msg.change.count == 2
+    assert tracker.acked_lsn == 0
+
+    tracker.ack(lsns)
+    assert tracker.acked_lsn == 3
+
+
+def test_parse_stream_routes():
+    assert parse_stream_routes(None, None, ()) == []
+    assert parse_stream_routes(None, None, (r'public\.audit_.*=audit', r'(?P<a>x)|y==z')) == [
+        (r'public\.audit_.*', 'audit'), (r'(?P<a>x)|y=', 'z')]
+
+    for value in ('audit', '=audit', 'public.audit=', '(=audit'):
+        with pytest.raises(click.BadParameter):
+            parse_stream_routes(None, None, (value,))
+
+
+def test_compression_ratio():
+    assert compression_ratio([Mock(compressed_bytes=0, uncompressed_bytes=0)]) is None
+    assert compression_ratio([Mock(compressed_bytes=10, uncompressed_bytes=40),
+                              Mock(compressed_bytes=10, uncompressed_bytes=20)]) == 3
+
+
+def test_should_send_to_kinesis():
+    consume = Consume(Mock(), Mock(), ['insert'])
+    assert consume.should_send_to_kinesis(Message(Change(1, 'my_table', 'INSERT', 1), ''))
+    assert not consume.should_send_to_kinesis(Message(Change(1, 'my_table', 'DELETE', 1), ''))
@@ -0,0 +1,37 @@
+from mock import patch
+import pytest
+
+from pg2kinesis import compression
+from pg2kinesis.compression import HEADER_MAGIC, GzipCompressor, decompress, get_compressor
+
+DATA = b'0,CDC,{"xid": 1, "table": "public.blue", "operation": "insert", "pkey": "1"}' * 50
+
+
+@pytest.mark.parametrize('name', ['gzip', 'zstd'])
+def test_round_trip(name):
+    if name == 'zstd':
+        pytest.importorskip('zstandard')
+
+    compressor = get_compressor(name)
+    assert compressor.name == name
+
+    compressed = compressor.compress(DATA)
+    assert compressed.startswith(HEADER_MAGIC + compressor.codec_id)
+    assert len(compressed) < len(DATA) / 10
+    assert decompress(compressed) == DATA
+
+
+def test_get_compressor():
+    assert get_compressor('gzip', 9).level == 9
+
+    with patch.object(compression, 'zstandard', None):
+        assert isinstance(get_compressor('zstd'), GzipCompressor), 'Falls back to gzip'
+
+    with pytest.raises(ValueError):
+        get_compressor('lz4')
+
+
+def test_decompress_uncompressed():
+    assert decompress(DATA) == DATA
+    assert decompress(b'') == b''
+    assert decompress(b'\xf3\x89\x9a\xc2kpl') == b'\xf3\x89\x9a\xc2kpl', 'KPL aggregates pass through'
@@ -1,12 +1,16 @@
 # coding=utf-8
 from __future__ import unicode_literals
 import json
+import re
 
 import mock
 import pytest
 
 from pg2kinesis.slot import PrimaryKeyMapItem
-from pg2kinesis.formatter import Change, CSVFormatter, CSVPayloadFormatter, Formatter, get_formatter
+from pg2kinesis.formatter import Change, FullChange, CSVFormatter, CSVPayloadFormatter, Formatter, \
+    MessagePackFormatter, get_formatter, \
+    compile_test_decoding_key_pattern, read_test_decoding_value, TupleKeyReader
+from pg2kinesis.json_codec import get_json_codec
 
 
 def get_formatter_produce_formatted_message(cls):
@@ -32,8 +36,8 @@ def test_CSVPayloadFormatter_produce_formatted_message():
 
 @pytest.fixture
 def pkey_map():
-    return {'public.test_table': PrimaryKeyMapItem(u'public.test_table', u'uuid', u'uuid', 0),
-            'public.test_table2': PrimaryKeyMapItem(u'public.test_table2', u'name', u'character varying', 0)}
+    return {'public.test_table': (PrimaryKeyMapItem(u'public.test_table', u'uuid', u'uuid', 0),),
+            'public.test_table2': (PrimaryKeyMapItem(u'public.test_table2', u'name', u'character varying', 0),)}
 
 
 @pytest.fixture(params=[CSVFormatter, CSVPayloadFormatter, Formatter])
@@ -51,8 +55,70 @@ def test___init__(formatter):
     assert u'public.test_table2:' in patterns, 'with colon'
     assert u'public.test_table' not in patterns, 'without colon should not be in patterns'
     assert u'public.test_table2' not in patterns, 'without colon should not be in patterns'
-    assert patterns[u'public.test_table:'].pattern == r"uuid\[uuid\]:'?([\w\-]+)'?"
-    assert patterns[u'public.test_table2:'].pattern == r"name\[character varying\]:'?([\w\-]+)'?"
+    assert patterns[u'public.test_table:'].col_names == [u'uuid']
+    assert patterns[u'public.test_table2:'].col_names == [u'name']
+
+
+@pytest.mark.parametrize('data, col_name, value', [
+    (u"id[integer]:1 name[text]:'x'", u'id', u'1'),
+    (u"id[integer]:1 name[text]:'x'", u'name', u'x'),
+    (u"a[text]:'it''s got id[integer]:2 inside' id[integer]:1", u'id', u'1'),
+    (u"\"Full \"\"Name\"\"\"[character varying]:'O''Brien jr' id[integer]:3", u'Full "Name"', u"O'Brien jr"),
+    (u"\"Full \"\"Name\"\"\"[character varying]:'O''Brien jr' id[integer]:3", u'id', u'3'),
+    (u"tags[text[]]:'{a,b}' ts[timestamp without time zone]:'2018-01-01 00:00:00'", u'ts', u'2018-01-01 00:00:00'),
+    (u"tags[text[]]:'{a,b}' id[integer]:null", u'id', u'null'),
+    (u"note[text]:'' id[text]:''", u'id', u''),
+    (u"old-key: id[integer]:1 new-tuple: id[integer]:2 body[text]:'a b'", u'id', u'1'),
+    (u"id2[integer]:2 id[integer]:1", u'id', u'1'),
+])
+def test_compile_test_decoding_key_pattern(data, col_name, value):
+    mat = compile_test_decoding_key_pattern([col_name]).match(data)
+    assert read_test_decoding_value(mat) == value
+
+
+def test_compile_test_decoding_key_pattern_missing():
+    pattern = compile_test_decoding_key_pattern([u'id'])
+    assert pattern.match(u'(no-tuple-data)') is None
+    assert pattern.match(u"a[text]:'id[integer]:1'") is None, 'Not fooled by quoted text'
+
+
+@pytest.mark.parametrize('data, col_name, value', [
+    (u"id[integer]:1 name[text]:'x'", u'id', u'1'),
+    (u"a[text]:'it''s got id[integer]:2 inside' id[integer]:1", u'id', u'1'),
+    (u"a[text]:'got id[integer]:2 inside' id[integer]:1", u'id', u'1'),
+    (u"\"Full \"\"Name\"\"\"[character varying]:'O''Brien jr' id[integer]:3", u'Full "Name"', u"O'Brien jr"),
+    (u"tags[text[]]:'{a,b}' ts[timestamp without time zone]:'2018-01-01 00:00:00'", u'ts', u'2018-01-01 00:00:00'),
+    (u"note[text]:'' id[text]:''", u'id', u''),
+    (u"xid[integer]:2 id[integer]:1", u'id', u'1'),
+    (u"a\"user\"[integer]:2 \"user\"[integer]:1", u'user', u'1'),
+    (u"\"user\"[integer]:1", u'user', u'1'),
+])
+def test_tuple_key_reader(data, col_name, value):
+    assert TupleKeyReader([col_name])(data) == [value]
+
+
+def test_tuple_key_reader_fallback():
+    reader = TupleKeyReader([u'a', u'id'])
+    assert reader(u"a[integer]:1 b[text]:'id[integer]:2' id[integer]:3") == [u'1', u'3']
+    assert reader._tokenizer is None, 'Searching sufficed'
+
+    assert reader(u"b[text]:'x a[integer]:2' a[integer]:1 id[integer]:3") == [u'1', u'3']
+    assert reader._tokenizer is not None, 'Tokenized after the search hit a quoted value'
+
+    assert reader(u"a[integer]:1") is None
+    assert reader(u"b[text]:'a[integer]:1 id[integer]:2'") is None, 'Not fooled by quoted text'
+
+
+@pytest.mark.parametrize('data, col_name, col_type', [
+    (u"id[integer]:1", u'id', u'integer'),
+    (u"id[bigint]:1", u'id', u'integer'),
+    (u"\"user\"[integer]:1 id[integer]:2", u'user', u'integer'),
+    (u"\"User\"[integer]:1", u'User', None),
+])
+def test_tuple_key_reader_types(data, col_name, col_type):
+    reader = TupleKeyReader([col_name], [col_type])
+    assert reader(data) == [u'1']
+    assert reader._tokenizer is None, 'Searching sufficed'
 
 
 def test__preprocess_test_decoding_change(formatter):
@@ -102,6 +168,10 @@ def test__preprocess_test_decoding_change(formatter):
     assert change.operation == u'DELETE'
     assert change.pkey == u'Bling-2'
 
+    change = formatter._preprocess_test_decoding_change(
+        u"table public.test_table2: UPDATE: body[text]:'it''s got spaces' name[character varying]:'Bling 2'")[0]
+    assert change.pkey == u'Bling 2', 'Quoted values with spaces'
+
 
 def test__preprocess_wal2json_change(formatter):
     formatter.cur_xact = ''
@@ -288,3 +358,473 @@ def test_get_formatter():
         assert isinstance(result, CSVFormatter)
         assert mocked.called
         mocked.assert_called_with(1, 2, 3, 4)
+
+
+def test__preprocess_wal2json_v2_change(formatter):
+    formatter.cur_xact = ''
+    assert formatter._preprocess_wal2json_v2_change(u'{"action": "B", "xid": 1337}') == []
+    assert formatter.cur_xact == 1337
+    assert formatter._preprocess_wal2json_v2_change(u'{"action": "C", "xid": 1337}') == []
+    assert formatter._preprocess_wal2json_v2_change(
+        u'{"action": "T", "schema": "public", "table": "test_table"}') == []
+
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        formatter._preprocess_wal2json_v2_change(u'{"action": "X"}')
+        mock_log_and_raise.assert_called_with(u'Unknown change: "X"')
+
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        formatter._preprocess_wal2json_v2_change(u"""{
+            "action": "I", "schema": "public", "table": "not_a_table",
+            "columns": [{"name": "uuid", "type": "uuid", "value": "00079f3e"}]
+        }""")
+        mock_log_and_raise.assert_called_with(u'Unable to locate table: "public.not_a_table"')
+
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        formatter._preprocess_wal2json_v2_change(u"""{
+            "action": "I", "schema": "public", "table": "test_table",
+            "columns": [{"name": "other", "type": "uuid", "value": "00079f3e"}]
+        }""")
+        mock_log_and_raise.assert_called_with(u'Unable to locate primary key for table "public.test_table"')
+
+    change = formatter._preprocess_wal2json_v2_change(u"""{
+        "action": "U", "schema": "public", "table": "test_table",
+        "columns": [{"name": "other", "type": "text", "value": "blue"},
+                    {"name": "uuid", "type": "uuid", "value": "00079f3e-0479-4475-acff-4f225cc5188a"}],
+        "identity": [{"name": "uuid", "type": "uuid", "value": "00079f3e-0479-4475-acff-4f225cc5188a"}]
+    }""")[0]
+    assert change == Change(xid=1337, table=u'public.test_table', operation=u'update',
+                            pkey=u'00079f3e-0479-4475-acff-4f225cc5188a')
+
+    change = formatter._preprocess_wal2json_v2_change(u"""{
+        "action": "D", "schema": "public", "table": "test_table2",
+        "identity": [{"name": "name", "type": "character varying", "value": "Bling-2"}]
+    }""")[0]
+    assert change == Change(xid=1337, table=u'public.test_table2', operation=u'delete', pkey=u'Bling-2')
+
+    formatter.table_re = re.compile(u'nope')
+    assert formatter._preprocess_wal2json_v2_change(u"""{
+        "action": "D", "schema": "public", "table": "test_table2",
+        "identity": [{"name": "name", "type": "character varying", "value": "Bling-2"}]
+    }""") == []
+
+
+def test__preprocess_wal2json_v2_full_change(formatter):
+    formatter.cur_xact = 101
+    formatter.full_change = True
+
+    change = formatter._preprocess_wal2json_v2_change(u"""{
+        "action": "I", "schema": "public", "table": "not_a_table",
+        "columns": [{"name": "id", "type": "integer", "value": 42},
+                    {"name": "b", "type": "integer", "value": null}]
+    }""")[0]
+    assert change.xid == 101
+    assert change.change == {
+        "kind": "insert",
+        "schema": "public",
+        "table": "not_a_table",
+        "columnnames": ["id", "b"],
+        "columntypes": ["integer", "integer"],
+        "columnvalues": [42, None]
+    }
+
+    change = formatter._preprocess_wal2json_v2_change(u"""{
+        "action": "D", "schema": "public", "table": "not_a_table",
+        "identity": [{"name": "id", "type": "integer", "value": 42}]
+    }""")[0]
+    assert change.change == {
+        "kind": "delete",
+        "schema": "public",
+        "table": "not_a_table",
+        "columnnames": [],
+        "columntypes": [],
+        "columnvalues": [],
+        "oldkeys": {"keynames": ["id"], "keytypes": ["integer"], "keyvalues": [42]}
+    }
+
+
+def test___call___wal2json_v2(pkey_map):
+    formatter = CSVFormatter(pkey_map, 'wal2json', wal2json_format_version=2)
+    with mock.patch.object(formatter, '_preprocess_wal2json_v2_change', return_value=[]) as mock_v2:
+        assert formatter('{"action": "C"}') == []
+        mock_v2.assert_called_with('{"action": "C"}')
+
+
+WAL2JSON_V1_TRANSACTION = u"""{
+    "xid": 1337,
+    "timestamp": "2018-03-01 16:41:53.654321+00",
+    "change": [
+        {
+            "kind": "insert",
+            "schema": "public",
+            "table": "test_table",
+            "columnnames": ["uuid"],
+            "columntypes": ["uuid"],
+            "columnvalues": ["00079f3e-0479-4475-acff-4f225cc5188a"]
+        },
+        {"kind": "delete", "schema": "public", "table": "skipped",
+         "columnnames": ["id"], "columntypes": ["int4"], "columnvalues": [1]}
+       ,{
+            "kind": "update",
+            "schema": "public",
+            "table": "test_table2",
+            "columnnames": ["name"],
+            "columntypes": ["varchar"],
+            "columnvalues": ["Bling-]2"]
+        }
+    ]
+}"""
+
+
+@pytest.mark.parametrize('full_change', [False, True])
+def test__iter_wal2json_changes(pkey_map, full_change):
+    formatter = Formatter(pkey_map, 'wal2json', full_change=full_change, table_pat=u'test_table')
+    expected = formatter._preprocess_wal2json_change(WAL2JSON_V1_TRANSACTION)
+    assert len(expected) == 2
+
+    formatter.cur_xact = ''
+    formatter.stream_threshold = 10
+    result = formatter._preprocess_wal2json_change(WAL2JSON_V1_TRANSACTION)
+    assert not isinstance(result, list), 'Streamed'
+    assert formatter.cur_xact == '', 'Lazy'
+
+    assert next(result) == expected[0]
+    assert formatter.cur_xact == 1337
+    assert list(result) == expected[1:]
+
+    assert list(formatter._iter_wal2json_changes(u'{"xid": 1, "change": [ ]}')) == []
+
+
+@pytest.mark.parametrize('window', [1, 7, 64, 1048576])
+def test__iter_wal2json_changes_windows(pkey_map, window):
+    payload = WAL2JSON_V1_TRANSACTION.replace(u'Bling-]2', u'Bl\u00efng-]\u20ac2').encode('utf-8')
+    formatter = Formatter(pkey_map, 'wal2json', full_change=True)
+    expected = formatter._preprocess_wal2json_change(payload)
+
+    with mock.patch('pg2kinesis.formatter.WAL2JSON_STREAM_WINDOW', window):
+        assert list(formatter._iter_wal2json_changes(payload)) == expected, \
+            'Rows and characters split across windows'
+        with pytest.raises(ValueError):
+            list(formatter._iter_wal2json_changes(payload[:-20]))
+
+
+def test__decode_window():
+    data = u'a\u20acb'.encode('utf-8')
+    assert Formatter._decode_window(data, 0, 2) == (u'a', 1), 'Characters are not split'
+    assert Formatter._decode_window(data, 1, 3) == (u'\u20ac', 4)
+    assert Formatter._decode_window(data, 4, 10) == (u'b', 5)
+
+
+def test__iter_wal2json_changes_unknown(formatter):
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        assert list(formatter._iter_wal2json_changes(u'{"xid": 1}')) == []
+        mock_log_and_raise.assert_called_with(u'Unknown change: "{"xid": 1}"')
+
+
+def test___call___streamed(pkey_map):
+    formatter = CSVFormatter(pkey_map, 'wal2json', table_pat=u'test_table', stream_threshold=10)
+    result = formatter(WAL2JSON_V1_TRANSACTION)
+    assert not isinstance(result, list)
+    assert [msg.fmt_msg for msg in result] == [u'0,CDC,1337,public.test_table,insert,00079f3e-0479-4475-acff-4f225cc5188a',
+                                               u'0,CDC,1337,public.test_table2,update,Bling-]2']
+
+
+@pytest.fixture
+def composite_pkey_map():
+    return {'public.composite': (PrimaryKeyMapItem(u'public.composite', u'a', u'int4', 1),
+                                 PrimaryKeyMapItem(u'public.composite', u'c', u'text', 3)),
+            'public.no_key': ()}
+
+
+def test__preprocess_test_decoding_change_composite(composite_pkey_map):
+    formatter = Formatter(composite_pkey_map)
+    formatter.cur_xact = '1'
+
+    change = formatter._preprocess_test_decoding_change(
+        u"table public.composite: UPDATE: a[integer]:1 b[text]:'b' c[text]:'x y'")[0]
+    assert change.pkey == [u'1', u'x y']
+
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        formatter._preprocess_test_decoding_change(u"table public.no_key: INSERT: a[integer]:1")
+        mock_log_and_raise.assert_called_with(u'Unable to locate primary key for table "public.no_key"')
+
+
+def test__preprocess_wal2json_change_composite(composite_pkey_map):
+    formatter = Formatter(composite_pkey_map, 'wal2json')
+    changes = formatter._preprocess_wal2json_change(json.dumps({
+        'xid': 5,
+        'change': [
+            {'kind': 'insert', 'schema': 'public', 'table': 'composite',
+             'columnnames': ['a', 'b', 'c'], 'columntypes': ['int4', 'text', 'text'],
+             'columnvalues': [1, 'b', 'x']},
+            {'kind': 'delete', 'schema': 'public', 'table': 'composite',
+             'oldkeys': {'keynames': ['a', 'c'], 'keytypes': ['int4', 'text'], 'keyvalues': [2, 'y']}},
+        ]}))
+
+    assert [change.pkey for change in changes] == [[u'1', u'x'], [u'2', u'y']]
+
+
+def test__preprocess_wal2json_v2_change_composite(composite_pkey_map):
+    formatter = Formatter(composite_pkey_map, 'wal2json', wal2json_format_version=2)
+    formatter._preprocess_wal2json_v2_change(u'{"action": "B", "xid": 5}')
+
+    change = formatter._preprocess_wal2json_v2_change(json.dumps({
+        'action': 'D', 'schema': 'public', 'table': 'composite',
+        'identity': [{'name': 'a', 'type': 'int4', 'value': 3},
+                     {'name': 'c', 'type': 'text', 'value': 'z'}]}))[0]
+
+    assert change.operation == u'delete'
+    assert change.pkey == [u'3', u'z']
+
+
+def test__key_positions(composite_pkey_map):
+    formatter = Formatter(composite_pkey_map)
+    primary_key = composite_pkey_map['public.composite']
+
+    assert formatter._key_positions('public.composite', 'columns', primary_key, ['a', 'b', 'c']) == [0, 2]
+    assert formatter._key_positions_cache == {('public.composite', 'columns', 3): [0, 2]}
+
+    # Same width, different order: cached positions are rechecked and rebuilt.
+    assert formatter._key_positions('public.composite', 'columns', primary_key, ['c', 'b', 'a']) == [2, 0]
+    assert formatter._key_positions('public.composite', 'columns', primary_key, ['a', 'b']) is None
+    assert formatter._key_positions('public.no_key', 'columns', (), ['a']) is None
+
+
+def test_CSVFormatter_composite_pkey():
+    change = Change(xid=1, table=u'public.composite', operation=u'insert', pkey=[u'1', u'x'])
+    assert CSVFormatter({}).produce_formatted_message(change).fmt_msg == u'0,CDC,1,public.composite,insert,1,x'
+
+
+def test__refresh_primary_key(pkey_map):
+    new_key = (PrimaryKeyMapItem(u'public.new_table', u'id', u'integer', 1),)
+    lookup = mock.Mock(side_effect=lambda table: new_key if table == u'public.new_table' else None)
+    formatter = Formatter(pkey_map, primary_key_lookup=lookup)
+    formatter.cur_xact = '1'
+
+    change = formatter._preprocess_test_decoding_change(u"table public.new_table: INSERT: id[integer]:7")[0]
+    assert change.pkey == u'7'
+    lookup.assert_called_once_with(u'public.new_table')
+
+    formatter._preprocess_test_decoding_change(u"table public.new_table: INSERT: id[integer]:8")
+    assert lookup.call_count == 1, 'Known from now on'
+
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        formatter._preprocess_test_decoding_change(u"table public.gone: INSERT: id[integer]:8")
+        mock_log_and_raise.assert_called_with(u'Unable to locate table: "public.gone:"')
+
+    assert not Formatter(pkey_map)._refresh_primary_key(u'public.new_table'), 'Nothing to look up with'
+
+
+def test__refresh_primary_key_after_ddl(pkey_map):
+    # Key column renamed.
+    renamed = (PrimaryKeyMapItem(u'public.test_table', u'id', u'uuid', 1),)
+    lookup = mock.Mock(return_value=renamed)
+    formatter = Formatter(pkey_map, 'wal2json', primary_key_lookup=lookup)
+
+    row = {'kind': 'insert', 'schema': 'public', 'table': 'test_table',
+           'columnnames': ['uuid', 'b'], 'columntypes': ['uuid', 'text'], 'columnvalues': ['x', 'y']}
+    assert formatter._wal2json_row(row).pkey == u'x'
+    assert not lookup.called, 'Rows matching their key never check'
+
+    row = dict(row, columnnames=['id', 'b'])
+    assert formatter._wal2json_row(row).pkey == u'x'
+    lookup.assert_called_once_with(u'public.test_table')
+    assert formatter.primary_key_map[u'public.test_table'] == renamed
+    assert formatter._key_positions_cache == {(u'public.test_table', 'columns', 2): [0]}
+
+    # Unchanged key: still missing.
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        formatter._wal2json_row(dict(row, columnnames=['other', 'b']))
+        mock_log_and_raise.assert_called_with(u'Unable to locate primary key for table "public.test_table"')
+    assert lookup.call_count == 2
+
+
+def test__refresh_primary_key_wal2json_v2(pkey_map):
+    lookup = mock.Mock(return_value=(PrimaryKeyMapItem(u'public.new_table', u'id', u'integer', 1),))
+    formatter = Formatter(pkey_map, 'wal2json', wal2json_format_version=2, primary_key_lookup=lookup)
+
+    change = formatter._wal2json_v2_row({'schema': 'public', 'table': 'new_table',
+                                         'columns': [{'name': 'id', 'type': 'integer', 'value': 3}]},
+                                        'insert')[0]
+    assert change.pkey == u'3'
+
+
+@pytest.mark.parametrize('output_plugin, payload', [
+    ('test_decoding', b"table public.test_table2: INSERT: name[character varying]:'caf\xc3\xa9'"),
+    ('wal2json', b'{"xid": 1, "change": [{"kind": "insert", "schema": "public", "table": "test_table2", '
+                 b'"columnnames": ["name"], "columntypes": ["varchar"], "columnvalues": ["caf\xc3\xa9"]}]}'),
+])
+def test___call___bytes(pkey_map, output_plugin, payload):
+    formatter = CSVPayloadFormatter(pkey_map, output_plugin, json_codec=get_json_codec('json'))
+    assert formatter(payload)[0].change.pkey == u'café'
+
+    formatter.stream_threshold = 1
+    assert list(formatter(payload))[0].change.pkey == u'café'
+
+
+def test_CSVPayloadFormatter_json_codec(pkey_map):
+    codec = mock.Mock()
+    codec.dumps.return_value = u'{}'
+    formatter = CSVPayloadFormatter(pkey_map, json_codec=codec)
+
+    assert formatter.produce_formatted_message(Change(1, u'public.blue', u'insert', u'1')).fmt_msg == u'0,CDC,{}'
+    codec.dumps.assert_called_once_with(dict(xid=1, table=u'public.blue', operation=u'insert', pkey=u'1'))
+
+
+def full_change(xid, kind='insert', names=('id', 'name'), values=(1, 'a'), oldkeys=None):
+    change = dict(kind=kind, schema='public', table='wide', columnnames=list(names),
+                  columntypes=['int4', 'text'][:len(names)], columnvalues=list(values))
+    if oldkeys:
+        change['oldkeys'] = oldkeys
+    return FullChange(xid=xid, change=change)
+
+
+def test_MessagePackFormatter_produce_formatted_message():
+    msgpack = pytest.importorskip('msgpack')
+    formatter = MessagePackFormatter({})
+
+    change = Change(xid=1, table=u'public.blue', operation=u'Update', pkey=[u'1', u'x'])
+    result = formatter.produce_formatted_message(change)
+    assert result.change == change
+    assert msgpack.unpackb(result.fmt_msg, raw=False) == [0, u'CDC', 1, u'public.blue', u'Update', [u'1', u'x']]
+
+
+def test_MessagePackFormatter_full_change():
+    msgpack = pytest.importorskip('msgpack')
+    formatter = MessagePackFormatter({}, 'wal2json', True)
+
+    def unpack(change):
+        return msgpack.unpackb(formatter.produce_formatted_message(change).fmt_msg, raw=False)
+
+    first = unpack(full_change(1))
+    assert first[:5] == [0, u'CDC', 1, u'public.wide', u'insert']
+    assert first[6:8] == [[1, u'a'], None]
+    assert first[8] == dict(columnnames=[u'id', u'name'], columntypes=[u'int4', u'text'], keynames=[], keytypes=[])
+
+    second = unpack(full_change(1, values=(2, 'b')))
+    assert second[5] == first[5], 'Same table version'
+    assert second[6:] == [[2, u'b'], None, None], 'Schema sent once per transaction'
+
+    altered = unpack(full_change(1, names=('id',), values=(3,)))
+    assert altered[5] != first[5]
+    assert altered[8][u'columnnames'] == [u'id']
+
+    deleted = unpack(full_change(1, 'delete', (), (), dict(keynames=['id'], keytypes=['int4'], keyvalues=[2])))
+    assert deleted[6:8] == [[], [2]]
+    assert deleted[8][u'keynames'] == [u'id']
+
+    next_xact = unpack(full_change(2))
+    assert next_xact[5] == first[5], 'Ids are stable'
+    assert next_xact[8] is not None, 'Every transaction describes its schemas'
+
+    assert MessagePackFormatter({}, 'wal2json', True)._full_change_record(full_change(9))[5] == first[5]
+    assert first[5] >= 2 ** 32 or altered[5] >= 2 ** 32, '64 bit ids'
+
+    formatter._schema_ids[('public.wide', ('id',), ('int4',), (), ())] = first[5]
+    collided = unpack(full_change(2, names=('id',), values=(3,)))
+    assert collided[8] is not None, 'Versions sharing an id are still both described'
+
+    wide = unpack(full_change(3, values=(2 ** 70, 'a')))
+    assert wide[6] == [str(2 ** 70), u'a'], 'Too wide for MessagePack'
+    assert unpack(full_change(3, values=(4, 'b')))[6] == [4, u'b']
+
+
+def test_MessagePackFormatter_missing(pkey_map):
+    with mock.patch('pg2kinesis.formatter.msgpack', None):
+        with pytest.raises(ImportError):
+            MessagePackFormatter(pkey_map)
+
+
+def test_begin_xid(pkey_map):
+    formatter = Formatter(pkey_map)
+    assert formatter.begin_xid(b'BEGIN 1234') == u'1234'
+    assert formatter.begin_xid(u'BEGIN 1234') == u'1234'
+    assert formatter.begin_xid(b'COMMIT 1234') is None
+    assert formatter.begin_xid(b"table public.test_table: INSERT: uuid[uuid]:'BEGIN 1'") is None
+
+    formatter = Formatter(pkey_map, 'wal2json', wal2json_format_version=2)
+    assert formatter.begin_xid(b'{"action":"B","xid":1234}') == 1234
+    assert formatter.begin_xid(b'{"action": "C", "xid": 1234}') is None
+    assert formatter.begin_xid(b'{"action":"I","schema":"B","table":"t","columns":[]}') is None
+
+    assert Formatter(pkey_map, 'wal2json').begin_xid(b'{"xid": 1234, "change": []}') is None, \
+        'Every message carries its xid'
+
+
+def test_operations_test_decoding(pkey_map):
+    formatter = CSVFormatter(pkey_map, operations=['delete'])
+    formatter.cur_xact = '1'
+    with mock.patch.object(formatter, '_primary_key_patterns') as patterns:
+        assert formatter(u"table public.test_table: INSERT: uuid[uuid]:'00079f3e'") == []
+        assert not patterns.__getitem__.called, 'Dropped before the key is extracted'
+
+    assert formatter(u"table public.test_table: DELETE: uuid[uuid]:'00079f3e'")[0].change.operation == u'DELETE'
+
+
+def test_operations_wal2json(pkey_map):
+    formatter = CSVFormatter(pkey_map, 'wal2json', operations=['insert'])
+    payload = json.dumps({'xid': 1, 'change': [
+        {'kind': 'delete', 'schema': 'public', 'table': 'test_table',
+         'oldkeys': {'keynames': ['uuid'], 'keytypes': ['uuid'], 'keyvalues': ['a']}},
+        {'kind': 'insert', 'schema': 'public', 'table': 'test_table',
+         'columnnames': ['uuid'], 'columntypes': ['uuid'], 'columnvalues': ['b']}]})
+    assert [msg.change.pkey for msg in formatter(payload)] == [u'b']
+
+
+@pytest.mark.parametrize('payload, skipped', [
+    (b'{"action":"I","schema":"public","table":"test_table","columns":[]}', False),
+    (b'{"action": "D", "schema": "public", "table": "test_table", "identity": []}', True),
+    (b'{"action":"I","schema":"public","table":"other_table","columns":[]}', True),
+    (b'{"action":"I","schema":"public","table":"test_\\u0074able","columns":[]}', False),
+    (b'{"action":"B","xid":1}', False),
+    (u'{"action":"D","schema":"public","table":"test_table","identity":[]}', False),
+    # As wal2json writes rows with include-xids, include-timestamp and include-lsn.
+    (b'{"action":"I","xid":1234,"schema":"public","table":"other_table","columns":[]}', True),
+    (b'{"action":"D","xid":1234,"schema":"public","table":"test_table","identity":[]}', True),
+    (b'{"action":"U","xid":1234,"schema":"public","table":"test_table","columns":[]}', False),
+    (b'{"action":"I","xid":1234,"timestamp":"2019-12-29 04:58:34.806671+00","lsn":"0/16D4320",'
+     b'"schema":"public","table":"other_table","columns":[]}', True),
+    (b'{"action":"I","xid":1234,"schema":"public","table":"test_\\u0074able","columns":[]}', False),
+])
+def test__skip_wal2json_v2_row(pkey_map, payload, skipped):
+    formatter = Formatter(pkey_map, 'wal2json', table_pat=r'^test_', wal2json_format_version=2,
+                          operations=['insert', 'update'])
+    assert formatter._skip_wal2json_v2_row(payload) == skipped
+
+
+def test_operations_wal2json_v2(pkey_map):
+    formatter = CSVFormatter(pkey_map, 'wal2json', wal2json_format_version=2, operations=['insert'])
+    with mock.patch.object(formatter.json_codec, 'loads') as loads:
+        assert formatter(b'{"action":"D","schema":"public","table":"test_table","identity":[]}') == []
+        assert not loads.called, 'Dropped before parsing'
+
+    with mock.patch.object(formatter.json_codec, 'loads') as loads:
+        assert formatter(b'{"action":"D","xid":5,"schema":"public","table":"test_table","identity":[]}') == []
+        assert not loads.called, 'Also with include-xids'
+
+    payload = b'{"action":"D","xid":5,"schema":"public","table":"test_\\u0074able",' \
+              b'"identity":[{"name":"uuid","type":"uuid","value":"a"}]}'
+    assert formatter(payload) == [], 'Dropped after parsing if the prefix is unexpected'
+
+    formatter = Formatter(pkey_map, 'wal2json', wal2json_format_version=2)
+    assert not formatter._filtering, 'Nothing to drop'
+    copy = Formatter(formatter.primary_key_map, 'wal2json', formatter.full_change, formatter.table_pat,
+                     wal2json_format_version=2, operations=formatter.operations)
+    assert not copy._filtering, 'Nor in copies made from its attributes, e.g. by FormatterPool'
+
+
+def test_ends_transaction(pkey_map):
+    formatter = Formatter(pkey_map)
+    assert formatter.ends_transaction(b'COMMIT 1234')
+    assert formatter.ends_transaction(u'COMMIT 1234')
+    assert not formatter.ends_transaction(b'BEGIN 1234')
+    assert not formatter.ends_transaction(b"table public.test_table: INSERT: uuid[uuid]:'COMMIT 1'")
+
+    formatter = Formatter(pkey_map, 'wal2json', wal2json_format_version=2)
+    assert formatter.ends_transaction(b'{"action":"C","xid":1234}')
+    assert not formatter.ends_transaction(b'{"action":"B","xid":1234}')
+    assert not formatter.ends_transaction(b'{"action":"I","schema":"C","table":"t","columns":[]}')
+
+    assert Formatter(pkey_map, 'wal2json').ends_transaction(b'{"xid": 1234, "change": []}'), \
+        'Every message is a whole transaction'
+    assert Formatter({}, 'pgoutput').ends_transaction(b'C\0')
+    assert not Formatter({}, 'pgoutput').ends_transaction(b'B\0')
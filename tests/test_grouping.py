@@ -0,0 +1,82 @@
+from __future__ import unicode_literals
+
+import pytest
+
+from pg2kinesis.formatter import CSVFormatter, Change, MessagePackFormatter, TransactionGroup
+from pg2kinesis.grouping import TransactionGrouper
+
+
+def message(formatter, xid, table='public.blue', pkey='1'):
+    return formatter.produce_formatted_message(Change(xid, table, 'insert', pkey))
+
+
+def test_transaction_grouper():
+    formatter = CSVFormatter({})
+    grouper = TransactionGrouper(formatter)
+
+    assert grouper.add(message(formatter, 1), 10) == []
+    assert grouper.add(message(formatter, 1, pkey='2'), 20) == []
+    assert grouper.pending_count == 2
+
+    [(group_msg, lsns)] = grouper.commit()
+    assert lsns == [10, 20]
+    assert group_msg.change == TransactionGroup(xid=1, table='public.blue', part=0, final=True, count=2)
+    assert group_msg.fmt_msg == '0,TXN,1,0,last,2\n0,CDC,1,public.blue,insert,1\n0,CDC,1,public.blue,insert,2'
+    assert grouper.pending_count == 0
+    assert grouper.commit() == [], 'Nothing left'
+
+
+def test_transaction_grouper_split():
+    formatter = CSVFormatter({})
+    size = len(message(formatter, 1).fmt_msg) + 1
+    grouper = TransactionGrouper(formatter, max_bytes=2 * size)
+
+    parts = []
+    for lsn in range(5):
+        parts.extend(grouper.add(message(formatter, 1, pkey=str(lsn)), lsn))
+    parts.extend(grouper.commit())
+
+    assert [(msg.change.part, msg.change.final, msg.change.count, lsns) for msg, lsns in parts] == [
+        (0, False, 2, [0, 1]), (1, False, 2, [2, 3]), (2, True, 1, [4])]
+    assert parts[0][0].fmt_msg.startswith('0,TXN,1,0,more,2\n')
+
+    grouper = TransactionGrouper(formatter, max_bytes=1)
+    assert grouper.add(message(formatter, 2), 5) == []
+    assert [msg.change.count for msg, _ in grouper.commit()] == [1], 'Messages larger than max_bytes go on their own'
+
+
+def test_transaction_grouper_keys():
+    formatter = CSVFormatter({})
+    grouper = TransactionGrouper(formatter, key=lambda table: table.startswith('public.audit'))
+
+    grouper.add(message(formatter, 1, 'public.blue'), 10)
+    grouper.add(message(formatter, 1, 'public.audit_log'), 10)
+    grouper.add(message(formatter, 1, 'public.red'), 20)
+    parts = grouper.commit()
+    assert [(msg.change.table, msg.change.count, lsns) for msg, lsns in parts] == [
+        ('public.blue', 2, [10, 20]), ('public.audit_log', 1, [10])]
+
+
+def test_transaction_grouper_missed_commit():
+    formatter = CSVFormatter({})
+    grouper = TransactionGrouper(formatter)
+
+    grouper.add(message(formatter, 1), 10)
+    [(group_msg, lsns)] = grouper.add(message(formatter, 2), 20)
+    assert (group_msg.change.xid, group_msg.change.final, lsns) == (1, True, [10])
+    assert grouper.commit()[0][0].change.xid == 2
+
+
+def test_transaction_grouper_binary():
+    msgpack = pytest.importorskip('msgpack')
+    formatter = MessagePackFormatter({})
+    grouper = TransactionGrouper(formatter)
+    grouper.add(message(formatter, 1), 10)
+    grouper.add(message(formatter, 1, pkey='2'), 10)
+
+    [(group_msg, _)] = grouper.commit()
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(group_msg.fmt_msg)
+    assert list(unpacker) == [[0, 'TXN', 1, 0, 'last', 2],
+                              [0, 'CDC', 1, 'public.blue', 'insert', '1'],
+                              [0, 'CDC', 1, 'public.blue', 'insert', '2']]
@@ -0,0 +1,61 @@
+# coding=utf-8
+from __future__ import unicode_literals
+import json
+
+import pytest
+
+from pg2kinesis import json_codec
+from pg2kinesis.json_codec import available_json_codecs, get_json_codec
+
+
+@pytest.fixture(params=available_json_codecs())
+def codec(request):
+    return get_json_codec(request.param)
+
+
+def test_loads(codec):
+    payload = '{"xid": 1, "change": [{"kind": "insert", "columnvalues": [1, 1.5, "é", null]}]}'
+    expected = {'xid': 1, 'change': [{'kind': 'insert', 'columnvalues': [1, 1.5, 'é', None]}]}
+
+    assert codec.loads(payload) == expected
+    assert codec.loads(payload.encode('utf-8')) == expected, 'Bytes too'
+
+
+def test_loads_wide_int(codec):
+    value = 123456789012345678901234567890
+    assert codec.loads('{"a": %d}' % value)['a'] == value, 'Never rounded to a float'
+    assert codec.loads(b'{"a": -9223372036854775809}')['a'] == -9223372036854775809
+
+
+def test_dumps(codec):
+    obj = {'xid': 1, 'table': 'public.blue', 'pkey': ['1', 'é'], 'wide': 2 ** 70}
+    assert json.loads(codec.dumps(obj)) == obj
+
+
+def test_get_json_codec():
+    assert get_json_codec().name == available_json_codecs()[0]
+    assert get_json_codec('auto').name == available_json_codecs()[0]
+    assert get_json_codec('json').name == 'json'
+    assert available_json_codecs()[-1] == 'json', 'Always available'
+
+    with pytest.raises(ValueError):
+        get_json_codec('nope')
+
+
+def test_get_json_codec_missing(monkeypatch):
+    monkeypatch.setattr(json_codec, 'JSON_CODECS', [(json_codec.OrjsonCodec, None),
+                                                    (json_codec.JSONCodec, json)])
+    assert get_json_codec().name == 'json'
+    assert available_json_codecs() == ['json']
+    with pytest.raises(ValueError):
+        get_json_codec('orjson')
+
+
+@pytest.mark.parametrize('data, expected', [
+    (b'{"a": 9223372036854775807}', True),
+    ('{"a": 922337203685477580}', False),
+    ('{"a": "2018-03-01 16:41:53.000123", "b": 1.5}', False),
+    ('{"a": "é 12345678901234567890"}', True),
+])
+def test_has_wide_int(data, expected):
+    assert json_codec.has_wide_int(data) == expected
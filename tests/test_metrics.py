@@ -0,0 +1,85 @@
+from __future__ import unicode_literals
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from pg2kinesis import metrics
+from pg2kinesis.metrics import Counter, Gauge, Histogram, Registry, start_http_server
+
+
+def test_counter():
+    registry = Registry()
+    counter = Counter('test_total', 'Things.', ['table', 'operation'], registry=registry)
+    counter.labels('public.blue', 'insert').inc()
+    counter.labels('public.blue', 'insert').inc(2)
+    counter.labels('public."odd\\name"', 'delete').inc()
+
+    assert registry.exposition().splitlines() == [
+        '# HELP test_total Things.',
+        '# TYPE test_total counter',
+        'test_total{table="public.\\"odd\\\\name\\"",operation="delete"} 1.0',
+        'test_total{table="public.blue",operation="insert"} 3.0',
+    ]
+
+
+def test_gauge():
+    registry = Registry()
+    gauge = Gauge('test_gauge', 'Level.', registry=registry)
+    gauge.set(5)
+    assert registry.exposition().splitlines()[-1] == 'test_gauge 5.0'
+
+    gauge.set_function(lambda: None)
+    assert registry.exposition().splitlines()[-1] == 'test_gauge 0.0', 'Nothing known yet'
+
+    gauge.set_function(lambda: 7)
+    assert registry.exposition().splitlines()[-1] == 'test_gauge 7.0', 'Read when scraped'
+
+
+def test_histogram():
+    registry = Registry()
+    histogram = Histogram('test_seconds', 'Latency.', buckets=[.1, 1], registry=registry)
+    for value in (.05, .1, .5, 3):
+        histogram.observe(value)
+
+    assert registry.exposition().splitlines()[2:] == [
+        'test_seconds_bucket{le="0.1"} 2.0',
+        'test_seconds_bucket{le="1.0"} 3.0',
+        'test_seconds_bucket{le="+Inf"} 4.0',
+        'test_seconds_sum 3.65',
+        'test_seconds_count 4.0',
+    ]
+
+
+def test_shared():
+    import threading
+    registry = Registry()
+    counter = Counter('test_total', 'Things.', ['reason'], registry=registry, shared=True)
+    histogram = Histogram('test_seconds', 'Latency.', buckets=[1], registry=registry, shared=True)
+
+    def update():
+        for _ in range(10000):
+            counter.labels('size').inc()
+            histogram.observe(.5)
+    threads = [threading.Thread(target=update) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counter.labels('size').get() == 40000, 'No increments lost'
+    assert histogram._children[()].counts == [40000, 0]
+
+
+def test_start_http_server():
+    registry = Registry()
+    Counter('test_total', 'Things.', registry=registry).inc()
+
+    server = start_http_server(0, '127.0.0.1', registry)
+    try:
+        response = urlopen('http://127.0.0.1:%s/metrics' % server.server_address[1])
+        assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+        assert 'test_total 1.0' in response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
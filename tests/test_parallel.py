@@ -0,0 +1,83 @@
+from mock import Mock
+import pytest
+
+from pg2kinesis.formatter import CSVFormatter
+from pg2kinesis.parallel import FormatterPool
+from pg2kinesis.slot import PrimaryKeyMapItem
+
+PKEY_MAP = {'public.test_table': (PrimaryKeyMapItem('public.test_table', 'id', 'integer', 1),)}
+
+
+@pytest.fixture
+def pool(request):
+    pool = FormatterPool(CSVFormatter(PKEY_MAP), 2, batch_size=2)
+    request.addfinalizer(pool.close)
+    return pool
+
+
+def insert(row_id, table='test_table'):
+    return 'table public.{}: INSERT: id[integer]:{}'.format(table, row_id).encode('utf-8')
+
+
+def test_formatter_pool(pool):
+    payloads = [b'BEGIN 10', insert(1), insert(2), b'COMMIT 10', b'BEGIN 11', insert(3), insert(4), b'COMMIT 11']
+    for lsn, payload in enumerate(payloads):
+        pool.put(payload, lsn)
+    pool.submit()
+    assert pool.pending_count == len(payloads)
+
+    results = list(pool.results(block=True))
+    assert [lsn for lsn, _ in results] == list(range(len(payloads))), 'In the order put'
+    assert [msg.fmt_msg for _, msgs in results for msg in msgs] == [
+        '0,CDC,10,public.test_table,INSERT,1', '0,CDC,10,public.test_table,INSERT,2',
+        '0,CDC,11,public.test_table,INSERT,3', '0,CDC,11,public.test_table,INSERT,4'], \
+        'Batches know the transaction they start in'
+    assert pool.pending_count == 0
+
+
+def test_formatter_pool_results_not_ready(pool):
+    pool._pending.append((None, [b'BEGIN 1'], [1], Mock(**{'ready.return_value': False, 'get.return_value': [[]]})))
+    assert list(pool.results()) == [], 'Waits for the oldest batch'
+
+    pool.max_pending_batches = 0
+    assert list(pool.results()) == [(1, [])], 'Unless too many are pending'
+
+
+def test_formatter_pool_primary_key_lookup():
+    new_key = (PrimaryKeyMapItem('public.new_table', 'id', 'integer', 1),)
+    formatter = CSVFormatter(PKEY_MAP, primary_key_lookup=Mock(return_value=new_key))
+    pool = FormatterPool(formatter, 1)
+    try:
+        pool.put(b'BEGIN 10', 1)
+        pool.put(insert(1, 'new_table'), 2)
+        pool.submit()
+        results = list(pool.results(block=True))
+        assert results[1][1][0].fmt_msg == '0,CDC,10,public.new_table,INSERT,1', 'Formatted inline'
+        formatter.primary_key_lookup.assert_called_once_with('public.new_table')
+        assert pool._primary_keys == {'public.new_table': new_key}
+
+        pool.put(insert(2, 'new_table'), 3)
+        assert list(pool.results(block=True))[0][1][0].change.pkey == '2'
+        assert formatter.primary_key_lookup.call_count == 1, 'Workers learnt the key'
+    finally:
+        pool.close()
+
+
+def test_formatter_pool_pgoutput():
+    from tests.test_pgoutput import USERS, begin, commit, insert, relation
+    pool = FormatterPool(CSVFormatter({}, 'pgoutput'), 2, batch_size=2)
+    try:
+        payloads = [begin(42), USERS, insert(16385, ['1', 'a', None]), insert(16385, ['2', 'b', None]),
+                    insert(16385, ['3', 'c', None]), relation(16385, 'public', 'users', [('uid', 23, True)]),
+                    insert(16385, ['4']), commit()]
+        for lsn, payload in enumerate(payloads):
+            pool.put(payload, lsn)
+        pool.submit()
+
+        results = list(pool.results(block=True))
+        assert [lsn for lsn, _ in results] == list(range(len(payloads)))
+        assert [msg.fmt_msg for _, msgs in results for msg in msgs] == [
+            '0,CDC,42,public.users,insert,{}'.format(i) for i in range(1, 5)], \
+            'Every worker knows the relations, as they were'
+    finally:
+        pool.close()
@@ -0,0 +1,167 @@
+from __future__ import unicode_literals
+import struct
+
+import mock
+import pytest
+
+from pg2kinesis import pgoutput
+from pg2kinesis.formatter import CSVFormatter, CSVPayloadFormatter, Change, FullChange
+
+
+def string(value):
+    return value.encode('utf-8') + b'\0'
+
+
+def tuple_data(values):
+    data = struct.pack('>H', len(values))
+    for value in values:
+        if value is None:
+            data += b'n'
+        elif value is pgoutput.UNCHANGED_TOAST:
+            data += b'u'
+        else:
+            value = value.encode('utf-8')
+            data += b't' + struct.pack('>i', len(value)) + value
+    return data
+
+
+def relation(oid, namespace, name, columns, replica_identity=b'd'):
+    """
+    :param columns: list of (name, type oid, is key).
+    """
+    data = b'R' + struct.pack('>I', oid) + string(namespace) + string(name) + replica_identity
+    data += struct.pack('>H', len(columns))
+    for col_name, type_oid, key in columns:
+        data += struct.pack('>b', 1 if key else 0) + string(col_name) + struct.pack('>Ii', type_oid, -1)
+    return data
+
+
+def begin(xid):
+    return b'B' + struct.pack('>QqI', 0x16B374D848, 1000, xid)
+
+
+def commit():
+    return b'C' + struct.pack('>bQQq', 0, 0x16B374D848, 0x16B374D900, 1000)
+
+
+def insert(oid, values):
+    return b'I' + struct.pack('>I', oid) + b'N' + tuple_data(values)
+
+
+def update(oid, values, old=None):
+    data = b'U' + struct.pack('>I', oid)
+    if old is not None:
+        data += b'K' + tuple_data(old)
+    return data + b'N' + tuple_data(values)
+
+
+def delete(oid, old):
+    return b'D' + struct.pack('>I', oid) + b'K' + tuple_data(old)
+
+
+USERS = relation(16385, 'public', 'users', [('id', 23, True), ('name', 25, False), ('doc', 16400, False)])
+ORDERS = relation(16390, 'public', 'orders', [('shop', 25, True), ('id', 20, True), ('total', 1700, False)])
+
+
+def test_decode():
+    assert pgoutput.decode(begin(42)) == pgoutput.Begin(0x16B374D848, 1000, 42)
+    assert pgoutput.decode(commit()) == pgoutput.Commit(0, 0x16B374D848, 0x16B374D900, 1000)
+
+    rel = pgoutput.decode(USERS)
+    assert rel.oid == 16385
+    assert (rel.namespace, rel.name, rel.replica_identity) == ('public', 'users', 'd')
+    assert rel.columns[0] == pgoutput.Column(1, 'id', 23, -1)
+    assert [col.name for col in rel.columns] == ['id', 'name', 'doc']
+
+    assert pgoutput.decode(insert(16385, ['1', 'caf\xe9', None])) == pgoutput.Insert(
+        16385, (b'1', 'caf\xe9'.encode('utf-8'), None))
+    assert pgoutput.decode(update(16385, ['1', 'b', pgoutput.UNCHANGED_TOAST])) == pgoutput.Update(
+        16385, None, (b'1', b'b', pgoutput.UNCHANGED_TOAST))
+    assert pgoutput.decode(update(16385, ['2', 'b', None], old=['1', None, None])).old == (b'1', None, None)
+    assert pgoutput.decode(delete(16385, ['1', None, None])) == pgoutput.Delete(16385, (b'1', None, None))
+
+    truncate = b'T' + struct.pack('>Ib', 2, 1) + struct.pack('>II', 16385, 16390)
+    assert pgoutput.decode(truncate) == pgoutput.Truncate(1, (16385, 16390))
+    assert pgoutput.decode(b'Y' + struct.pack('>I', 16400) + string('public') + string('mood')) == \
+        pgoutput.Type(16400, 'public', 'mood')
+    assert pgoutput.decode(b'O' + struct.pack('>Q', 5) + string('origin')) == pgoutput.Origin(5, 'origin')
+
+    with pytest.raises(ValueError):
+        pgoutput.decode(b'Z')
+
+
+def test_relation_oid():
+    assert pgoutput.relation_oid(insert(16385, ['1', 'a', None])) == 16385
+    assert pgoutput.relation_oid(delete(16390, ['s', '1', None])) == 16390
+    assert pgoutput.relation_oid(USERS) is None
+    assert pgoutput.relation_oid(begin(1)) is None
+
+
+def test_formatter():
+    formatter = CSVFormatter({}, 'pgoutput')
+    messages = [begin(42), USERS, ORDERS, insert(16385, ['1', 'a', None]),
+                update(16390, ['s1', '7', '1.50']), delete(16385, ['1', None, None]), commit()]
+
+    fmt_msgs = [fmt_msg for message in messages for fmt_msg in formatter(message)]
+    assert [msg.change for msg in fmt_msgs] == [
+        Change(xid=42, table='public.users', operation='insert', pkey='1'),
+        Change(xid=42, table='public.orders', operation='update', pkey=['s1', '7']),
+        Change(xid=42, table='public.users', operation='delete', pkey='1')]
+    assert fmt_msgs[1].fmt_msg == '0,CDC,42,public.orders,update,s1,7'
+    assert formatter.begin_xid(begin(43)) == 43
+    assert formatter.begin_xid(insert(16385, ['1', 'a', None])) is None
+
+
+def test_formatter_filters_before_decoding():
+    formatter = CSVFormatter({}, 'pgoutput', table_pat='^users$', operations=['insert'])
+    formatter(USERS)
+    formatter(ORDERS)
+
+    with mock.patch.object(pgoutput, 'decode') as decode:
+        assert formatter(delete(16385, ['1', None, None])) == []
+        assert formatter(insert(16390, ['s1', '7', '1.50'])) == []
+        assert not decode.called
+
+    assert len(formatter(insert(16385, ['1', 'a', None]))) == 1
+
+
+def test_formatter_missing_key():
+    formatter = CSVFormatter({}, 'pgoutput')
+    formatter(relation(16395, 'public', 'log', [('line', 25, False)], replica_identity=b'n'))
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        assert formatter(insert(16395, ['x'])) == []
+        mock_log_and_raise.assert_called_with('Unable to locate primary key for table "public.log"')
+
+        assert formatter(insert(16399, ['x'])) == []
+        mock_log_and_raise.assert_called_with('Unknown relation: 16399')
+
+
+def test_formatter_relation_changed():
+    formatter = CSVFormatter({}, 'pgoutput')
+    formatter(USERS)
+    formatter(relation(16385, 'public', 'users', [('name', 25, False), ('uid', 23, True)]))
+    assert formatter(insert(16385, ['a', '9']))[0].change.pkey == '9'
+
+
+def test_formatter_full_change():
+    formatter = CSVPayloadFormatter({}, 'pgoutput', full_change=True)
+    formatter(begin(42))
+    formatter(USERS)
+    formatter(b'Y' + struct.pack('>I', 16400) + string('public') + string('mood'))
+
+    change = formatter(insert(16385, ['1', 'a', None]))[0].change
+    assert isinstance(change, FullChange)
+    assert change.xid == 42
+    assert change.change == dict(kind='insert', schema='public', table='users', columnnames=['id', 'name', 'doc'],
+                                 columntypes=['int4', 'text', 'mood'], columnvalues=['1', 'a', None])
+
+    change = formatter(update(16385, ['1', 'b', pgoutput.UNCHANGED_TOAST]))[0].change
+    assert change.change['columnnames'] == ['id', 'name'], 'Unchanged TOASTed values left out'
+    assert change.change['oldkeys'] == dict(keynames=['id'], keytypes=['int4'], keyvalues=['1'])
+
+    change = formatter(update(16385, ['2', 'b', None], old=['1', None, None]))[0].change
+    assert change.change['oldkeys']['keyvalues'] == ['1'], 'Changed key'
+
+    change = formatter(delete(16385, ['1', None, None]))[0].change
+    assert change.change == dict(kind='delete', schema='public', table='users',
+                                 oldkeys=dict(keynames=['id'], keytypes=['int4'], keyvalues=['1']))
@@ -1,16 +1,20 @@
+import time
+
 from mock import call, Mock, MagicMock, patch, PropertyMock
 
 import pytest
 import psycopg2
 import psycopg2.errorcodes
+import psycopg2.extras
 
-from pg2kinesis.slot import SlotReader
+from pg2kinesis.slot import SlotReader, parse_lsn
 
 
 @pytest.fixture
 def slot():
     slot = SlotReader('blah_db', 'blah_host', 'blah_port', 'blah_user', 'blah_sslmode', 'pg2kinesis')
     slot._repl_cursor = Mock()
+    slot._repl_cursor.read_message.side_effect = psycopg2.extras.StopReplication
     slot._repl_conn = Mock()
     slot._normal_conn = Mock()
 
@@ -82,6 +86,35 @@ def test_create_slot(slot):
                                                                          output_plugin=u'test_decoding')
 
 
+def test_create_publication(slot):
+    slot._normal_conn = MagicMock(server_version=110000)
+    cur = slot._normal_conn.cursor.return_value.__enter__.return_value
+    cur.fetchall.return_value = [(1,)]
+    slot.create_publication()
+    assert cur.execute.call_count == 1, 'Already present'
+
+    cur.reset_mock()
+    cur.fetchall.return_value = []
+    slot.create_publication(['insert', 'update'])
+    sql, params = cur.execute.call_args[0]
+    assert params == ('insert, update',)
+    assert 'CREATE PUBLICATION' in repr(sql) and 'publish' in repr(sql)
+
+    cur.reset_mock()
+    slot.create_publication(['update', 'insert', 'delete', 'truncate'])
+    assert len(cur.execute.call_args[0]) == 1 and 'publish' not in repr(cur.execute.call_args[0][0]), \
+        'Everything is published by default'
+
+    cur.reset_mock()
+    slot._normal_conn.server_version = 100005
+    slot.create_publication(['update', 'insert', 'delete', 'truncate'])
+    assert len(cur.execute.call_args[0]) == 1, 'Postgres 10 cannot publish truncate'
+
+    cur.reset_mock()
+    slot.create_publication(['insert', 'truncate'])
+    assert cur.execute.call_args[0][1] == ('insert',)
+
+
 def test_delete_slot(slot):
     with patch.object(psycopg2.ProgrammingError, 'pgcode',
                       new_callable=PropertyMock,
@@ -124,20 +157,99 @@ def test__get_connection(slot):
 def test_primary_key_map(slot):
     slot._execute_and_fetch = Mock(return_value=[('test_table', 'pkey', 'uuid', 0),
                                                  ('test_table2', 'pkey', 'uuid', 0),
-                                                 ('blue', 'bkey', 'char var', 10)
+                                                 ('blue', 'bkey', 'char var', 10),
+                                                 ('no_key', None, None, None),
+                                                 ('composite', 'a', 'int4', 1),
+                                                 ('composite', 'b', 'text', 3),
                                                  ])
 
     pkey_map = slot.primary_key_map
 
-    assert len(pkey_map) == 3
+    assert len(pkey_map) == 5
     assert 'test_table' in pkey_map
     assert 'test_table2' in pkey_map
     assert 'blue' in pkey_map
 
-    assert pkey_map['blue'].table_name == 'blue'
-    assert pkey_map['blue'].col_name == 'bkey'
-    assert pkey_map['blue'].col_type == 'char var'
-    assert pkey_map['blue'].col_ord_pos == 10
+    assert len(pkey_map['blue']) == 1
+    assert pkey_map['blue'][0].table_name == 'blue'
+    assert pkey_map['blue'][0].col_name == 'bkey'
+    assert pkey_map['blue'][0].col_type == 'char var'
+    assert pkey_map['blue'][0].col_ord_pos == 10
+
+    assert pkey_map['no_key'] == ()
+    assert [item.col_name for item in pkey_map['composite']] == ['a', 'b']
+
+
+
+def test_table_primary_key(slot):
+    with patch.object(slot, '_get_connection') as mock_gc:
+        mock_cur = mock_gc.return_value.cursor.return_value.__enter__.return_value
+        mock_cur.fetchall.return_value = [('public.blue', 'a', 'integer', 1), ('public.blue', 'b', 'text', 2)]
+
+        pkey = slot.table_primary_key('public.blue')
+        assert [item.col_name for item in pkey] == ['a', 'b']
+        mock_cur.execute.assert_called_with(SlotReader.TABLE_PK_SQL, ('public', 'blue'))
+        assert slot._meta_conn is mock_gc.return_value, 'Own connection'
+
+        mock_cur.fetchall.return_value = [('public.blue', None, None, None)]
+        assert slot.table_primary_key('public.blue') == ()
+
+        mock_cur.fetchall.return_value = []
+        assert slot.table_primary_key('public.blue') is None
+
+        assert mock_gc.call_count == 1, 'Opened once'
+
+    slot.__exit__(None, None, None)
+    assert slot._meta_conn.close.called
+
+
+
+def test_parse_lsn():
+    assert parse_lsn('16/B374D848') == 0x16B374D848
+    assert parse_lsn('0/0') == 0
+    assert parse_lsn(None) is None
+
+
+def test_sample_lag(slot):
+    from pg2kinesis import metrics
+    slot._normal_conn.server_version = 100005
+    slot._execute_and_fetch = Mock(return_value=[('1/500', '1/100', '0/FFFFFF00')])
+
+    assert slot.sample_lag(0x100000300) == 0x400
+    assert 'pg_current_wal_lsn()' in slot._execute_and_fetch.call_args[0][0]
+    assert slot._execute_and_fetch.call_args[0][1] == 'pg2kinesis'
+    assert slot.retained_wal == 0x600
+    assert slot.receive_lag == 0x200
+    assert metrics.REPLICATION_LAG_BYTES.labels().value == 0x400
+    assert metrics.RETAINED_WAL_BYTES.labels().value == 0x600
+    assert metrics.RECEIVE_LAG_BYTES.labels().value == 0x200
+
+    slot.sample_lag()
+    assert slot.receive_lag == 0x400, 'Nothing received yet'
+
+    slot._normal_conn.server_version = 90500
+    slot._execute_and_fetch = Mock(return_value=[('1/500', None, '1/0')])
+    assert slot.sample_lag() == 0x500, 'No confirmed_flush_lsn before 9.6'
+    sql = slot._execute_and_fetch.call_args[0][0]
+    assert 'pg_current_xlog_location()' in sql and 'NULL::text' in sql
+
+    slot._execute_and_fetch = Mock(return_value=[])
+    assert slot.sample_lag() == 0x500, 'Slot gone, keep the last sample'
+
+
+def test_start_lag_sampler(slot):
+    with patch.object(slot, 'sample_lag', side_effect=[Exception('boom'), 1, 2, 3, 4, 5, 6, 7, 8, 9]) as mock_sample:
+        thread = slot.start_lag_sampler(.01, lambda: 42)
+        for _ in range(200):
+            if mock_sample.call_count >= 2:
+                break
+            time.sleep(.01)
+        slot.__exit__(None, None, None)
+        thread.join(1)
+
+    assert not thread.is_alive(), 'Stopped on exit'
+    assert mock_sample.call_count >= 2, 'Kept sampling after an error'
+    mock_sample.assert_called_with(42)
 
 
 def test_execute_and_fetch(slot):
@@ -156,9 +268,66 @@ def test_execute_and_fetch(slot):
 
 
 def test_process_replication_stream(slot):
+    msg1, msg2 = Mock(), Mock()
+    slot._repl_cursor.read_message.side_effect = [msg1, None, msg2, psycopg2.extras.StopReplication]
     consume = Mock()
-    slot.process_replication_stream(consume)
+    with patch('select.select', return_value=([slot._repl_cursor], [], [])) as mock_select:
+        slot.process_replication_stream(consume)
 
     assert call.start_replication('pg2kinesis', options=None) in  slot._repl_cursor.method_calls, 'We started replication event loop'
-    assert call.consume_stream(consume) in slot._repl_cursor.method_calls, 'We pass consume to this method'
-
+    assert consume.call_args_list == [call(msg1), call(msg2)], 'We pass every message to consume'
+    assert mock_select.call_count == 1, 'Waited once nothing was ready'
+    assert mock_select.call_args[0][:3] == ([slot._repl_cursor], [], [])
+
+
+def test_process_replication_stream_tick(slot):
+    msg = Mock()
+    slot._repl_cursor.read_message.side_effect = [None, msg, None, psycopg2.extras.StopReplication]
+    consume, tick = Mock(), Mock()
+    # Start, then each wait's timeout and tick check, the tick rescheduling itself.
+    times = [100.0, 100.4, 101.0, 101.0, 101.5, 101.6, 101.7]
+    with patch('pg2kinesis.slot.timer', side_effect=times), \
+            patch('select.select', return_value=([], [], [])) as mock_select:
+        slot.process_replication_stream(consume, tick, tick_interval=1)
+
+    consume.assert_called_once_with(msg)
+    tick.assert_called_once_with(slot._repl_cursor)
+    assert [c[0][3] for c in mock_select.call_args_list] == [pytest.approx(0.6), pytest.approx(0.4)], \
+        'Waits no longer than until the next tick'
+
+
+def test_process_replication_stream_no_tick(slot):
+    slot._repl_cursor.read_message.side_effect = [None, None, psycopg2.extras.StopReplication]
+    times = [100.0, 100.0, 101.0, 101.0, 101.5, 101.6]
+    with patch('pg2kinesis.slot.timer', side_effect=times), \
+            patch('select.select', return_value=([], [], [])) as mock_select:
+        slot.process_replication_stream(Mock(), tick_interval=1)
+
+    assert [c[0][3] for c in mock_select.call_args_list] == [pytest.approx(1), pytest.approx(0.5)], \
+        'Keeps blocking once a tick is due'
+
+
+def test_process_replication_stream_wal2json(slot):
+    slot.output_plugin = 'wal2json'
+    slot.process_replication_stream(Mock())
+    assert call.start_replication('pg2kinesis', options={'include-xids': 1}) in slot._repl_cursor.method_calls
+
+    slot._repl_cursor.reset_mock()
+    slot.wal2json_format_version = 2
+    slot.process_replication_stream(Mock())
+    assert call.start_replication('pg2kinesis', options={'format-version': 2, 'include-xids': 1}) \
+        in slot._repl_cursor.method_calls
+
+    slot._repl_cursor.reset_mock()
+    slot.output_plugin = 'pgoutput'
+    slot.process_replication_stream(Mock())
+    assert call.start_replication('pg2kinesis', options={'proto_version': '1', 'publication_names': 'pg2kinesis'}) \
+        in slot._repl_cursor.method_calls
+    slot.output_plugin = 'wal2json'
+
+    slot._repl_cursor.reset_mock()
+    slot.plugin_options = {'actions': 'insert,update', 'add-tables': 'public.*'}
+    slot.process_replication_stream(Mock())
+    assert call.start_replication('pg2kinesis', options={'format-version': 2, 'include-xids': 1,
+                                                          'actions': 'insert,update', 'add-tables': 'public.*'}) \
+        in slot._repl_cursor.method_calls
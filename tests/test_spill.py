@@ -0,0 +1,101 @@
+import os
+import threading
+
+from mock import Mock
+
+from pg2kinesis.spill import CHECKPOINT, SpillDrainer, SpillLog
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.spill'))
+
+
+def test_spill_log(tmpdir):
+    directory = str(tmpdir.join('stream'))
+    log = SpillLog(directory, segment_bytes=4096)
+    assert log.peek(0) is None, 'Empty'
+
+    log.append('pk1', None, b'one')
+    log.append('pk2', '1234', b'two')
+    assert (log.pending_count, log.pending_bytes) == (2, 2 * 7 + 4 + 6)
+
+    assert log.peek(0) == ('pk1', None, b'one')
+    assert log.peek(0) == ('pk1', None, b'one'), 'Until popped'
+    log.pop()
+    assert log.pending_count == 1
+    assert os.path.exists(os.path.join(directory, CHECKPOINT))
+    log.close()
+
+    log = SpillLog(directory, segment_bytes=4096)
+    assert log.pending_count == 1, 'Popped records are not drained again'
+    assert log.peek(0) == ('pk2', '1234', b'two')
+    log.pop()
+    log.append('pk3', None, b'three')
+    assert log.peek(0) == ('pk3', None, b'three'), 'Appends after what was left'
+    log.close()
+
+
+def test_spill_log_segments(tmpdir):
+    directory = str(tmpdir)
+    log = SpillLog(directory, segment_bytes=100)
+    for i in range(5):
+        log.append('pk', None, b'x' * 30)
+    log.append('pk', None, b'y' * 500)
+    assert len(segments(directory)) == 4, 'Two records per segment, the large one gets its own'
+    assert os.path.getsize(os.path.join(directory, segments(directory)[-1])) > 500
+
+    drained = []
+    while log.pending_count:
+        drained.append(log.peek(0)[2])
+        log.pop()
+    assert drained == [b'x' * 30] * 5 + [b'y' * 500]
+    assert len(segments(directory)) == 1, 'Drained segments are removed'
+    log.close()
+
+
+def test_spill_log_torn_append(tmpdir):
+    directory = str(tmpdir)
+    log = SpillLog(directory, segment_bytes=4096)
+    log.append('pk', None, b'one')
+    log.append('pk', None, b'two')
+    log.close()
+
+    # Garble the last byte of the second record as a crash in the middle of its write would.
+    path = os.path.join(directory, segments(directory)[0])
+    with open(path, 'r+b') as f:
+        f.seek(2 * (8 + 5) + 2 * 3 - 1)
+        f.write(b'?')
+
+    log = SpillLog(directory, segment_bytes=4096)
+    assert log.pending_count == 1
+    log.append('pk', None, b'three')
+    log.close()
+
+    log = SpillLog(directory, segment_bytes=4096)
+    assert [log.peek(0)[2], log.pop(), log.peek(0)[2]] == [b'one', None, b'three']
+    log.close()
+
+
+def test_spill_drainer(tmpdir):
+    log = SpillLog(str(tmpdir), segment_bytes=4096)
+    log.append('pk1', None, b'one')
+    log.append('pk2', None, b'two')
+
+    sent = []
+    done = threading.Event()
+
+    def send(pk, ehk, data):
+        if not sent:
+            sent.append(None)
+            raise Exception('Throttled')
+        sent.append(data)
+        if len(sent) == 3:
+            done.set()
+
+    drainer = SpillDrainer(log, Mock(side_effect=send), poll_interval=.01).start()
+    assert done.wait(5)
+    drainer.close()
+
+    assert sent == [None, b'one', b'two'], 'Failed sends are retried in order'
+    assert log.pending_count == 0
+    log.close()
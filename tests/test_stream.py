@@ -96,3 +96,647 @@ def test__send_agg_record(writer):
         writer._send_agg_record(agg_rec)
         assert e_info.value.message == 'ProvisionedThroughputExceededException caused a backed off too many times!', \
             'We raise on too many throughput errors'
+
+
+def test_put_message_acknowledges_lsns(writer):
+    writer._send_agg_record = Mock()
+    msg = Mock()
+    msg.change.xid = 10
+    for lsn in (100, 200, 300, 400):
+        writer.tracker.add(lsn)
+
+    writer.last_send = 1445444940.0
+    with freeze_time('2015-10-21 16:29:00'):
+        writer._record_agg.add_user_record = Mock(return_value=None)
+        writer.put_message(msg, 100)
+        writer.put_message(msg, 200)
+        assert writer.tracker.acked_lsn is None, 'Nothing sent yet'
+
+        writer._record_agg.add_user_record = Mock(return_value='full')
+        writer.put_message(msg, 300)
+        assert writer.tracker.acked_lsn == 200, 'Full aggregate does not include the message that filled it'
+
+    with freeze_time('2015-10-21 16:29:20'):
+        writer._record_agg.add_user_record = Mock(return_value=None)
+        writer.put_message(msg, 400)
+        assert writer.tracker.acked_lsn == 400, 'Window flush sends everything put so far'
+
+
+def test_put_message_acknowledges_lsn_lists(writer):
+    writer._send_agg_record = Mock()
+    msg = Mock()
+    msg.change.xid = 10
+    for lsn in (100, 200, 200):
+        writer.tracker.add(lsn)
+
+    writer.flush_policy.linger = None
+    writer._record_agg.add_user_record = Mock(return_value=None)
+    writer.put_message(msg, [100, 200, 200])
+    assert writer.tracker.acked_lsn is None
+    writer.flush()
+    assert writer.tracker.acked_lsn == 200, 'Every LSN of a group acknowledged'
+
+
+def test_send_queue():
+    from pg2kinesis.stream import SendQueue
+    queue = SendQueue(max_count=2, max_bytes=10)
+
+    assert queue.get(timeout=0) is None, 'Empty queue times out'
+
+    queue.put('a', 3)
+    queue.put('b', 4)
+    assert queue.count == 2
+    assert queue.bytes == 7
+    assert queue._is_full(), 'Count cap reached'
+
+    assert queue.get() == 'a'
+    assert queue.count == 1
+    assert queue.bytes == 4
+    assert not queue._is_full()
+
+    queue.put('c', 6)
+    assert queue._is_full(), 'Byte cap reached'
+    assert queue.get() == 'b'
+    assert queue.get() == 'c'
+
+    queue.put('big', 100)
+    assert queue.get() == 'big', 'Oversized items are accepted into an empty queue'
+
+
+def test_pipelined_stream_writer():
+    from pg2kinesis.stream import PipelinedStreamWriter
+    stream_writer = Mock()
+    pipelined = PipelinedStreamWriter(stream_writer, poll_interval=.01)
+
+    msg = Mock(fmt_msg='abc')
+    pipelined.put_message(msg, 10)
+    assert pipelined.queued_count == 1
+    assert pipelined.queued_bytes == 3
+    assert not stream_writer.put_message.called, 'Nothing sent from the calling thread'
+
+    assert pipelined.tracker is stream_writer.tracker
+
+    pipelined.start()
+    for _ in range(100):
+        if stream_writer.put_message.call_count > 1:
+            break
+        time.sleep(.01)
+    pipelined.close()
+
+    assert stream_writer.put_message.call_args_list[0] == call(msg, 10)
+    assert call(None) in stream_writer.put_message.call_args_list, 'Idle sender checks the send window'
+    assert stream_writer.close.called, 'Pending messages sent on close'
+
+
+def test_pipelined_stream_writer_close():
+    from pg2kinesis.stream import PipelinedStreamWriter
+    stream_writer = Mock()
+    pipelined = PipelinedStreamWriter(stream_writer)
+
+    msg = Mock(fmt_msg='abc')
+    pipelined.put_message(msg, 10)
+    pipelined.close()
+
+    assert stream_writer.mock_calls == [call.put_message(msg, 10), call.close()], 'Queued messages sent first'
+    assert pipelined.queued_count == 0
+
+    stream_writer.reset_mock()
+    pipelined._error = ValueError('boom')
+    pipelined.close()
+    assert not stream_writer.close.called, 'Nothing sent after the sender failed'
+
+
+def test_pipelined_stream_writer_error():
+    from pg2kinesis.stream import PipelinedStreamWriter
+    stream_writer = Mock()
+    stream_writer.put_message.side_effect = ValueError('boom')
+    pipelined = PipelinedStreamWriter(stream_writer, poll_interval=.01)
+
+    pipelined.put_message(Mock(fmt_msg='abc'), 10)
+    pipelined._run()
+
+    with pytest.raises(ValueError):
+        pipelined.put_message(None, 11)
+
+
+def test_pipelined_stream_writer_error_full_queue():
+    import threading
+    from pg2kinesis.stream import PipelinedStreamWriter
+    stream_writer = Mock()
+    started = threading.Event()
+
+    def fail(*args):
+        started.set()
+        time.sleep(.05)
+        raise ValueError('boom')
+    stream_writer.put_message.side_effect = fail
+    pipelined = PipelinedStreamWriter(stream_writer, max_queue_count=2, poll_interval=.01)
+
+    pipelined.start()
+    pipelined.put_message(Mock(fmt_msg='abc'), 10)
+    started.wait(1)
+    pipelined.put_message(Mock(fmt_msg='abc'), 11)
+    pipelined.put_message(Mock(fmt_msg='abc'), 12)
+    assert pipelined.queued_count == 2, 'Queue is full'
+
+    errors = []
+
+    def put():
+        try:
+            pipelined.put_message(Mock(fmt_msg='abc'), 13)
+        except ValueError as e:
+            errors.append(e)
+    blocked = threading.Thread(target=put)
+    blocked.start()
+    blocked.join(2)
+    assert not blocked.is_alive(), 'Blocked put woken up by the sender failing'
+    assert len(errors) == 1
+
+
+def test_put_message_batch(writer):
+    writer.batch = True
+    writer._send_batch = Mock()
+    msg = Mock()
+    msg.change.xid = 10
+    writer.tracker.add(100)
+    writer.tracker.add(200)
+
+    agg_rec = Mock()
+    agg_rec.get_contents = Mock(return_value=('pk', None, b'data'))
+
+    writer.last_send = 1445444940.0
+    with freeze_time('2015-10-21 16:29:00'):
+        writer._record_agg.add_user_record = Mock(return_value=agg_rec)
+        result = writer.put_message(msg, 100)
+        assert result is None, 'Full aggregate is batched, not sent'
+        assert not writer._send_batch.called
+        assert len(writer._batch) == 1
+        assert writer._batch_bytes == 6
+        assert writer.tracker.acked_lsn is None
+
+    with freeze_time('2015-10-21 16:29:20'):
+        writer._record_agg.add_user_record = Mock(return_value=None)
+        writer._record_agg.clear_and_get = Mock(return_value=agg_rec)
+        result = writer.put_message(msg, 200)
+        assert result == [agg_rec, agg_rec], 'Window elapsed flushed the batch'
+        writer._send_batch.assert_called_once_with([{'Data': b'data', 'PartitionKey': 'pk'}] * 2)
+        assert writer._batch == []
+        assert writer.tracker.acked_lsn == 200
+
+
+def test__put_batch_limits(writer):
+    from pg2kinesis import stream
+    writer.batch = True
+    writer._send_batch = Mock()
+
+    agg_rec = Mock()
+    agg_rec.get_contents = Mock(return_value=('pk', None, b'x' * 1048574))
+
+    for lsn in range(6):
+        writer.tracker.add(lsn)
+    for lsn in range(5):
+        assert writer._put_batch(agg_rec, [lsn]) is None
+    assert writer._put_batch(agg_rec, [5]) == [agg_rec] * 5, 'Byte limit would be exceeded'
+    assert writer.tracker.acked_lsn == 4, 'Only acknowledge what was in the sent batch'
+    assert len(writer._batch) == 1
+
+    writer._batch = []
+    agg_rec.get_contents = Mock(return_value=('pk', None, b'x'))
+    for lsn in range(stream.MAX_RECORDS_PER_BATCH - 1):
+        assert writer._put_batch(agg_rec, []) is None
+    assert len(writer._put_batch(agg_rec, [])) == stream.MAX_RECORDS_PER_BATCH, 'Record limit reached'
+
+
+def test__send_batch(writer):
+    assert writer._send_batch([]) is None, 'Nothing to do'
+
+    records = [{'Data': b'1', 'PartitionKey': '1'}, {'Data': b'2', 'PartitionKey': '2'}]
+    err = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'put_records')
+    partial = {'FailedRecordCount': 1, 'Records': [{'SequenceNumber': '1'},
+                                                   {'ErrorCode': 'ProvisionedThroughputExceededException'}]}
+    writer._kinesis.put_records = Mock(side_effect=[err, partial, {'FailedRecordCount': 0, 'Records': []}])
+
+    with patch.object(time, 'sleep') as mock_sleep:
+        writer._send_batch(records)
+        assert mock_sleep.call_args_list == [call(.1), call(.2)], 'Geometric back off!'
+
+    assert writer._kinesis.put_records.call_args_list[1] == call(Records=records, StreamName='blah')
+    assert writer._kinesis.put_records.call_args_list[2] == call(Records=records[1:], StreamName='blah'), \
+        'Only the failed entry is retried'
+
+    with pytest.raises(ClientError):
+        writer._kinesis.put_records = Mock(side_effect=ClientError({'Error': {'Code': 'Something else'}},
+                                                                   'put_records'))
+        writer._send_batch(records)
+
+    writer.back_off_limit = .3
+    writer._kinesis.put_records = Mock(return_value=partial)
+    with pytest.raises(Exception), patch.object(time, 'sleep'):
+        writer._send_batch(records)
+
+
+def test__send_batch_keeps_key_order(writer):
+    records = [{'Data': b'1', 'PartitionKey': 'a'},
+               {'Data': b'2', 'PartitionKey': 'b'},
+               {'Data': b'3', 'PartitionKey': 'a'},
+               {'Data': b'4', 'PartitionKey': 'x', 'ExplicitHashKey': '5'},
+               {'Data': b'5', 'PartitionKey': 'y', 'ExplicitHashKey': '5'},
+               {'Data': b'6', 'PartitionKey': 'a', 'ExplicitHashKey': '7'}]
+    throttled = {'ErrorCode': 'ProvisionedThroughputExceededException'}
+    partial = {'FailedRecordCount': 2, 'Records': [throttled, {'SequenceNumber': '2'}, {'SequenceNumber': '3'},
+                                                   throttled, {'SequenceNumber': '5'}, {'SequenceNumber': '6'}]}
+    writer._kinesis.put_records = Mock(side_effect=[partial, {'FailedRecordCount': 0, 'Records': []}])
+
+    with patch.object(time, 'sleep'):
+        writer._send_batch(records)
+
+    assert writer._kinesis.put_records.call_args_list[1] == call(Records=[records[0], records[2], records[3],
+                                                                          records[4]], StreamName='blah'), \
+        'Accepted entries after a failed one with the same key are resent behind it'
+
+
+def test__send_agg_record_spill(writer):
+    from botocore.exceptions import EndpointConnectionError
+    writer.spill_log = spill_log = Mock(pending_count=0)
+    agg_rec = Mock()
+    agg_rec.get_contents = Mock(return_value=('pk', 'ehk', b'data'))
+    err = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'put_record')
+
+    writer._kinesis.put_record = Mock(side_effect=err)
+    with patch.object(time, 'sleep') as mock_sleep:
+        writer._send_agg_record(agg_rec)
+    assert not mock_sleep.called, 'Spilled rather than backing off'
+    spill_log.append.assert_called_once_with('pk', 'ehk', b'data')
+
+    writer._kinesis.put_record = Mock(side_effect=EndpointConnectionError(endpoint_url='http://kinesis'))
+    writer._send_agg_record(agg_rec)
+    assert spill_log.append.call_count == 2, 'Spilled while Kinesis cannot be reached'
+
+    spill_log.pending_count = 2
+    writer._kinesis.put_record = Mock(return_value={'SequenceNumber': '1'})
+    writer._send_agg_record(agg_rec)
+    assert not writer._kinesis.put_record.called, 'Stays behind what was spilled'
+    assert spill_log.append.call_count == 3
+
+    with pytest.raises(ClientError):
+        spill_log.pending_count = 0
+        writer._kinesis.put_record = Mock(side_effect=ClientError({'Error': {'Code': 'Something else'}},
+                                                                  'put_record'))
+        writer._send_agg_record(agg_rec)
+
+
+def test__send_batch_spill(writer):
+    writer.spill_log = spill_log = Mock(pending_count=0)
+    records = [{'Data': b'1', 'PartitionKey': '1'}, {'Data': b'2', 'PartitionKey': '2', 'ExplicitHashKey': '5'}]
+    partial = {'FailedRecordCount': 1, 'Records': [{'SequenceNumber': '1'},
+                                                   {'ErrorCode': 'ProvisionedThroughputExceededException'}]}
+    writer._kinesis.put_records = Mock(return_value=partial)
+
+    with patch.object(time, 'sleep') as mock_sleep:
+        writer._send_batch(records)
+    assert not mock_sleep.called
+    assert spill_log.append.call_args_list == [call('2', '5', b'2')], 'Only the failed entry is spilled'
+
+    spill_log.pending_count = 1
+    writer._send_batch(records)
+    assert writer._kinesis.put_records.call_count == 1, 'Stays behind what was spilled'
+    assert spill_log.append.call_args_list[1:] == [call('1', None, b'1'), call('2', '5', b'2')]
+
+    spill_log.reset_mock()
+    spill_log.pending_count = 0
+    records.append({'Data': b'3', 'PartitionKey': '3', 'ExplicitHashKey': '5'})
+    partial['Records'].append({'SequenceNumber': '3'})
+    writer._send_batch(records)
+    assert spill_log.append.call_args_list == [call('2', '5', b'2'), call('3', '5', b'3')], \
+        'Spilled with the entries after it to the same shard'
+
+
+def test__send_batch_metrics(writer):
+    from pg2kinesis import metrics
+    retries = metrics.THROTTLE_RETRIES.labels().value
+    requests = sum(metrics.PUT_SECONDS.labels('put_records').counts)
+
+    records = [{'Data': b'1', 'PartitionKey': '1'}, {'Data': b'2', 'PartitionKey': '2'}]
+    err = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'put_records')
+    partial = {'FailedRecordCount': 2, 'Records': [{'ErrorCode': 'ProvisionedThroughputExceededException'}] * 2}
+    writer._kinesis.put_records = Mock(side_effect=[err, partial, {'FailedRecordCount': 0, 'Records': []}])
+
+    with patch.object(time, 'sleep'):
+        writer._send_batch(records)
+
+    assert metrics.THROTTLE_RETRIES.labels().value == retries + 3, 'One request, then two records'
+    assert sum(metrics.PUT_SECONDS.labels('put_records').counts) == requests + 3
+
+
+def test_flush_policy():
+    from pg2kinesis.stream import FlushPolicy
+    writer = Mock(pending_bytes=100, pending_records=10)
+
+    policy = FlushPolicy(linger=2)
+    assert policy.flush_reason(writer, 1.9) is None
+    assert policy.flush_reason(writer, 2) == 'time'
+    assert FlushPolicy(linger=None).flush_reason(writer, 1000) is None, 'Only full aggregates are sent'
+
+    assert FlushPolicy(linger=2, max_batch_bytes=100).flush_reason(writer, 0) == 'size'
+    assert FlushPolicy(linger=2, max_batch_bytes=101).flush_reason(writer, 0) is None
+    assert FlushPolicy(linger=2, max_batch_records=10).flush_reason(writer, 0) == 'size'
+
+
+def test_adaptive_flush_policy():
+    from pg2kinesis.stream import AdaptiveFlushPolicy
+    policy = AdaptiveFlushPolicy(linger=10, max_batch_bytes=1000, min_linger=.1)
+
+    light = Mock(pending_bytes=10, pending_records=1)
+    assert policy.flush_reason(light, .05) is None, 'Always lingers min_linger'
+    assert policy.flush_reason(light, .2) == 'time', 'Took .2s to fill 1% of the batch'
+
+    heavy = Mock(pending_bytes=500, pending_records=50)
+    assert policy.flush_reason(heavy, 1) is None, 'Fills within linger, keep filling'
+    assert policy.flush_reason(heavy, 6) == 'time', 'Would not fill within linger after all'
+    assert policy.flush_reason(heavy, 10) == 'time'
+    assert policy.flush_reason(Mock(pending_bytes=1000), 1) == 'size'
+    assert policy.flush_reason(Mock(pending_bytes=0), 5) is None, 'Nothing to send'
+
+    policy.max_batch_records = 100
+    assert policy.flush_reason(Mock(pending_bytes=10, pending_records=50), 1) is None, 'Records fill it'
+
+
+def test_flush_reasons(writer):
+    from pg2kinesis import metrics
+    writer._send_agg_record = Mock()
+    counts = dict((reason, metrics.FLUSHES.labels(reason).value) for reason in ('size', 'time', 'shutdown'))
+
+    msg = Mock()
+    msg.change.xid = 10
+    writer.last_send = time.time()
+    writer._record_agg.add_user_record = Mock(return_value='full')
+    writer.put_message(msg)
+
+    writer.last_send = 0
+    writer._record_agg.clear_and_get = Mock(return_value='agg')
+    writer.put_message(None)
+
+    writer._record_agg.clear_and_get = Mock(return_value=None)
+    writer.close()
+    writer._record_agg.clear_and_get = Mock(return_value='agg')
+    writer.close()
+
+    assert metrics.FLUSHES.labels('size').value == counts['size'] + 1
+    assert metrics.FLUSHES.labels('time').value == counts['time'] + 1
+    assert metrics.FLUSHES.labels('shutdown').value == counts['shutdown'] + 1, 'Only counted if anything was sent'
+
+
+def test_key_coalescer():
+    from pg2kinesis.formatter import Change, Message
+    from pg2kinesis.stream import KeyCoalescer
+
+    def msg(operation, pkey):
+        return Message(Change(1, 'public.blue', operation, pkey), '{}:{}'.format(operation, pkey))
+
+    coalescer = KeyCoalescer()
+    coalescer.add(msg('insert', '1'), 1)
+    coalescer.add(msg('update', '2'), 2)
+    coalescer.add(msg('UPDATE', '1'), 3)
+    coalescer.add(msg('delete', '1'), 4)
+    coalescer.add(msg('insert', '1'), 5)
+    coalescer.add(msg('truncate', None), 6)
+    coalescer.add(msg('update', '2'), [7, 7])
+    assert coalescer.pending_count == 5
+    assert coalescer.pending_bytes == sum(len(m) for m in ('update:2', 'delete:1', 'insert:1', 'truncate:None',
+                                                            'update:2'))
+
+    assert [(fmt_msg.fmt_msg, lsns) for fmt_msg, lsns in coalescer.drain()] == [
+        ('update:2', [2]),
+        ('delete:1', [1, 3, 4]),
+        ('insert:1', [5]),
+        ('truncate:None', [6]),
+        ('update:2', [7, 7]),
+    ], 'Last change of every row in order, deletes and truncates are not collapsed into later changes'
+    assert coalescer.pending_count == coalescer.pending_bytes == 0
+
+    coalescer.add(Message(Change(1, 'public.blue', 'update', ['1', 'a']), 'x'), 1)
+    coalescer.add(Message(Change(1, 'public.blue', 'update', ['1', 'a']), 'y'), 2)
+    assert coalescer.drain() == [(Message(Change(1, 'public.blue', 'update', ['1', 'a']), 'y'), [1, 2])], \
+        'Composite keys'
+
+
+def test_put_message_coalesced():
+    from pg2kinesis.formatter import Change, Message
+    from pg2kinesis.stream import KeyCoalescer
+    with patch.object(boto3, 'client'):
+        writer = StreamWriter('blah', coalescer=KeyCoalescer(max_bytes=100))
+    writer._send_agg_record = Mock()
+    writer.flush_policy.linger = None
+    for lsn in range(4):
+        writer.tracker.add(lsn)
+
+    for lsn, pkey in enumerate('1211'):
+        assert writer.put_message(Message(Change(1, 'public.blue', 'update', pkey), pkey), lsn) is None
+    assert writer.pending_records == 2
+    assert writer.tracker.acked_lsn is None, 'Held while coalesced'
+
+    [agg_record] = writer.flush()
+    assert agg_record.get_num_user_records() == 2
+    assert writer.tracker.acked_lsn == 3
+    assert writer.pending_bytes == 0
+
+    writer.put_message(Message(Change(1, 'public.blue', 'update', '1'), 'x' * 100))
+    assert writer._send_agg_record.call_count == 2, 'Flushed once the coalescer is full'
+
+
+def test_pending_bytes(writer):
+    from pg2kinesis.stream import PipelinedStreamWriter
+    writer._record_agg.get_num_user_records = Mock(return_value=0)
+    writer._record_agg.get_size_bytes = Mock(return_value=20)
+    assert writer.pending_bytes == 0, 'Empty aggregates hold nothing'
+
+    writer._record_agg.get_num_user_records = Mock(return_value=1)
+    writer._batch_bytes = 100
+    assert writer.pending_bytes == 120
+
+    pipelined = PipelinedStreamWriter(writer)
+    pipelined._queue.put('item', 30)
+    assert pipelined.pending_bytes == 150
+
+    writer._batch = [(Mock(**{'get_num_user_records.return_value': 3}), {}, [])]
+    assert writer.pending_records == 4
+
+
+def test_partition_key():
+    from pg2kinesis.formatter import Change, FullChange
+    key = StreamWriter.partition_key(Change(1, 'public.blue', 'update', '42'))
+    assert key == StreamWriter.partition_key(Change(2, 'public.blue', 'delete', '42')), 'Independent of xid'
+    assert key != StreamWriter.partition_key(Change(1, 'public.blue', 'update', '43'))
+    assert len(key) == 32
+
+    composite = StreamWriter.partition_key(Change(1, 'public.blue', 'update', ['42', 'a']))
+    assert composite == StreamWriter.partition_key(Change(1, 'public.blue', 'update', '42,a'))
+
+    full_key = StreamWriter.partition_key(FullChange(1, {'schema': 'public', 'table': 'blue'}))
+    assert full_key == StreamWriter.partition_key(FullChange(2, {'schema': 'public', 'table': 'blue'}))
+
+
+@pytest.fixture()
+def key_writer():
+    mock_client = Mock()
+    mock_client.get_paginator.return_value.paginate.return_value = [{'StreamDescription': {'Shards': [
+        {'HashKeyRange': {'StartingHashKey': str(2 ** 127)}, 'SequenceNumberRange': {}},
+        {'HashKeyRange': {'StartingHashKey': '0'}, 'SequenceNumberRange': {}},
+        {'HashKeyRange': {'StartingHashKey': '5'}, 'SequenceNumberRange': {'EndingSequenceNumber': '1'}},
+    ]}}]
+    with patch.object(boto3, 'client', return_value=mock_client):
+        writer = StreamWriter('blah', shard_count=2, partition_by='key')
+
+    mock_client.create_stream.assert_called_with(StreamName='blah', ShardCount=2)
+    return writer
+
+
+def test__load_shard_map(key_writer):
+    assert key_writer._shard_starts == [0, 2 ** 127], 'Closed shards skipped, sorted by hash key'
+    assert key_writer._shard_for('0' * 32) == 0
+    assert key_writer._shard_for('7' + 'f' * 31) == 0
+    assert key_writer._shard_for('8' + '0' * 31) == 1
+    assert key_writer._shard_for('f' * 32) == 1
+
+
+def test_put_message_partition_by_key(key_writer):
+    from pg2kinesis.formatter import Change, Message
+    key_writer._send_agg_record = Mock()
+    key_writer.last_send = time.time()
+
+    changes = [Change(1, 'public.blue', 'update', str(i)) for i in range(20)]
+    for lsn, change in enumerate(changes):
+        key_writer.tracker.add(lsn)
+        assert key_writer.put_message(Message(change, 'msg'), lsn) is None
+
+    assert set(key_writer._shard_aggs) == {0, 1}, 'Keys spread over both shards'
+    for shard, agg in key_writer._shard_aggs.items():
+        pk, ehk, _ = agg.current_record.get_contents()
+        assert ehk == str(key_writer._shard_starts[shard]), 'Aggregate pinned to its shard'
+        assert key_writer._shard_for(pk) == shard
+
+    result = key_writer.flush()
+    assert len(result) == 2
+    assert key_writer._send_agg_record.call_count == 2
+    assert key_writer.tracker.acked_lsn == 19
+
+
+def test_put_message_partition_by_key_full(key_writer):
+    from pg2kinesis.formatter import Change, Message
+    key_writer._send_agg_record = Mock()
+    key_writer.last_send = time.time()
+    for lsn in (1, 2, 3):
+        key_writer.tracker.add(lsn)
+
+    msgs = [Message(Change(1, 'public.blue', 'update', str(i)), 'msg') for i in (0, 2, 4)]
+    shards = [key_writer._shard_for(key_writer.partition_key(msg.change)) for msg in msgs]
+    assert shards[0] != shards[1] and shards[1] == shards[2], 'Sanity: keys 1 and 2 share a shard'
+
+    key_writer.put_message(msgs[0], 1)
+    key_writer.put_message(msgs[1], 2)
+    agg = key_writer._shard_aggs[shards[1]]
+    with patch.object(agg, 'add_user_record', return_value='full'):
+        assert key_writer.put_message(msgs[2], 3) == 'full'
+    assert key_writer._send_agg_record.called
+    assert key_writer.tracker.acked_lsn is None, 'Other shard still holds an older message'
+
+
+def test_compress_aggregates(writer):
+    from pg2kinesis.compression import decompress, get_compressor
+    writer.compressor = get_compressor('gzip')
+    writer._kinesis.put_record.return_value = {'SequenceNumber': '1'}
+    writer._send_batch = Mock()
+
+    data = b'x' * 1000
+    agg_rec = Mock()
+    agg_rec.get_contents = Mock(return_value=('pk', None, data))
+
+    writer._send_agg_record(agg_rec)
+    sent = writer._kinesis.put_record.call_args[1]['Data']
+    assert decompress(sent) == data
+
+    writer._put_batch(agg_rec, [], flush=True)
+    assert decompress(writer._send_batch.call_args[0][0][0]['Data']) == data
+
+    assert writer.uncompressed_bytes == 2000
+    assert writer.compressed_bytes == 2 * len(sent)
+    assert writer.compression_ratio == 1000 / len(sent)
+
+
+def test_compress_records(writer):
+    from pg2kinesis.compression import decompress, get_compressor
+    assert writer.compression_ratio is None
+
+    writer.compressor = get_compressor('gzip')
+    writer.compress_records = True
+    writer.flush_policy.linger = None
+    writer._record_agg.add_user_record = Mock(return_value=None)
+
+    msg = Mock()
+    msg.change.xid = 10
+    msg.fmt_msg = u'0,CDC,' + u'x' * 100
+    writer.put_message(msg)
+
+    pk, data = writer._record_agg.add_user_record.call_args[0]
+    assert pk == '10'
+    assert decompress(data) == msg.fmt_msg.encode('utf-8')
+
+    agg_rec = Mock()
+    agg_rec.get_contents = Mock(return_value=('pk', None, b'agg'))
+    assert writer._agg_contents(agg_rec) == ('pk', None, b'agg'), 'Aggregates left alone'
+
+
+def test_routing_stream_writer():
+    from pg2kinesis.stream import RoutingStreamWriter
+    from pg2kinesis.tracker import LSNTracker
+    tracker = LSNTracker()
+    default, audit, busy = Mock(tracker=tracker, pending_bytes=1), Mock(tracker=tracker, pending_bytes=2), \
+        Mock(tracker=tracker, pending_bytes=4)
+    writer = RoutingStreamWriter([(r'public\.audit_.*', audit), (r'public\.(orders|lines)', busy),
+                                  (r'public\..*_log', audit)], default)
+
+    assert writer.writers == [default, audit, busy]
+    assert writer.tracker is tracker
+    assert writer.pending_bytes == 7
+
+    assert writer.writer_for('public.audit_users') is audit
+    assert writer.writer_for('public.orders') is busy
+    assert writer.writer_for('public.orders_archive') is default, 'Whole name must match'
+    assert writer.writer_for('public.access_log') is audit
+    assert writer.writer_for('other.audit_users') is default
+
+    msg = Mock()
+    msg.change.table = 'public.lines'
+    writer.put_message(msg, 10)
+    busy.put_message.assert_called_once_with(msg, 10)
+    assert not default.put_message.called
+
+    writer.put_message(None)
+    for routed in (default, audit, busy):
+        routed.put_message.assert_called_with(None)
+
+    writer.close()
+    assert default.close.called and audit.close.called and busy.close.called
+
+    with pytest.raises(ValueError):
+        RoutingStreamWriter([('public.audit', Mock(tracker=LSNTracker()))], default)
+
+
+def test_routing_stream_writer_acknowledgement():
+    from pg2kinesis.stream import RoutingStreamWriter
+    from pg2kinesis.tracker import LSNTracker
+    tracker = LSNTracker()
+    default, audit = Mock(tracker=tracker), Mock(tracker=tracker)
+    writer = RoutingStreamWriter([('public.audit', audit)], default)
+
+    # One replication message, a row for each stream.
+    tracker.add(10, 2)
+    for table in ('public.audit', 'public.users'):
+        msg = Mock()
+        msg.change.table = table
+        writer.put_message(msg, 10)
+
+    default.tracker.ack([10])
+    assert tracker.acked_lsn is None, 'Still in flight to the audit stream'
+    audit.tracker.ack([10])
+    assert tracker.acked_lsn == 10
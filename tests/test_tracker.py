@@ -0,0 +1,64 @@
+import threading
+
+from pg2kinesis.tracker import LSNTracker
+
+
+def test_add():
+    tracker = LSNTracker()
+    assert tracker.received_lsn is None
+    assert tracker.acked_lsn is None
+
+    tracker.add(10, 2)
+    tracker.add(10, 1)
+    assert len(tracker) == 1, 'Same LSN shares an entry'
+    assert tracker.received_lsn == 10
+
+    tracker.add(20, 0)
+    assert tracker.acked_lsn is None, 'Nothing to send but still behind 10'
+    assert len(tracker) == 2
+
+
+def test_add_nothing_to_send():
+    tracker = LSNTracker()
+    tracker.add(10, 0)
+    assert tracker.acked_lsn == 10, 'Acknowledged right away'
+    assert len(tracker) == 0
+
+    tracker.add(10, 1)
+    assert tracker.acked_lsn == 10
+    assert len(tracker) == 1
+
+
+def test_ack():
+    tracker = LSNTracker()
+    tracker.add(10, 2)
+    tracker.add(20, 1)
+    tracker.add(30, 0)
+    tracker.add(40, 1)
+
+    tracker.ack([])
+    tracker.ack([20, 40])
+    assert tracker.acked_lsn is None, 'Out of order acknowledgement waits for 10'
+
+    tracker.ack([10])
+    assert tracker.acked_lsn is None, 'One message of 10 still in flight'
+
+    tracker.ack([10])
+    assert tracker.acked_lsn == 40, 'Highest contiguous LSN'
+    assert len(tracker) == 0
+
+
+def test_ack_threads():
+    tracker = LSNTracker()
+    lsns = list(range(1, 1001))
+    for lsn in lsns:
+        tracker.add(lsn)
+
+    threads = [threading.Thread(target=lambda part: [tracker.ack([lsn]) for lsn in part], args=(lsns[i::4],))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert tracker.acked_lsn == 1000